@@ -98,7 +98,7 @@ test = Tester().test
 
 # import standard submodules and important classes/functions
 from . import tracer
-from .tracer import CGraph, Function
+from .tracer import CGraph, Function, GuardError, traced
 
 from . import utpm
 from .utpm import UTPM, UTP
@@ -110,6 +110,8 @@ from .compound import *
 
 from . import special
 
+from . import parallel
+
 from . import linalg
 from .linalg import *
 
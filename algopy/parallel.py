@@ -0,0 +1,159 @@
+"""
+Evaluation of a recorded CGraph at many inputs on a pool of processes.
+
+The tape is written once to a temporary file with CGraph.save and every
+worker process loads it with memory-mapped constants (CGraph.load with
+mmap_mode='r'), i.e. the constant arrays of the tape are shared by all
+workers through the page cache and are not pickled.
+
+The inputs and the results are exchanged through shared memory
+(multiprocessing.sharedctypes.RawArray) that is mapped into the address
+space of every worker as numpy.ndarray. The tasks only transfer the index
+ranges of the inputs they work on, hence no UTPM data is pickled at all.
+
+Each worker evaluates its chunk of inputs with CGraph.gradient_batch, i.e.
+the inputs of a chunk are processed by a single sweep over the tape.
+
+Example:
+
+    >>> cg = algopy.CGraph()
+    >>> x = algopy.Function(numpy.ones(3))
+    >>> y = algopy.sum(algopy.exp(x) * x)
+    >>> cg.trace_off()
+    >>> cg.independentFunctionList = [x]
+    >>> cg.dependentFunctionList = [y]
+    >>> X = numpy.random.random((1000, 3))
+    >>> G = algopy.parallel.map_gradient(cg, X, processes=4)
+    >>> G.shape
+    (1000, 3)
+"""
+
+import os
+import tempfile
+import multiprocessing
+import multiprocessing.sharedctypes
+
+import numpy
+
+# state of a worker process, set by _init_worker
+_worker = {}
+
+
+def shared_array(shape):
+    """
+    returns a float64 numpy.ndarray of the given shape that is backed by
+    shared memory, and the underlying RawArray
+    """
+    size = int(numpy.prod(shape))
+    raw = multiprocessing.sharedctypes.RawArray('d', max(size, 1))
+    return numpy.frombuffer(raw, dtype=float, count=size).reshape(shape), raw
+
+
+def _as_array(raw, shape):
+    size = int(numpy.prod(shape))
+    return numpy.frombuffer(raw, dtype=float, count=size).reshape(shape)
+
+
+def _init_worker(path, inputs, outputs):
+    from algopy import CGraph
+    cg = CGraph.load(path, mmap_mode='r')
+    cg.trace_off()
+    _worker['cg'] = cg
+    _worker['X'] = [_as_array(raw, shape) for raw, shape in inputs]
+    _worker['G'] = [_as_array(raw, shape) for raw, shape in outputs]
+
+
+def _gradient_chunk(chunk):
+    start, stop = chunk
+    cg = _worker['cg']
+    X = [Xi[start:stop] for Xi in _worker['X']]
+    G = cg.gradient_batch(X if len(X) > 1 else X[0])
+    if len(X) == 1:
+        G = [G]
+    for Gi, out in zip(G, _worker['G']):
+        out[start:stop] = Gi
+
+
+def map_gradient(cg, X, processes=None, chunksize=None):
+    """
+    Computes the gradients of a function f at many points in parallel.
+
+    The result is the same as CGraph.gradient_batch(X), in particular a
+    GuardError is raised if a point takes a different branch than the
+    recorded one.
+
+    Parameters
+    ----------
+    cg: CGraph instance
+        the recorded function f with a single dependent Function of size 1
+    X: array_like or list of array_like
+        X[b] is the b-th point, i.e. X.shape = (B,) + x.shape.
+        For several independent Functions a list of such arrays.
+    processes: int or None
+        number of worker processes, the number of CPUs if None
+    chunksize: int or None
+        number of points per task. The points of a task are evaluated by
+        a single sweep with P = chunksize. By default the points are
+        distributed such that each process gets about four tasks.
+
+    Returns
+    -------
+    G: numpy.ndarray or list of numpy.ndarray
+        G[b] is the gradient at X[b], a list of arrays for several
+        independent Functions
+    """
+
+    N_indep = len(cg.independentFunctionList)
+
+    if len(cg.dependentFunctionList) != 1:
+        raise ValueError('len(cg.dependentFunctionList) must be 1 but provided %d'%
+                         len(cg.dependentFunctionList))
+
+    if N_indep == 1:
+        X = [X]
+    if len(X) != N_indep:
+        raise ValueError('expected %d arrays of inputs but provided %d'%(N_indep, len(X)))
+
+    X = [numpy.asarray(Xi, dtype=float) for Xi in X]
+    B = X[0].shape[0]
+    for Xi, f in zip(X, cg.independentFunctionList):
+        if Xi.shape[0] != B:
+            raise ValueError('all inputs must have the same batch size %d'%B)
+        if Xi.shape[1:] != numpy.shape(f.x):
+            raise ValueError('expected inputs of shape (B,) + %s but provided %s'%(
+                             numpy.shape(f.x), Xi.shape))
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, -(-B // (4 * processes)))
+
+    inputs = []
+    for Xi in X:
+        Xs, raw = shared_array(Xi.shape)
+        Xs[...] = Xi
+        inputs.append((raw, Xi.shape))
+
+    outputs = []
+    for Xi in X:
+        Gs, raw = shared_array(Xi.shape)
+        outputs.append((raw, Xi.shape))
+
+    fd, path = tempfile.mkstemp(suffix='.npz')
+    os.close(fd)
+    try:
+        cg.save(path)
+        pool = multiprocessing.Pool(processes, _init_worker, (path, inputs, outputs))
+        try:
+            chunks = [(start, min(start + chunksize, B)) for start in range(0, B, chunksize)]
+            pool.map(_gradient_chunk, chunks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        os.remove(path)
+
+    G = [_as_array(raw, shape).copy() for raw, shape in outputs]
+    if N_indep == 1:
+        return G[0]
+    return G
@@ -0,0 +1,52 @@
+from numpy.testing import (TestCase, assert_equal, assert_raises,
+                           assert_array_almost_equal, run_module_suite)
+import numpy
+
+import algopy
+from algopy.parallel import map_gradient
+
+
+class Test_map_gradient(TestCase):
+
+    def trace(self, f, x_list):
+        cg = algopy.CGraph()
+        fx_list = [algopy.Function(x) for x in x_list]
+        fy = f(*fx_list)
+        cg.trace_off()
+        cg.independentFunctionList = fx_list
+        cg.dependentFunctionList = [fy]
+        return cg
+
+    def test_single_independent(self):
+        A = numpy.random.random((4, 4)) + 4*numpy.eye(4)
+
+        def f(x):
+            return algopy.sum(algopy.exp(algopy.dot(A, x)) * x)
+
+        X = numpy.random.random((11, 4))
+        cg = self.trace(f, [X[0]])
+        G = map_gradient(cg, X, processes=2, chunksize=3)
+        assert_equal(G.shape, X.shape)
+        assert_array_almost_equal(G, [cg.gradient(x) for x in X])
+
+    def test_several_independents(self):
+
+        def f(x, z):
+            y = algopy.zeros(3, dtype=x)
+            y[0] = algopy.sin(x[0]) * z
+            y[1:] = x[1:] * x[:2]
+            return algopy.sum(y * y) / z
+
+        X = numpy.random.random((7, 3))
+        Z = numpy.random.random(7) + 1
+        cg = self.trace(f, [X[0], Z[0]])
+        GX, GZ = map_gradient(cg, [X, Z], processes=2)
+        G = [cg.gradient([X[b], Z[b]]) for b in range(7)]
+        assert_array_almost_equal(GX, [g[0] for g in G])
+        assert_array_almost_equal(GZ, [g[1] for g in G])
+
+        assert_raises(ValueError, map_gradient, cg, [X, Z[:3]])
+
+
+if __name__ == "__main__":
+    run_module_suite()
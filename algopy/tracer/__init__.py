@@ -1,3 +1,3 @@
 from . import tracer
 from .tracer import *
-
+from .cache import traced, TracedFunction
@@ -0,0 +1,231 @@
+"""
+Cache of recorded computational graphs, keyed by the signature of the inputs.
+
+The decorator algopy.traced records a CGraph of the decorated function on
+the first call with a new signature (shapes and dtypes of the array arguments
+and the values of the static arguments) and evaluates all further calls with
+the same signature on the recorded tape:
+
+    >>> @algopy.traced
+    ... def f(x, y):
+    ...     return algopy.sum(algopy.exp(x) * y)
+    >>> y = f(numpy.ones(3), numpy.ones(3))             # records a CGraph
+    >>> g = f.gradient(numpy.zeros(3), numpy.ones(3))   # reuses it
+    >>> f.cache_info()
+    CacheInfo(hits=1, misses=1, maxsize=32, currsize=1)
+
+The tape only contains the operations that have been executed when it was
+recorded. Comparisons of the array arguments (e.g. ``if x[0] < 0:``) are
+recorded as guards of the CGraph, see CGraph.check_guards. If a call takes a
+different branch, the function is traced again and the new CGraph is cached
+next to the existing ones, i.e. for each signature there is one CGraph per
+branch pattern. Control flow that depends on the array arguments in other
+ways (e.g. on ``float(x[0])``) is not detected; values that select such a
+branch should be passed as static arguments.
+"""
+
+import collections
+import functools
+
+import numpy
+
+from .tracer import CGraph, Function, GuardError
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class TracedFunction(object):
+    """
+    Function with a cache of recorded CGraphs, see algopy.traced.
+
+    Parameters
+    ----------
+    f: callable
+        the function, it must return a single (array or scalar) value
+    maxsize: int
+        maximal number of cached signatures, the CGraphs of the least
+        recently used signature are evicted when a new one is recorded.
+        Also the maximal number of branch-specific CGraphs per signature.
+    static_argnums: tuple of int
+        positions of the arguments that are not differentiated. They are
+        part of the cache key, hence they have to be hashable.
+    compile: bool
+        if True, the recorded CGraphs are compiled, see CGraph.compile
+
+    Attributes
+    ----------
+    hits, misses: int
+        number of calls that found or did not find a valid CGraph in the cache,
+        i.e. a call that takes a new branch is a miss
+    """
+
+    def __init__(self, f, maxsize=32, static_argnums=(), compile=True):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1 but provided %r'%maxsize)
+
+        self.f = f
+        self.maxsize = maxsize
+        self.static_argnums = tuple(static_argnums)
+        self.compile = compile
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        functools.update_wrapper(self, f)
+
+    def _split(self, args):
+        """ returns the cache key and the list of array arguments """
+        key = []
+        x_list = []
+        for i, a in enumerate(args):
+            if i in self.static_argnums:
+                try:
+                    hash(a)
+                except TypeError:
+                    raise TypeError('static argument %d must be hashable'%i)
+                key.append(('static', a))
+            else:
+                a = numpy.asarray(a)
+                key.append((a.shape, a.dtype.str))
+                x_list.append(a)
+        return tuple(key), x_list
+
+    def _record(self, args):
+        previous = Function.cgraph
+        cg = CGraph()
+        try:
+            fargs = []
+            independents = []
+            for i, a in enumerate(args):
+                if i in self.static_argnums:
+                    fargs.append(a)
+                else:
+                    fa = Function(numpy.asarray(a))
+                    fargs.append(fa)
+                    independents.append(fa)
+            fy = Function.totype(self.f(*fargs))
+        finally:
+            Function.cgraph = previous
+
+        cg.independentFunctionList = independents
+        cg.dependentFunctionList = [fy]
+        if self.compile:
+            cg.compile()
+        return cg
+
+    def _dispatch(self, args, evaluate):
+        """
+        returns evaluate(cg, x_list) for the first cached CGraph cg of the
+        signature of args whose guards hold, a new CGraph is recorded if
+        there is none
+        """
+
+        key, x_list = self._split(args)
+        cgs = self._cache.pop(key, [])
+        if cgs:
+            self._cache[key] = cgs
+
+        for n, cg in enumerate(cgs):
+            try:
+                retval = evaluate(cg, x_list)
+            except GuardError:
+                continue
+            self.hits += 1
+            cgs.insert(0, cgs.pop(n))
+            return retval
+
+        self.misses += 1
+        cg = self._record(args)
+        if not cgs:
+            while len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+            self._cache[key] = cgs
+        cgs.insert(0, cg)
+        del cgs[self.maxsize:]
+        return evaluate(cg, x_list)
+
+    def get_cgraph(self, *args):
+        """
+        returns the CGraph for args and the array arguments, the CGraph is
+        recorded if there is no cached CGraph for the signature and the
+        branch pattern of args
+        """
+
+        def evaluate(cg, x_list):
+            cg.check_guards(x_list)
+            return cg, x_list
+
+        return self._dispatch(args, evaluate)
+
+    def cache_info(self):
+        """ returns the hits, misses, maxsize and current size of the cache """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        """ removes all CGraphs from the cache and resets the counters """
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unpack(cg, x_list):
+        if len(cg.independentFunctionList) == 1:
+            return x_list[0]
+        return x_list
+
+    def __call__(self, *args):
+        """ evaluates the function on the recorded CGraph """
+        return self.value(*args)
+
+    def value(self, *args):
+        """ evaluates the function on the recorded CGraph """
+        return self._dispatch(args, lambda cg, x_list: cg.function(x_list)[0])
+
+    def gradient(self, *args):
+        """
+        computes the gradient, see CGraph.gradient. For several array
+        arguments a list of gradients is returned.
+        """
+        return self._dispatch(args, lambda cg, x_list:
+                              cg.gradient(self._unpack(cg, x_list)))
+
+    def jacobian(self, *args):
+        """ computes the Jacobian w.r.t. the single array argument, see CGraph.jacobian """
+        return self._dispatch(args, lambda cg, x_list:
+                              cg.jacobian(self._unpack(cg, x_list)))
+
+    def hessian(self, *args):
+        """ computes the Hessian w.r.t. the single array argument, see CGraph.hessian """
+        return self._dispatch(args, lambda cg, x_list:
+                              cg.hessian(self._unpack(cg, x_list)))
+
+
+def traced(f=None, maxsize=32, static_argnums=(), compile=True):
+    """
+    Decorator that records a CGraph of f for each signature of the arguments
+    and reuses it for further calls, see algopy.tracer.cache.
+
+    Can be used as @traced or with options, e.g.
+    @traced(maxsize=8, static_argnums=(1,)).
+
+    The decorated function provides the methods value, gradient, jacobian
+    and hessian, which take the same arguments as f, and the methods
+    cache_info and cache_clear. Calling it is the same as calling value.
+
+    Parameters
+    ----------
+    f: callable
+    maxsize, static_argnums, compile:
+        see TracedFunction
+
+    Returns
+    -------
+    tf: TracedFunction instance
+    """
+
+    def decorator(f):
+        return TracedFunction(f, maxsize=maxsize, static_argnums=static_argnums,
+                              compile=compile)
+
+    if f is None:
+        return decorator
+    return decorator(f)
@@ -0,0 +1,445 @@
+"""
+Checkpointed reverse mode for compiled CGraph programs.
+
+The reverse sweep needs the values of all intermediate nodes. For
+time-stepping tapes (e.g. an explicit Euler integration traced over many
+steps) the memory to store them grows linearly with the number of steps.
+
+CGraph.compile(checkpoints=c) or CGraph.compile(memory_budget=nbytes) returns a
+CheckpointedProgram that splits the tape into steps and only stores the
+states at a few step boundaries (the checkpoints). In the reverse sweep the
+steps are recomputed from the checkpoints following a binomial (revolve)
+schedule, see
+
+    Griewank, A. and Walther, A., "Algorithm 799: revolve: an implementation
+    of checkpointing for the reverse or adjoint mode of computational
+    differentiation", ACM TOMS 26(1), 2000.
+
+The state at a step boundary is the set of values that are computed before
+and used after the boundary. The step boundaries are either marked during
+tracing with CGraph.mark_step() or inferred from repeated patterns in the
+sequence of opcodes, see infer_steps.
+
+Example:
+
+    >>> cg = algopy.CGraph()
+    >>> x = algopy.Function(numpy.ones(2))
+    >>> y = x
+    >>> for i in range(100):
+    ...     cg.mark_step()
+    ...     y = y + 0.01 * algopy.sin(y)
+    >>> z = algopy.sum(y)
+    >>> cg.trace_off()
+    >>> cg.independentFunctionList = [x]
+    >>> cg.dependentFunctionList = [z]
+    >>> program = cg.compile(checkpoints=5)
+    >>> g = cg.gradient(numpy.ones(2))
+    >>> program.recomputations
+    321
+
+i.e. the 100 steps are evaluated 321 times in the reverse sweep with 5
+checkpoints instead of storing the values of all 100 steps.
+"""
+
+import traceback
+
+import numpy
+
+import algopy
+from .program import Program
+from .passes import fresh_opcodes, mutated_alias_classes
+
+
+def binomial(n, k):
+    """ returns the binomial coefficient n over k """
+    if k < 0 or k > n:
+        return 0
+    retval = 1
+    for i in range(min(k, n - k)):
+        retval = retval * (n - i) // (i + 1)
+    return retval
+
+
+def revolve_schedule(n, c):
+    """
+    Computes a binomial checkpointing schedule for the reversal of n steps
+    with c checkpoints.
+
+    Parameters
+    ----------
+    n: int
+        number of steps
+    c: int
+        number of checkpoints (c >= 1), the state before the first step
+        occupies one of them
+
+    Returns
+    -------
+    actions: list of tuples
+        the actions of the schedule:
+
+            * ('store', k): store the state at boundary k (before step k)
+            * ('restore', k): restore the state at boundary k
+            * ('free', k): delete the checkpoint at boundary k
+            * ('advance', k, l): evaluate the steps k, ..., l-1 and keep
+              only the values that are needed after step l-1
+            * ('tape', k): evaluate step k and keep all its values
+            * ('reverse', k): evaluate the pullback of step k
+    """
+
+    if c < 1:
+        raise ValueError('at least one checkpoint is required')
+
+    actions = []
+
+    def rec(a, b, c):
+        # the state at a is current and stored in a checkpoint
+        n = b - a
+        if n == 1:
+            actions.extend([('tape', a), ('reverse', a)])
+
+        elif c == 1:
+            for i in range(b - 1, a - 1, -1):
+                if i != b - 1:
+                    actions.append(('restore', a))
+                if i > a:
+                    actions.append(('advance', a, i))
+                actions.extend([('tape', i), ('reverse', i)])
+
+        else:
+            # smallest repetition number r such that beta(c, r) >= n
+            r = 1
+            while binomial(c + r, c) < n:
+                r += 1
+
+            m = min(max(n - binomial(c - 1 + r, c - 1), 1), n - 1)
+            actions.extend([('advance', a, a + m), ('store', a + m)])
+            rec(a + m, b, c - 1)
+            actions.extend([('free', a + m), ('restore', a)])
+            rec(a, a + m, c)
+
+    actions.append(('store', 0))
+    rec(0, n, c)
+    actions.append(('free', 0))
+    return actions
+
+
+def infer_steps(opcodes, min_repetitions=2):
+    """
+    Infers step boundaries from a repeated pattern in the sequence of opcodes.
+
+    Finds the period p whose consecutive repetitions cover the longest part
+    of the sequence (the smallest p among equally good candidates).
+
+    Parameters
+    ----------
+    opcodes: list of str
+        e.g. the opcodes of the forward instructions of a Program
+    min_repetitions: int
+        minimal number of repetitions of the pattern
+
+    Returns
+    -------
+    boundaries: list of int
+        the positions in opcodes where a repetition of the pattern starts
+    """
+
+    N = len(opcodes)
+    codes = {}
+    seq = numpy.array([codes.setdefault(op, len(codes)) for op in opcodes], dtype=int)
+
+    best = (0, 0, 0)   # (coverage, period, start)
+    for p in range(1, N // min_repetitions + 1):
+        eq = numpy.concatenate(([False], seq[:-p] == seq[p:], [False]))
+        changes = numpy.flatnonzero(eq[1:] != eq[:-1])
+        if changes.size == 0:
+            continue
+        starts, ends = changes[::2], changes[1::2]
+        lengths = ends - starts
+        k = numpy.argmax(lengths)
+        coverage = (lengths[k] // p) * p + p
+        if coverage // p >= min_repetitions and coverage > best[0]:
+            best = (coverage, p, starts[k])
+
+    coverage, p, start = best
+    if p == 0:
+        return []
+    return list(range(start, start + coverage + 1, p))
+
+
+class CheckpointedProgram(Program):
+    """
+    Program with a checkpointed reverse sweep, see the module docstring.
+
+    The forward instructions are split into steps at the boundaries
+    0 = b_0 < b_1 < ... < b_n = len(self.forward). The pushforward evaluates
+    each step once and stores the states at the checkpoints of the schedule,
+    the pullback recomputes the steps from the checkpoints.
+
+    Parameters
+    ----------
+    functionList, independent_slots, dependent_slots, wrt_slots:
+        see Program
+    boundaries: list of int
+        positions in self.forward (i.e. in the list of forward instructions)
+        where a new step starts
+    checkpoints: int or None
+        number of checkpoints
+    memory_budget: int or None
+        number of bytes for the checkpoints and the values of one step.
+        The number of checkpoints is chosen in each pushforward based on the
+        number of Taylor coefficients D*P. Either checkpoints or
+        memory_budget has to be provided.
+
+    Attributes
+    ----------
+    boundaries: list of int
+        the step boundaries b_0, ..., b_n
+    live: list of list of int
+        live[k] are the slots that form the state at boundary b_k
+    snapshots: int
+        the number of checkpoints used by the current schedule
+    schedule: list of tuples
+        the current schedule, see revolve_schedule
+    recomputations: int
+        the number of step evaluations of the last pullback
+    """
+
+    def __init__(self, functionList, independent_slots, dependent_slots,
+                 wrt_slots=None, boundaries=(), checkpoints=None, memory_budget=None):
+
+        if dependent_slots is None:
+            raise ValueError('checkpointing requires the dependentFunctionList')
+
+        if checkpoints is None and memory_budget is None:
+            raise ValueError('either checkpoints or memory_budget must be provided')
+
+        if checkpoints is not None and checkpoints < 1:
+            raise ValueError('checkpoints must be at least 1 but provided %r'%checkpoints)
+
+        Program.__init__(self, functionList, independent_slots, dependent_slots,
+                         wrt_slots, release_buffers=False)
+
+        self.checkpoints = checkpoints
+        self.memory_budget = memory_budget
+
+        position = {}
+        for i, ins in enumerate(self.forward):
+            position[ins.result] = i
+
+        # bytes of one Taylor coefficient of the values
+        def size(x):
+            if isinstance(x, tuple):
+                return sum([size(xi) for xi in x])
+            elif isinstance(x, algopy.UTPM):
+                return x.data[0, 0].nbytes
+            elif isinstance(x, numpy.ndarray):
+                return x.nbytes
+            return 8
+
+        self._sizes = dict([(s, size(self.values[s])) for s in position])
+
+        # the buffers modified by setitem must not be part of a state, since
+        # checkpoints store references to the values. Hence no step boundary
+        # may lie within the range of forward instructions that use such a buffer.
+        mutated, root = mutated_alias_classes(functionList)
+        extent = {}
+        for i, ins in enumerate(self.forward):
+            for s in [ins.result] + [t for pos, t in ins.slots]:
+                if root[s] in mutated and s in position:
+                    lo, hi = extent.get(root[s], (i, i))
+                    extent[root[s]] = (min(lo, position[s], i), max(hi, i))
+        self._setitem_extents = list(extent.values())
+
+        self._position = position
+        self._checkpoints = {}
+        self._x_list = None
+        self._pending = None
+        self.schedule = None
+        self.snapshots = None
+        self.recomputations = 0
+        self.set_boundaries(boundaries)
+
+    def set_boundaries(self, boundaries):
+        """
+        Splits the forward instructions into steps.
+
+        Parameters
+        ----------
+        boundaries: list of int
+            positions in self.forward where a new step starts. Boundaries
+            that would split the use of a buffer modified by setitem are ignored.
+        """
+
+        F = len(self.forward)
+        position = self._position
+        boundaries = [b for b in boundaries if 0 < b < F and
+                      not any([lo < b <= hi for lo, hi in self._setitem_extents])]
+        self.boundaries = [0] + sorted(set(boundaries)) + [F]
+
+        self.steps = [self.forward[self.boundaries[k]:self.boundaries[k+1]]
+                      for k in range(len(self.boundaries) - 1)]
+        reverse = set([id(ins) for ins in self.reverse])
+        self.reverse_steps = [[ins for ins in instructions[::-1] if id(ins) in reverse]
+                              for instructions in self.steps]
+
+        # last use of each value in the forward sweep
+        last_use = {}
+        for i, ins in enumerate(self.forward):
+            for pos, s in ins.slots:
+                last_use[s] = i
+        for s in self.dependent_slots:
+            last_use[s] = F
+
+        # states at the boundaries, including the bases of views
+        parents = {}
+        for ins in self.forward:
+            if ins.opcode not in fresh_opcodes:
+                parents[ins.result] = [s for pos, s in ins.slots if s in position]
+
+        self.live = []
+        for b in self.boundaries:
+            live = set([s for s, i in position.items()
+                        if i < b and last_use.get(s, -1) >= b])
+            todo = list(live)
+            while todo:
+                for t in parents.get(todo.pop(), []):
+                    if t not in live:
+                        live.add(t)
+                        todo.append(t)
+            self.live.append(sorted(live))
+
+        self.schedule = None
+        self._pending = None
+
+    def get_snapshots(self):
+        """ returns the number of checkpoints for the current D and P """
+
+        if self.memory_budget is None:
+            return int(min(self.checkpoints, len(self.steps)))
+
+        DP = 1 if self._DP is None else self._DP[0] * self._DP[1]
+        sizes = self._sizes
+
+        state_bytes = max([sum([sizes[s] for s in live]) for live in self.live] + [1])
+        step_bytes = max([sum([sizes[ins.result] for ins in instructions])
+                          for instructions in self.steps] + [0])
+
+        c = (self.memory_budget - step_bytes * DP) // (state_bytes * DP)
+        if c < 1:
+            raise ValueError('the memory budget of %d bytes is too small, at least '
+                             '%d bytes are required'%(self.memory_budget,
+                                                      (step_bytes + state_bytes) * DP))
+        return int(min(c, len(self.steps)))
+
+    def _drop(self, slots):
+        values = self.values
+        for s in slots:
+            values[s] = None
+
+    def _run(self, action):
+        kind = action[0]
+
+        if kind == 'store':
+            k = action[1]
+            self._checkpoints[k] = [(s, self.values[s]) for s in self.live[k]]
+
+        elif kind == 'restore':
+            k = action[1]
+            self._drop(self._position)
+            for s, x in self._checkpoints[k]:
+                self.values[s] = x
+
+        elif kind == 'free':
+            del self._checkpoints[action[1]]
+
+        elif kind == 'advance':
+            for k in range(action[1], action[2]):
+                for ins in self.steps[k]:
+                    self._evaluate(ins)
+                self.recomputations += 1
+                keep = set(self.live[k+1])
+                self._drop([s for s in self.live[k] if s not in keep])
+                self._drop([ins.result for ins in self.steps[k]
+                            if ins.result not in keep])
+
+        elif kind == 'tape':
+            for ins in self.steps[action[1]]:
+                self._evaluate(ins)
+            self.recomputations += 1
+
+        elif kind == 'reverse':
+            k = action[1]
+            for ins in self.reverse_steps[k]:
+                self._pull_back(ins, self._protected, True)
+            keep = self._protected
+            self._drop([ins.result for ins in self.steps[k] if ins.result not in keep])
+
+    def _run_until_first_tape(self):
+        while True:
+            action = self.schedule[self._pending]
+            self._pending += 1
+            self._run(action)
+            if action[0] == 'tape':
+                break
+
+    def pushforward(self, x_list, independent_slots, dependent_slots=()):
+        """
+        Evaluates the program for the inputs x_list and stores the
+        checkpoints, see Program.pushforward.
+        """
+
+        self._x_list = list(x_list)
+        self._protected = set(independent_slots) | set(dependent_slots)
+        self._checkpoints = {}
+        self._drop(self._position)
+        self._set_independents(x_list, independent_slots)
+
+        c = self.get_snapshots()
+        if self.schedule is None or c != self.snapshots:
+            self.schedule = revolve_schedule(len(self.steps), c)
+            self.snapshots = c
+
+        self._pending = 0
+        try:
+            self._run_until_first_tape()
+        except Exception as e:
+            err_str = 'pushforward failed, reported error is:\n%s'%e
+            err_str += 'traceback:\n%s'%traceback.format_exc()
+            raise Exception(err_str)
+
+        self._lift_dependents(dependent_slots)
+
+    def pullback(self, xbar_list, dependent_slots, independent_slots=()):
+        """
+        Evaluates the adjoint program with the checkpointing schedule,
+        see Program.pullback.
+
+        The number of step evaluations is stored in self.recomputations.
+        """
+
+        if self._x_list is None:
+            raise ValueError('pushforward has to be called before pullback')
+
+        if self._pending is None:
+            # the schedule has been consumed by a previous pullback
+            self.pushforward(self._x_list, independent_slots, dependent_slots)
+
+        self._protected = set(independent_slots) | set(dependent_slots)
+        self.recomputations = 0
+        self._seed_adjoints(xbar_list, dependent_slots)
+
+        try:
+            for action in self.schedule[self._pending:]:
+                self._run(action)
+        except Exception as e:
+            err_str = '\npullback failed (%s)\n\n'%(action,)
+            err_str += '\n%s'%traceback.format_exc()
+            raise Exception(err_str)
+
+        self._pending = None
+
+        for s in independent_slots:
+            self.get_adjoint(s)
+
+        self._pool = {}
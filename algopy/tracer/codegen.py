@@ -0,0 +1,514 @@
+"""
+Generation of Python source code from a recorded CGraph.
+
+CGraph.to_python_source() emits a module with two straight-line functions:
+
+    * ``forward(C, x_0, ..., x_{K-1})`` evaluates the tape and returns the
+      values of the dependent Functions and the values that are needed by
+      the reverse sweep
+    * ``reverse(C, saved, ybar_0, ..., ybar_{M-1})`` evaluates the adjoint
+      sweep and returns the adjoints of the independent and of the dependent
+      Functions
+
+The slots of the tape become local variables ``v<n>`` (values) and ``b<n>``
+(adjoints), the elementary functions and their pullbacks are called directly
+and the constants that cannot be written as Python literals are passed in the
+list ``C``. Hence there is no interpretive overhead per node: no argument
+lists are rebuilt, no types are checked and no pullback functions are looked
+up during the sweeps. Temporaries that are not needed by the reverse sweep are
+deleted after their last use in the forward sweep.
+
+CGraph.codegen() compiles the module and installs it as the program of the
+CGraph, i.e. all drivers (gradient, jacobian, hessian, ...) evaluate the
+generated code. With a path, the module is written to ``<path>.py`` and
+imported, so that Python caches its bytecode, and the constants are written
+to ``<path>.npz``. The module can then also be used on its own:
+
+    >>> cg.codegen('objective')
+    >>> import objective
+    >>> C = objective.constants()
+    >>> (y,), saved = objective.forward(C, algopy.UTPM.init_jacobian(x))
+
+Example:
+
+    >>> cg = algopy.CGraph()
+    >>> x = algopy.Function(numpy.ones(3))
+    >>> y = algopy.sum(algopy.sin(x) * x)
+    >>> cg.trace_off()
+    >>> cg.independentFunctionList = [x]
+    >>> cg.dependentFunctionList = [y]
+    >>> print(cg.to_python_source())
+    ...
+    def forward(C, x0):
+        v0 = x0
+        v1 = sin(v0)
+        v2 = mul(v1, v0)
+        v3 = sum(v2, None, None, None)
+        return (lift(v3, get_DP(x0)),), (v0, v1, v2, v3)
+    ...
+"""
+
+import os
+import re
+import sys
+import json
+import types
+
+try:
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import cache_from_source
+except ImportError:
+    # Python 2
+    import imp
+    SourceFileLoader = None
+
+import numpy
+
+import algopy
+from .tracer import Function, get_pullback_function
+from .passes import fresh_opcodes
+from .serialization import func_to_opcode, opcode_to_func, _Encoder, _Decoder
+
+# names in the generated source that must not be used for functions
+reserved_names = set([
+    'C', 'saved', 'DP', 'forward', 'reverse', 'constants', 'slice', 'Ellipsis',
+    'opcode_to_func', 'get_DP', 'lift', 'owns', 'adjoint_like', 'load_constants',
+    ])
+
+
+def get_DP(*x_list):
+    """ returns (D,P) of the first UTPM instance in x_list or None """
+    for x in x_list:
+        if isinstance(x, algopy.UTPM):
+            return x.data.shape[:2]
+    return None
+
+
+def lift(x, DP):
+    """ converts a constant x to a UTPM instance with the given (D,P), see Program._lift """
+    if DP is None or x is None or isinstance(x, (algopy.UTPM, tuple)):
+        return x
+    if not (numpy.isscalar(x) or isinstance(x, numpy.ndarray)):
+        return x
+    x = numpy.asarray(x)
+    data = numpy.zeros(DP + x.shape, dtype=x.dtype)
+    data[0, ...] = x
+    return algopy.UTPM(data)
+
+
+def owns(x):
+    """ returns False if x is a UTPM instance that is a view, see Program.get_adjoint """
+    return not isinstance(x, algopy.UTPM) or x.owndata == True
+
+
+def adjoint_like(x):
+    """ returns a new zero adjoint of the value x, see Program.get_adjoint """
+    if isinstance(x, algopy.UTPM):
+        return x.zeros_like()
+    elif numpy.isscalar(x):
+        return 0.
+    elif isinstance(x, tuple):
+        return tuple([xi.zeros_like() if isinstance(xi, algopy.UTPM) else None for xi in x])
+    return None
+
+
+def tuple_expr(items):
+    """ returns the Python expression of a tuple of the expressions items """
+    if len(items) == 1:
+        return '(%s,)'%items[0]
+    return '(%s)'%', '.join(items)
+
+
+def load_constants(filename):
+    """ loads the constants of a generated module filename from the corresponding .npz file """
+    path = os.path.splitext(filename)[0] + '.npz'
+    if not os.path.exists(path):
+        return []
+    with numpy.load(path) as npz:
+        arrays = dict([(key, npz[key]) for key in npz.files])
+    constants = json.loads(str(arrays.pop('constants')))
+    decoder = _Decoder(arrays)
+    return [decoder.decode(c) for c in constants]
+
+
+class SourceGenerator(object):
+    """
+    Generates the source code of a compiled Program, see the module docstring.
+
+    Attributes
+    ----------
+    constants: list
+        the constants C that are referenced by the source
+    names: dict
+        maps the module level names of the source to 'module.qualname'
+        of the referenced functions
+    """
+
+    def __init__(self, program, independent_slots, dependent_slots):
+        self.program = program
+        self.independent_slots = list(independent_slots)
+        self.dependent_slots = list(dependent_slots)
+        self.constants = []
+        self._constant_ids = {}
+        self.names = {}
+        self._name_of = {}
+
+    def constant(self, c):
+        """ returns a Python expression of the constant c """
+
+        if c is None or c is Ellipsis or isinstance(c, (bool, str)):
+            return repr(c)
+
+        elif isinstance(c, (int, float)) and not isinstance(c, numpy.generic) and \
+             numpy.isfinite(c):
+            return repr(c)
+
+        elif isinstance(c, slice):
+            return 'slice(%s, %s, %s)'%(self.constant(c.start), self.constant(c.stop),
+                                        self.constant(c.step))
+
+        elif isinstance(c, tuple):
+            return tuple_expr([self.constant(ci) for ci in c])
+
+        k = self._constant_ids.get(id(c))
+        if k is None:
+            k = len(self.constants)
+            self.constants.append(c)
+            self._constant_ids[id(c)] = k
+        return 'C[%d]'%k
+
+    def function(self, func):
+        """ returns a Python expression of the function func """
+
+        if id(func) in self._name_of:
+            return self._name_of[id(func)]
+
+        try:
+            opcode = func_to_opcode(func)
+        except ValueError:
+            # e.g. fused kernels or lambdas
+            name = self.constant(func)
+        else:
+            base = re.sub(r'\W', '_', func.__name__)
+            name = base
+            n = 1
+            while name in self.names or name in reserved_names:
+                n += 1
+                name = '%s_%d'%(base, n)
+            self.names[name] = opcode
+
+        self._name_of[id(func)] = name
+        return name
+
+    def value(self, s):
+        return 'v%d'%s
+
+    def adjoint(self, s):
+        return 'b%d'%s
+
+    def generate(self):
+        program = self.program
+        instructions = program.instructions
+        independent_slots = self.independent_slots
+        dependent_slots = self.dependent_slots
+
+        # slots whose adjoints are allocated in the reverse sweep, views need
+        # the adjoints of the arguments
+        adjoint_slots = set(dependent_slots) | set(independent_slots)
+        for ins in program.reverse:
+            adjoint_slots.add(ins.result)
+            adjoint_slots.update([s for pos, s in ins.slots])
+        for s in sorted(adjoint_slots, reverse=True):
+            ins = instructions[s]
+            if ins.func != Function.Id and ins.opcode not in fresh_opcodes:
+                adjoint_slots.update([t for pos, t in ins.slots])
+
+        saved = sorted(adjoint_slots)
+        saved_set = set(saved)
+
+        forward = self.generate_forward(saved, saved_set)
+        reverse = self.generate_reverse(saved)
+
+        lines = ['# generated by algopy.tracer.codegen from a CGraph with %d nodes'%len(instructions),
+                 '',
+                 'from algopy.tracer.codegen import opcode_to_func, get_DP, lift, owns, '
+                 'adjoint_like, load_constants',
+                 '']
+        for name in sorted(self.names):
+            lines.append('%s = opcode_to_func(%r)'%(name, self.names[name]))
+        lines += ['',
+                  '',
+                  'def constants():',
+                  '    return load_constants(__file__)',
+                  '',
+                  '']
+        return '\n'.join(lines + forward + ['', ''] + reverse) + '\n'
+
+    def generate_forward(self, saved, saved_set):
+        program = self.program
+        instructions = program.instructions
+        v = self.value
+        x_names = ['x%d'%k for k in range(len(self.independent_slots))]
+
+        lines = ['def forward(%s):'%', '.join(['C'] + x_names)]
+        if any([ins.lift for ins in program.forward]):
+            lines.append('    DP = get_DP(%s)'%', '.join(x_names))
+
+        # last use of the values in the forward sweep
+        last_use = {}
+        for i, ins in enumerate(program.forward):
+            for pos, s in ins.slots:
+                last_use[s] = i
+        keep = saved_set | set(self.dependent_slots)
+
+        defined = set()
+
+        def define(s):
+            if s in defined:
+                return
+            if s in self.independent_slots:
+                lines.append('    %s = %s'%(v(s), x_names[self.independent_slots.index(s)]))
+            else:
+                lines.append('    %s = %s'%(v(s), self.constant(program.values[s])))
+            defined.add(s)
+
+        for s in self.independent_slots:
+            define(s)
+
+        for i, ins in enumerate(program.forward):
+            args = [self.constant(a) for a in ins.args]
+            for pos, s in ins.slots:
+                define(s)
+                args[pos] = 'lift(%s, DP)'%v(s) if ins.lift else v(s)
+            lines.append('    %s = %s(%s)'%(v(ins.result), self.function(ins.func), ', '.join(args)))
+            defined.add(ins.result)
+
+            dead = sorted(set([s for pos, s in ins.slots if last_use[s] == i and s not in keep]))
+            if dead:
+                lines.append('    del %s'%', '.join([v(s) for s in dead]))
+
+        for s in saved + self.dependent_slots:
+            define(s)
+
+        ys = ['lift(%s, get_DP(%s))'%(v(s), ', '.join(x_names)) for s in self.dependent_slots]
+        lines.append('    return %s, %s'%(tuple_expr(ys), tuple_expr([v(s) for s in saved])))
+        return lines
+
+    def generate_reverse(self, saved):
+        program = self.program
+        instructions = program.instructions
+        v, b = self.value, self.adjoint
+        protected = set(self.independent_slots) | set(self.dependent_slots)
+        ybar_names = ['ybar%d'%k for k in range(len(self.dependent_slots))]
+
+        lines = ['def reverse(%s):'%', '.join(['C', 'saved'] + ybar_names)]
+        if saved:
+            lines.append('    %s = saved'%tuple_expr([v(s) for s in saved])[1:-1])
+
+        allocated = set()
+
+        def allocate(s):
+            if s in allocated:
+                return
+            ins = instructions[s]
+            if ins.func == Function.Id or ins.opcode in fresh_opcodes:
+                lines.append('    %s = adjoint_like(%s)'%(b(s), v(s)))
+            else:
+                args = [self.constant(a) for a in ins.args]
+                for pos, t in ins.slots:
+                    allocate(t)
+                    args[pos] = b(t)
+                lines.append('    %s = adjoint_like(%s) if owns(%s) else %s(%s)'%(
+                             b(s), v(s), v(s), self.function(ins.func), ', '.join(args)))
+            allocated.add(s)
+
+        for k, s in enumerate(self.dependent_slots):
+            allocate(s)
+            lines.append('    %s[...] = %s'%(b(s), ybar_names[k]))
+
+        for ins in program.reverse:
+            r = ins.result
+            y = program.values[r]
+            restore = None
+            if ins.setitem is not None:
+                restore = '    %s[%s] = %s'%(v(ins.slots[0][1]), self.constant(ins.setitem[0]),
+                                             self.constant(ins.setitem[1]))
+
+            ybar_slot = ins.slots[0][1] if y is None else r
+            if ybar_slot not in allocated:
+                # the adjoint is zero, hence there is nothing to pull back
+                if restore is not None:
+                    lines.append(restore)
+                continue
+
+            args = [self.constant(a) for a in ins.args]
+            argsbar = ['None'] * len(ins.args)
+            for pos, s in ins.slots:
+                allocate(s)
+                args[pos] = v(s)
+                argsbar[pos] = b(s)
+
+            pb = get_pullback_function(algopy.UTPM, ins.func)
+            out = 'out=%s'%tuple_expr(argsbar)
+            if isinstance(y, tuple):
+                call = ', '.join(['%s[%d]'%(b(r), i) for i in range(len(y))] + args +
+                                 ['%s[%d]'%(v(r), i) for i in range(len(y))])
+            elif y is None:
+                call = ', '.join(args)
+            else:
+                call = ', '.join([b(r)] + args + [v(r)])
+            lines.append('    %s(%s, %s)'%(self.function(pb), call, out))
+
+            if restore is not None:
+                lines.append(restore)
+
+            if y is not None and r not in protected:
+                lines.append('    del %s'%b(r))
+
+        for s in self.independent_slots:
+            allocate(s)
+
+        lines.append('    return %s, %s'%(tuple_expr([b(s) for s in self.independent_slots]),
+                                       tuple_expr([b(s) for s in self.dependent_slots])))
+        return lines
+
+
+def generate(program, independent_slots, dependent_slots):
+    """
+    Generates the source code of the compiled Program program.
+
+    Returns
+    -------
+    source: str
+    constants: list
+        the constants C that have to be passed to forward and reverse
+    """
+    generator = SourceGenerator(program, independent_slots, dependent_slots)
+    return generator.generate(), generator.constants
+
+
+def write_module(source, constants, path):
+    """
+    Writes the source to path.py (only if it has changed) and the constants
+    to path.npz, and imports the module from path.py, i.e. Python caches
+    its bytecode.
+    """
+
+    # encode the constants first, i.e. nothing is written if one cannot be saved
+    encoder = _Encoder()
+    encoded = [encoder.encode(c) for c in constants]
+
+    filename = path + '.py'
+    old_source = None
+    if os.path.exists(filename):
+        with open(filename) as fobj:
+            old_source = fobj.read()
+
+    if old_source != source:
+        with open(filename, 'w') as fobj:
+            fobj.write(source)
+
+        # the cached bytecode is only invalidated by the modification time
+        # (in seconds) and the size of the source, remove it explicitly
+        if os.path.exists(cached_bytecode(filename)):
+            os.remove(cached_bytecode(filename))
+
+    if constants:
+        numpy.savez(path + '.npz', constants=numpy.array(json.dumps(encoded)), **encoder.arrays)
+    elif os.path.exists(path + '.npz'):
+        os.remove(path + '.npz')
+
+    return import_module(os.path.basename(path), filename)
+
+
+def cached_bytecode(filename):
+    """ returns the file name of the cached bytecode of the source filename """
+    if SourceFileLoader is None:
+        return filename + 'c'
+    return cache_from_source(filename)
+
+
+def import_module(name, filename):
+    """
+    Imports the module name from the file filename without adding it to
+    sys.modules, i.e. modules with the same name in different directories
+    do not replace each other.
+    """
+    if SourceFileLoader is None:
+        module = imp.load_source(name, filename)
+        del sys.modules[name]
+        return module
+
+    loader = SourceFileLoader(name, filename)
+    module = types.ModuleType(name)
+    module.__file__ = filename
+    module.__loader__ = loader
+    loader.exec_module(module)
+    return module
+
+
+def load_module(source, name):
+    """ executes the source in a new module that is not written to a file """
+    module = types.ModuleType(name)
+    module.__file__ = None
+    exec(compile(source, '<algopy generated>', 'exec'), module.__dict__)
+    return module
+
+
+class GeneratedProgram(object):
+    """
+    Program that evaluates the sweeps with generated code, see
+    algopy.tracer.codegen. Use CGraph.codegen() to create an instance.
+
+    It provides the interface of algopy.tracer.program.Program that is used
+    by the CGraph, i.e. after pushforward and pullback only the values and
+    adjoints of the independent and dependent slots are available.
+
+    Attributes
+    ----------
+    source: str
+        the generated source code
+    module: module
+        the generated module with the functions forward and reverse
+    constants: list
+        the constants C of the generated code
+    """
+
+    def __init__(self, program, independent_slots, dependent_slots, path=None):
+        self.slot_of = program.slot_of
+        self.independent_slots = independent_slots
+        self.dependent_slots = dependent_slots
+        self.wrt_slots = None
+        self.values = [None] * len(program.instructions)
+        self.adjoints = [None] * len(program.instructions)
+        self._saved = None
+
+        self.source, self.constants = generate(program, independent_slots, dependent_slots)
+
+        if path is None:
+            self.module = load_module(self.source, 'algopy_generated')
+        else:
+            self.module = write_module(self.source, self.constants, path)
+
+    def __str__(self):
+        return self.source
+
+    def get_slots(self, function_list):
+        """ returns the slot indices of the Function nodes in function_list """
+        return [self.slot_of[id(f)] for f in function_list]
+
+    def pushforward(self, x_list, independent_slots, dependent_slots=()):
+        ys, self._saved = self.module.forward(self.constants, *x_list)
+        for s, x in zip(independent_slots, x_list):
+            self.values[s] = x
+        for s, y in zip(dependent_slots, ys):
+            self.values[s] = y
+
+    def pullback(self, xbar_list, dependent_slots, independent_slots=()):
+        if self._saved is None:
+            raise ValueError('the pushforward has to be done before the pullback')
+        xbars, ybars = self.module.reverse(self.constants, self._saved, *xbar_list)
+        for s, xbar in zip(independent_slots, xbars):
+            self.adjoints[s] = xbar
+        for s, ybar in zip(dependent_slots, ybars):
+            self.adjoints[s] = ybar
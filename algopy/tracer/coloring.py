@@ -0,0 +1,257 @@
+"""
+Graph colorings for the compressed evaluation of sparse derivatives.
+
+If two columns of a sparse Jacobian J (M x N) have no nonzero entry in a
+common row (i.e. they are structurally orthogonal), they can be evaluated
+with one forward direction: J dot (e_j + e_k) contains both columns without
+overlap. A partition of the columns into groups of structurally orthogonal
+columns is a distance-2 coloring of the bipartite graph of J, or equivalently
+a coloring of the column intersection graph (Curtis, Powell and Reid, 1974).
+
+The seed matrix S (N x p) with S[j, color[j]] = 1 compresses the Jacobian
+to B = J S with p columns and the entries of J are recovered as
+J[i, j] = B[i, color[j]]. The reverse mode works the same way with the rows
+of J.
+
+The functions in this module use the greedy algorithm with the largest
+first ordering, see
+
+    Gebremedhin, A. H., Manne, F. and Pothen, A., "What color is your
+    Jacobian? Graph coloring for computing derivatives",
+    SIAM Review 47(4), 2005.
+"""
+
+import numpy
+import scipy.sparse
+
+
+def as_pattern(pattern):
+    """
+    converts a sparsity pattern (scipy.sparse matrix or array_like of bool)
+    to a scipy.sparse.csr_matrix with entries 1 at the nonzero positions
+    """
+
+    if scipy.sparse.issparse(pattern):
+        pattern = scipy.sparse.csr_matrix(pattern, dtype=bool)
+    else:
+        pattern = scipy.sparse.csr_matrix(numpy.asarray(pattern) != 0)
+
+    pattern.eliminate_zeros()
+    pattern.sort_indices()
+    return pattern.astype(numpy.int8)
+
+
+def column_coloring(pattern):
+    """
+    Computes a distance-2 coloring of the columns of a sparse matrix,
+    i.e. columns that share a nonzero row get different colors.
+
+    Parameters
+    ----------
+    pattern: scipy.sparse matrix or array_like
+        the sparsity pattern, shape (M, N)
+
+    Returns
+    -------
+    colors: numpy.ndarray of int, shape (N,)
+        colors[j] is the color of column j, the colors are 0, 1, ..., p-1
+    """
+
+    pattern = as_pattern(pattern)
+    csc = pattern.tocsc()
+    csr = pattern
+
+    N = pattern.shape[1]
+    degree = numpy.diff(csc.indptr)
+    order = numpy.argsort(-degree, kind='mergesort')
+
+    colors = -numpy.ones(N, dtype=int)
+    forbidden = -numpy.ones(N + 1, dtype=int)
+
+    for j in order:
+        rows = csc.indices[csc.indptr[j]:csc.indptr[j+1]]
+        for i in rows:
+            neighbours = csr.indices[csr.indptr[i]:csr.indptr[i+1]]
+            c = colors[neighbours]
+            forbidden[c[c >= 0]] = j
+        c = 0
+        while forbidden[c] == j:
+            c += 1
+        colors[j] = c
+
+    return colors
+
+
+def row_coloring(pattern):
+    """
+    Computes a distance-2 coloring of the rows of a sparse matrix,
+    i.e. rows that share a nonzero column get different colors.
+
+    See column_coloring.
+    """
+    return column_coloring(as_pattern(pattern).T)
+
+
+def seed_matrix(colors):
+    """
+    returns the seed matrix S with S[j, colors[j]] = 1,
+    shape (len(colors), number of colors)
+    """
+
+    p = colors.max() + 1 if colors.size > 0 else 0
+    S = numpy.zeros((colors.size, p))
+    S[numpy.arange(colors.size), colors] = 1.
+    return S
+
+
+def recover_columns(pattern, colors, B):
+    """
+    Recovers the sparse matrix J from the compressed matrix B = J S.
+
+    Parameters
+    ----------
+    pattern: scipy.sparse matrix
+        sparsity pattern of J
+    colors: numpy.ndarray
+        column colors of J, see column_coloring
+    B: numpy.ndarray
+        compressed matrix, shape (M, number of colors)
+
+    Returns
+    -------
+    J: scipy.sparse.csr_matrix
+    """
+
+    coo = as_pattern(pattern).tocoo()
+    values = B[coo.row, colors[coo.col]]
+    return scipy.sparse.csr_matrix((values, (coo.row, coo.col)), shape=coo.shape)
+
+
+def recover_rows(pattern, colors, C):
+    """
+    Recovers the sparse matrix J from the compressed matrix C = W^T J,
+    where W is the seed matrix of the row colors.
+
+    Parameters
+    ----------
+    pattern: scipy.sparse matrix
+        sparsity pattern of J
+    colors: numpy.ndarray
+        row colors of J, see row_coloring
+    C: numpy.ndarray
+        compressed matrix, shape (number of colors, N)
+
+    Returns
+    -------
+    J: scipy.sparse.csr_matrix
+    """
+
+    coo = as_pattern(pattern).tocoo()
+    values = C[colors[coo.row], coo.col]
+    return scipy.sparse.csr_matrix((values, (coo.row, coo.col)), shape=coo.shape)
+
+
+def symmetric_pattern(pattern):
+    """
+    returns the symmetric sparsity pattern of a Hessian, i.e. the union of
+    pattern, its transpose and the diagonal
+    """
+
+    pattern = as_pattern(pattern)
+    N = pattern.shape[0]
+    if pattern.shape != (N, N):
+        raise ValueError('the pattern must be square but provided shape %s'%(pattern.shape,))
+    return as_pattern(pattern + pattern.T + scipy.sparse.identity(N, dtype=numpy.int8))
+
+
+def star_coloring(pattern):
+    """
+    Computes a star coloring of the adjacency graph of a symmetric sparse
+    matrix, i.e. a distance-1 coloring in which every path on four vertices
+    uses at least three colors.
+
+    A star coloring allows the direct recovery of a symmetric matrix H from
+    the compressed matrix B = H S, see recover_symmetric. It usually needs
+    far fewer colors than the distance-2 coloring of the columns, since
+    symmetry is exploited.
+
+    The greedy algorithm is Algorithm 4.1 of Gebremedhin, Manne and Pothen
+    (2005).
+
+    Parameters
+    ----------
+    pattern: scipy.sparse matrix or array_like
+        the sparsity pattern, shape (N, N), it is symmetrized
+
+    Returns
+    -------
+    colors: numpy.ndarray of int, shape (N,)
+        colors[j] is the color of vertex j, the colors are 0, 1, ..., p-1
+    """
+
+    pattern = symmetric_pattern(pattern)
+    N = pattern.shape[0]
+    indptr, indices = pattern.indptr, pattern.indices
+
+    def neighbours(v):
+        adj = indices[indptr[v]:indptr[v+1]]
+        return adj[adj != v]
+
+    degree = numpy.diff(indptr)
+    order = numpy.argsort(-degree, kind='mergesort')
+
+    colors = -numpy.ones(N, dtype=int)
+    forbidden = -numpy.ones(N + 1, dtype=int)
+
+    for v in order:
+        for w in neighbours(v):
+            if colors[w] >= 0:
+                forbidden[colors[w]] = v
+            for x in neighbours(w):
+                if x == v or colors[x] < 0:
+                    continue
+                if colors[w] < 0:
+                    forbidden[colors[x]] = v
+                else:
+                    y = neighbours(x)
+                    y = y[y != w]
+                    if numpy.any(colors[y] == colors[w]):
+                        forbidden[colors[x]] = v
+        c = 0
+        while forbidden[c] == v:
+            c += 1
+        colors[v] = c
+
+    return colors
+
+
+def recover_symmetric(pattern, colors, B):
+    """
+    Recovers the symmetric sparse matrix H from the compressed matrix B = H S,
+    where S is the seed matrix of a star coloring.
+
+    The entry H[i, j] is read from B[i, colors[j]] if j is the only column
+    with color colors[j] in row i, otherwise from B[j, colors[i]].
+
+    Parameters
+    ----------
+    pattern: scipy.sparse matrix
+        sparsity pattern of H, it is symmetrized
+    colors: numpy.ndarray
+        star coloring of H, see star_coloring
+    B: numpy.ndarray
+        compressed matrix, shape (N, number of colors)
+
+    Returns
+    -------
+    H: scipy.sparse.csr_matrix
+    """
+
+    coo = symmetric_pattern(pattern).tocoo()
+    row, col = coo.row, coo.col
+    p = colors.max() + 1 if colors.size > 0 else 0
+
+    key = row * p + colors[col]
+    unique = numpy.bincount(key, minlength=coo.shape[0] * p)[key] == 1
+    values = numpy.where(unique, B[row, colors[col]], B[col, colors[row]])
+    return scipy.sparse.csr_matrix((values, (row, col)), shape=coo.shape)
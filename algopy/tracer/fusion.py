@@ -0,0 +1,363 @@
+"""
+Fusion of chains of elementwise operations of a CGraph.
+
+An expression like ``vY*log1p(exp(-alpha)) + (1-vY)*log1p(exp(alpha))``
+is recorded as a chain of elementwise nodes. Evaluated node by node, each
+node allocates a UTPM of shape (D,P) + shape and loops over all Taylor
+degrees, i.e. the run time is dominated by the memory traffic of the
+intermediate values.
+
+CGraph.fuse() replaces maximal trees of elementwise nodes (all nodes of
+the tree except the root are used exactly once, by another node of the
+tree) by a single node whose func is a FusedKernel. The kernel evaluates
+the operations of the tree block by block along the (flattened) element
+axis: the intermediate values of a block have the shape (D,P,block) and
+stay small enough to remain in the cache, and only the result of the root
+is stored at full size.
+
+The pullback of a FusedKernel is fused the same way: for each block the
+intermediate values are recomputed and the pullbacks of the operations are
+evaluated in reverse order on the block, accumulating directly into the
+corresponding block of the adjoints of the inputs.
+
+Example:
+
+    >>> cg = algopy.CGraph()
+    >>> x = algopy.Function(numpy.ones(1000))
+    >>> y = algopy.sum(x * algopy.log1p(algopy.exp(-x)))
+    >>> cg.trace_off()
+    >>> cg.independentFunctionList = [x]
+    >>> cg.dependentFunctionList = [y]
+    >>> cg.fuse()['nodes']
+    3
+    >>> print(cg.compile())
+    0: Id        <- [0]
+    1: fused     <- [0]
+    2: sum       <- [1, c, c, c]
+"""
+
+import numpy
+
+import algopy
+from .tracer import Function, get_pullback_function
+from .passes import get_arg_slots, mutated_alias_classes, value_nbytes
+
+# elementwise operations with one Function argument
+unary_opcodes = set([
+    'exp', 'expm1', 'log', 'log1p', 'sin', 'cos', 'tan', 'sqrt', 'square',
+    'reciprocal', 'negative', 'neg', 'expit', 'logit',
+    ])
+
+# elementwise operations with two Function arguments
+binary_opcodes = set(['add', 'sub', 'mul', 'truediv'])
+
+# elementwise operations with one Function argument and a constant exponent
+power_opcodes = set(['pow'])
+
+
+def get_shape(x):
+    """ returns the shape of a value on the tape """
+    return getattr(x, 'shape', ())
+
+
+class FusedKernel(object):
+    """
+    Elementwise operations of a CGraph that are evaluated as one operation.
+
+    The kernel is called with the values of its inputs, i.e.
+    kernel(x_0, ..., x_{K-1}), and evaluates the steps in order. The value
+    of step j is stored at position K + j of the list of values, the value
+    of the last step is the result.
+
+    Parameters
+    ----------
+    steps: list of (func, args, slots)
+        func: the elementwise function
+        args: argument template, the constant arguments are filled in
+        slots: pairs (position in args, position in the list of values)
+    ninputs: int
+        number of inputs K
+    shape: tuple
+        shape of the result, the inputs have either this shape or shape ()
+    block_size: int
+        number of entries (D*P*block) of the UTPM data of an intermediate
+        value of a block
+    """
+
+    __name__ = 'fused'
+
+    def __init__(self, steps, ninputs, shape, block_size=2**15):
+        self.steps = steps
+        self.ninputs = ninputs
+        self.shape = tuple(shape)
+        self.size = int(numpy.prod(self.shape))
+        self.block_size = block_size
+
+    def __str__(self):
+        return 'fused(%s)'%', '.join([func.__name__ for func, args, slots in self.steps])
+
+    __repr__ = __str__
+
+    def evaluate(self, inputs):
+        """ returns the list of the inputs and the values of all steps """
+        values = list(inputs)
+        for func, args, slots in self.steps:
+            args = list(args)
+            for pos, k in slots:
+                args[pos] = values[k]
+            values.append(func(*args))
+        return values
+
+    def _blocks(self, inputs, D, P):
+        """
+        returns the block length and a function that returns the inputs
+        restricted to a block
+        """
+
+        M = self.size
+        flat = []
+        for x in inputs:
+            if isinstance(x, algopy.UTPM) and x.shape == self.shape:
+                flat.append((1, x.data.reshape((D, P, M))))
+            elif isinstance(x, numpy.ndarray) and x.shape == self.shape:
+                flat.append((2, x.reshape(M)))
+            else:
+                flat.append((0, x))
+
+        def block(sl):
+            retval = []
+            for kind, x in flat:
+                if kind == 1:
+                    retval.append(algopy.UTPM(x[..., sl]))
+                elif kind == 2:
+                    retval.append(x[sl])
+                else:
+                    retval.append(x)
+            return retval
+
+        return max(1, min(M, self.block_size // (D * P))), block
+
+    def __call__(self, *inputs):
+        utpms = [x for x in inputs if isinstance(x, algopy.UTPM)]
+        if not utpms:
+            # e.g. constant inputs or the degree 0 evaluation of CGraph.check_guards
+            return self.evaluate(inputs)[-1]
+
+        D, P = utpms[0].data.shape[:2]
+        M = self.size
+        B, block = self._blocks(inputs, D, P)
+        if B >= M:
+            return self.evaluate(inputs)[-1]
+
+        out = None
+        for start in range(0, M, B):
+            sl = slice(start, start + B)
+            y = self.evaluate(block(sl))[-1]
+            if out is None:
+                # the result owns its memory, flat is a view of it
+                out = numpy.empty((D, P) + self.shape, dtype=y.data.dtype)
+                flat = out.reshape((D, P, M))
+            flat[..., sl] = y.data
+
+        return algopy.UTPM(out)
+
+    def pullback(self, ybar, *args, **kwargs):
+        """
+        pullback of the kernel, called as pullback(ybar, x_0, ..., x_{K-1}, y, out=xbars)
+
+        The contributions are added to the adjoints xbars of the inputs.
+        """
+
+        out = kwargs['out']
+        inputs = args[:-1]
+        if not isinstance(ybar, algopy.UTPM):
+            return out
+
+        D, P = ybar.data.shape[:2]
+        M = self.size
+        K = self.ninputs
+        B, block = self._blocks(inputs, D, P)
+
+        # adjoints of the inputs, restricted to the blocks like the inputs
+        flat_bars = []
+        copies = []
+        for x, xbar in zip(inputs, out):
+            if isinstance(xbar, algopy.UTPM) and xbar.shape == self.shape:
+                flat = xbar.data.reshape((D, P, M))
+                if not numpy.may_share_memory(flat, xbar.data):
+                    copies.append((xbar, flat))
+                flat_bars.append((1, flat))
+            else:
+                flat_bars.append((0, xbar))
+
+        ybar_flat = ybar.data.reshape((D, P, M))
+
+        for start in range(0, M, B):
+            sl = slice(start, start + B)
+            values = self.evaluate(block(sl))
+
+            bars = [algopy.UTPM(xbar[..., sl]) if kind == 1 else xbar
+                    for kind, xbar in flat_bars]
+            bars += [None] * len(self.steps)
+            bars[-1] = algopy.UTPM(ybar_flat[..., sl])
+
+            for j in range(len(self.steps) - 1, -1, -1):
+                z = values[K + j]
+                zbar = bars[K + j]
+                if zbar is None or not isinstance(z, algopy.UTPM):
+                    continue
+
+                func, fargs, slots = self.steps[j]
+                fargs = list(fargs)
+                fbars = [None] * len(fargs)
+                for pos, k in slots:
+                    fargs[pos] = values[k]
+                    if bars[k] is None and k >= K and isinstance(values[k], algopy.UTPM):
+                        bars[k] = values[k].zeros_like()
+                    fbars[pos] = bars[k]
+
+                pb = get_pullback_function(z.__class__, func)
+                pb(zbar, *(fargs + [z]), out=fbars)
+
+        for xbar, flat in copies:
+            xbar.data[...] = flat.reshape(xbar.data.shape)
+
+        return out
+
+
+def fuse_elementwise(functionList, protected_slots, block_size=2**15):
+    """
+    Replaces maximal trees of elementwise nodes by FusedKernel nodes.
+
+    A node is fused into its consumer if both are elementwise operations
+    (see unary_opcodes, binary_opcodes and power_opcodes) with values of
+    the same shape, the consumer is the only node that uses it, it is not
+    protected (e.g. independent or dependent) and it does not share memory
+    with a buffer that is modified by setitem. The arguments of fused nodes
+    must have the shape of the value or shape ().
+
+    The root of each tree keeps its identity (i.e. its consumers and the
+    dependentFunctionList do not change), its func is replaced by the
+    FusedKernel and its args by the inputs of the tree. The other nodes of
+    the tree are removed from the functionList.
+
+    The functionList is modified in place and the Function.ID attributes
+    are renumbered.
+
+    Parameters
+    ----------
+    functionList: list of Function
+    protected_slots: list of int
+        positions of the nodes that must stay on the tape
+    block_size: int
+        see FusedKernel
+
+    Returns
+    -------
+    stats: dict
+        'nodes': number of removed nodes,
+        'nbytes': number of bytes of the values of the removed nodes,
+        'kernels': number of FusedKernel nodes
+    """
+
+    arg_slots = get_arg_slots(functionList)
+    mutated, root = mutated_alias_classes(functionList, arg_slots)
+    N = len(functionList)
+    protected = set(protected_slots)
+
+    def eligible(n):
+        f = functionList[n]
+        if f.func == Function.Id or root[n] in mutated or \
+           any([root[s] in mutated for s in arg_slots[n]]):
+            return False
+
+        x = f.x
+        if not isinstance(x, (algopy.UTPM, numpy.ndarray)) and not numpy.isscalar(x):
+            return False
+
+        opcode = f.func.__name__
+        fargs = [isinstance(a, Function) for a in f.args]
+        if opcode in unary_opcodes:
+            ok = fargs == [True]
+        elif opcode in binary_opcodes:
+            ok = fargs == [True, True]
+        elif opcode in power_opcodes:
+            ok = fargs == [True, False] and numpy.isscalar(f.args[1])
+        else:
+            ok = False
+
+        shp = get_shape(x)
+        return ok and all([get_shape(functionList[s].x) in (shp, ())
+                           for s in arg_slots[n]])
+
+    is_eligible = [eligible(n) for n in range(N)]
+
+    consumers = [set() for n in range(N)]
+    for n in range(N):
+        for s in arg_slots[n]:
+            consumers[s].add(n)
+
+    # parent[n] is the consumer into which node n is fused
+    parent = [None] * N
+    for n in range(N):
+        if not is_eligible[n] or n in protected or len(consumers[n]) != 1:
+            continue
+        c = list(consumers[n])[0]
+        if is_eligible[c] and get_shape(functionList[c].x) == get_shape(functionList[n].x):
+            parent[n] = c
+
+    def find_root(n):
+        while parent[n] is not None:
+            n = parent[n]
+        return n
+
+    members = {}
+    for n in range(N):
+        if parent[n] is not None:
+            members.setdefault(find_root(n), []).append(n)
+
+    removed = set()
+    nbytes = 0
+    for r, group in members.items():
+        group = sorted(group) + [r]
+        member_ids = set([id(functionList[n]) for n in group])
+        position = {}
+        inputs = []
+        steps = []
+
+        for n in group:
+            f = functionList[n]
+            args = []
+            slots = []
+            for pos, a in enumerate(f.args):
+                if not isinstance(a, Function):
+                    args.append(a)
+                    continue
+                args.append(None)
+                if id(a) not in position and id(a) not in member_ids:
+                    position[id(a)] = len(inputs)
+                    inputs.append(a)
+                slots.append((pos, id(a)))
+            steps.append((f.func, args, slots, id(f)))
+
+        # the values of step j are stored after the inputs
+        K = len(inputs)
+        for j, step in enumerate(steps):
+            position[step[3]] = K + j
+        steps = [(func, args, [(pos, position[a]) for pos, a in slots])
+                 for func, args, slots, fid in steps]
+
+        f = functionList[r]
+        f.func = FusedKernel(steps, K, get_shape(f.x), block_size=block_size)
+        f.args = inputs
+        f.pullback_class = None
+
+        for n in group[:-1]:
+            removed.add(n)
+            nbytes += value_nbytes(functionList[n].x)
+
+    functionList[:] = [f for n, f in enumerate(functionList) if n not in removed]
+    for n, f in enumerate(functionList):
+        f.ID = n
+
+    return {'nodes': len(removed), 'nbytes': nbytes, 'kernels': len(members)}
@@ -0,0 +1,426 @@
+"""
+Analysis and optimization passes on recorded computational graphs.
+
+The passes operate on the functionList of a CGraph, i.e. on the list of
+Function nodes in the order in which they have been recorded.
+"""
+
+import numpy
+
+import algopy
+
+# opcodes whose pullback only depends on the type and the shape of the values
+# of the arguments and of the result, but not on the values themselves
+value_free_pullbacks = set([
+    'add', 'sub', 'neg', 'negative', '__add__', '__sub__', '__neg__',
+    'getitem', '__getitem__', 'setitem', '__setitem__',
+    'reshape', 'transpose', 'trace', 'sum', 'zeros',
+    ])
+
+# opcodes that always return a new value that does not share memory
+# with any of the arguments
+fresh_opcodes = set([
+    'add', 'sub', 'mul', 'truediv', 'div', 'neg', 'negative', 'pow',
+    '__add__', '__sub__', '__mul__', '__truediv__', '__div__', '__neg__', '__pow__',
+    'exp', 'expm1', 'log', 'log1p', 'sqrt', 'square', 'absolute', 'reciprocal',
+    'sin', 'cos', 'tan', 'sign', 'erf', 'erfi', 'dawsn', 'logit', 'expit',
+    'gammaln', 'psi', 'dot', 'outer', 'inv', 'solve', 'prod', 'det', 'logdet',
+    'zeros', 'ones', 'fused',
+    ])
+
+setitem_opcodes = set(['setitem', '__setitem__'])
+
+
+def get_arg_slots(functionList):
+    """
+    returns for each node of the functionList the list of positions
+    (in functionList) of its Function arguments
+    """
+    from .tracer import Function
+
+    slot_of = {}
+    for n, f in enumerate(functionList):
+        slot_of[id(f)] = n
+
+    arg_slots = []
+    for n, f in enumerate(functionList):
+        arg_slots.append([slot_of[id(a)] for a in f.args
+                          if isinstance(a, Function) and a is not f])
+    return arg_slots
+
+
+def alias_classes(functionList, arg_slots=None):
+    """
+    Partitions the nodes into classes of nodes that may share memory.
+
+    Two nodes are in the same class if one is the argument of the other and
+    the operation is not known to return new memory (e.g. getitem or reshape).
+    setitem modifies its buffer in place, hence all nodes in the class
+    of the buffer may be affected by it. The value assigned by setitem is
+    copied and therefore not added to the class of the buffer.
+
+    Returns
+    -------
+    root: list of int
+        root[n] is the representative of the class of node n
+    """
+
+    if arg_slots is None:
+        arg_slots = get_arg_slots(functionList)
+
+    root = list(range(len(functionList)))
+
+    def find(n):
+        while root[n] != n:
+            root[n] = root[root[n]]
+            n = root[n]
+        return n
+
+    for n, f in enumerate(functionList):
+        if f.func.__name__ in fresh_opcodes:
+            continue
+        slots = arg_slots[n]
+        if f.func.__name__ in setitem_opcodes:
+            # the assigned value is copied into the buffer
+            slots = slots[:1]
+        for s in slots:
+            rs, rn = find(s), find(n)
+            if rs != rn:
+                root[max(rs, rn)] = min(rs, rn)
+
+    return [find(n) for n in range(len(functionList))]
+
+
+def activity_analysis(functionList, independent_slots, dependent_slots):
+    """
+    Marks the nodes of the functionList as varied and useful.
+
+    A node is varied if it depends on one of the independent nodes given by
+    independent_slots, and it is useful if one of the dependent nodes given
+    by dependent_slots depends on it. Only nodes that are varied and useful
+    (i.e. active) contribute to the derivatives.
+
+    Modifications of buffers by setitem are taken into account: if the
+    assigned value is varied, the whole alias class of the buffer becomes
+    varied, and a setitem is useful if any node of the alias class of its
+    buffer is useful.
+
+    Parameters
+    ----------
+    functionList: list of Function
+    independent_slots: list of int
+        positions of the independent nodes in functionList
+    dependent_slots: list of int
+        positions of the dependent nodes in functionList
+
+    Returns
+    -------
+    varied: list of bool
+    useful: list of bool
+    """
+
+    N = len(functionList)
+    arg_slots = get_arg_slots(functionList)
+    setitems = [n for n, f in enumerate(functionList)
+                if f.func.__name__ in setitem_opcodes and arg_slots[n]]
+
+    if setitems:
+        root = alias_classes(functionList, arg_slots)
+        members = {}
+        for n in range(N):
+            members.setdefault(root[n], []).append(n)
+
+    # forward propagation
+    varied = [False] * N
+    for s in independent_slots:
+        varied[s] = True
+
+    changed = True
+    while changed:
+        changed = False
+        for n in range(N):
+            if not varied[n]:
+                for s in arg_slots[n]:
+                    if varied[s]:
+                        varied[n] = True
+                        break
+
+        for n in setitems:
+            if varied[n]:
+                for m in members[root[arg_slots[n][0]]]:
+                    if not varied[m]:
+                        varied[m] = True
+                        changed = True
+
+    # backward propagation
+    useful = [False] * N
+    for s in dependent_slots:
+        useful[s] = True
+
+    changed = True
+    while changed:
+        changed = False
+        for n in range(N-1, -1, -1):
+            if useful[n]:
+                for s in arg_slots[n]:
+                    useful[s] = True
+
+        for n in setitems:
+            if not useful[n]:
+                for m in members[root[arg_slots[n][0]]]:
+                    if useful[m]:
+                        useful[n] = True
+                        changed = True
+                        break
+
+    return varied, useful
+
+
+def mutated_alias_classes(functionList, arg_slots=None):
+    """
+    returns the representatives (see alias_classes) of all classes
+    that contain a buffer that is modified by setitem, and the alias classes
+    """
+
+    if arg_slots is None:
+        arg_slots = get_arg_slots(functionList)
+
+    root = alias_classes(functionList, arg_slots)
+    mutated = set([root[arg_slots[n][0]] for n, f in enumerate(functionList)
+                   if f.func.__name__ in setitem_opcodes and arg_slots[n]])
+    return mutated, root
+
+
+def constant_key(c):
+    """
+    returns a hashable key such that constant_key(a) == constant_key(b)
+    implies that the constants a and b are equal
+    """
+
+    if c is None or c is Ellipsis or isinstance(c, (bool, int, float, complex, str)):
+        return (type(c), c)
+
+    elif isinstance(c, numpy.ndarray):
+        if c.dtype.hasobject:
+            return ('id', id(c))
+        return ('array', c.shape, c.dtype.str, c.tobytes())
+
+    elif isinstance(c, numpy.generic):
+        return ('scalar', c.dtype.str, c.tobytes())
+
+    elif isinstance(c, algopy.UTPM):
+        return ('utpm', type(c), constant_key(c.data))
+
+    elif isinstance(c, (tuple, list)):
+        return (type(c), tuple([constant_key(ci) for ci in c]))
+
+    elif isinstance(c, slice):
+        return ('slice', constant_key(c.start), constant_key(c.stop), constant_key(c.step))
+
+    try:
+        hash(c)
+        return ('object', c)
+    except TypeError:
+        return ('id', id(c))
+
+
+def value_nbytes(x):
+    """ returns the number of bytes that are owned by the value x of a node """
+
+    if isinstance(x, algopy.UTPM):
+        return x.data.nbytes if x.owndata else 0
+
+    elif isinstance(x, numpy.ndarray):
+        return x.nbytes if x.base is None else 0
+
+    elif isinstance(x, tuple):
+        return sum([value_nbytes(xi) for xi in x])
+
+    return 0
+
+
+def common_subexpression_elimination(functionList):
+    """
+    Merges nodes that compute the same func of the same arguments.
+
+    Two nodes are merged if they have the same func, the same Function
+    arguments (after merging) and equal constant arguments.
+    Identity nodes, setitem nodes and nodes that read from a buffer that is
+    modified by setitem are never merged, since their values depend on the
+    position in the tape.
+
+    The consumers of a removed node are rewired to the node that is kept.
+    The functionList is modified in place and the Function.ID attributes
+    are renumbered.
+
+    Parameters
+    ----------
+    functionList: list of Function
+
+    Returns
+    -------
+    replacement: dict
+        maps id(f) of each removed node f to the node that replaces it
+    stats: dict
+        'nodes': number of removed nodes,
+        'nbytes': number of bytes of the values of the removed nodes
+    """
+    from .tracer import Function
+
+    arg_slots = get_arg_slots(functionList)
+    mutated, root = mutated_alias_classes(functionList, arg_slots)
+
+    replacement = {}
+    seen = {}
+    nbytes = 0
+    kept = []
+
+    for n, f in enumerate(functionList):
+
+        # rewire the arguments to the nodes that are kept
+        if any([id(a) in replacement for a in f.args if isinstance(a, Function)]):
+            f.args = [replacement.get(id(a), a) if isinstance(a, Function) else a
+                      for a in f.args]
+
+        if f.func == Function.Id or f.func.__name__ in setitem_opcodes or \
+           root[n] in mutated or any([root[s] in mutated for s in arg_slots[n]]):
+            kept.append(f)
+            continue
+
+        key = (f.func, tuple([('node', id(a)) if isinstance(a, Function)
+                              else constant_key(a) for a in f.args]))
+        g = seen.get(key)
+
+        if g is None:
+            seen[key] = f
+            kept.append(f)
+        else:
+            replacement[id(f)] = g
+            nbytes += value_nbytes(f.x)
+
+    functionList[:] = kept
+    for n, f in enumerate(functionList):
+        f.ID = n
+
+    return replacement, {'nodes': len(replacement), 'nbytes': nbytes}
+
+
+def fold_constants(functionList, independent_slots, dependent_slots):
+    """
+    Evaluates the nodes that do not depend on the independent nodes once
+    and replaces them by their values.
+
+    The folded values (e.g. numpy.ndarray instances) become constant
+    arguments of their consumers and the folded nodes are removed from the
+    functionList, i.e. from both sweeps. This includes identity nodes of
+    constants that are not independent.
+
+    Dependent nodes, setitem nodes, nodes whose buffers are modified by
+    setitem and their consumers are not folded.
+
+    The functionList is modified in place and the Function.ID attributes
+    are renumbered.
+
+    Parameters
+    ----------
+    functionList: list of Function
+    independent_slots: list of int
+        positions of the independent nodes in functionList
+    dependent_slots: list of int
+        positions of the dependent nodes in functionList
+
+    Returns
+    -------
+    folded: dict
+        maps id(f) of each removed node f to its value
+    stats: dict
+        'nodes': number of removed nodes,
+        'nbytes': number of bytes of the folded values that are
+        referenced by the remaining nodes
+    """
+    from .tracer import Function
+
+    arg_slots = get_arg_slots(functionList)
+    mutated, root = mutated_alias_classes(functionList, arg_slots)
+    varied, useful = activity_analysis(functionList, independent_slots, dependent_slots)
+    keep = set(independent_slots) | set(dependent_slots)
+
+    folded = {}
+    kept = []
+    referenced = {}
+
+    for n, f in enumerate(functionList):
+
+        args = [folded[id(a)] if isinstance(a, Function) and id(a) in folded
+                else a for a in f.args]
+
+        if varied[n] or n in keep or root[n] in mutated or \
+           f.func.__name__ in setitem_opcodes or \
+           (f.func != Function.Id and any([isinstance(a, Function) for a in args])):
+            for a, b in zip(f.args, args):
+                if a is not b:
+                    referenced[id(b)] = b
+            f.args = args
+            kept.append(f)
+
+        elif f.func == Function.Id:
+            folded[id(f)] = f.x
+
+        else:
+            folded[id(f)] = f.func(*args)
+
+    functionList[:] = kept
+    for n, f in enumerate(functionList):
+        f.ID = n
+
+    nbytes = sum([value_nbytes(c) for c in referenced.values()])
+    return folded, {'nodes': len(folded), 'nbytes': nbytes}
+
+
+def tape_size(functionList):
+    """
+    returns the number of nodes and the sum of the sizes (number of
+    entries per Taylor coefficient) of the values of the functionList
+    """
+
+    def size(x):
+        if isinstance(x, tuple):
+            return sum([size(xi) for xi in x])
+        elif isinstance(x, algopy.UTPM):
+            return x.data[0, 0].size
+        elif isinstance(x, numpy.ndarray):
+            return x.size
+        elif x is None:
+            return 0
+        return 1
+
+    return len(functionList), sum([size(f.x) for f in functionList])
+
+
+# cost model of the Jacobian drivers in units of about 10 ns. The constants
+# have been fitted to run times of CGraph.jacobian for a few test functions
+# by experimental/performance_tests/jacobian_cost_model.py (numpy 1.24),
+# rerun it to refit them or use jacobian(x, mode='auto', calibrate=True)
+# to measure the run times of a particular CGraph instead
+NODE_OVERHEAD_FORWARD = 1831.   # per node and forward sweep
+NODE_OVERHEAD_REVERSE = 5047.   # per node for the pushforward and the pullback
+FORWARD_FACTOR = 0.032          # per entry of a value and direction
+REVERSE_FACTOR = 0.03           # per entry of a value and adjoint direction
+REVERSE_ENTRY_OVERHEAD = 0.     # per entry of a value in the pullback
+
+
+def jacobian_cost_model(nodes, size, N, M):
+    """
+    estimates the costs of the Jacobian of F:R^N --> R^M in the forward
+    and in the reverse mode for a tape with the given number of nodes and
+    the given sum of the sizes of the values
+
+    Returns
+    -------
+    cost_forward: float
+    cost_reverse: float
+    """
+    cost_forward = nodes * NODE_OVERHEAD_FORWARD + FORWARD_FACTOR * N * size
+    cost_reverse = nodes * NODE_OVERHEAD_REVERSE + \
+                   (REVERSE_FACTOR * M + REVERSE_ENTRY_OVERHEAD) * size
+    return cost_forward, cost_reverse
@@ -0,0 +1,553 @@
+"""
+Linear instruction programs compiled from a CGraph.
+
+CGraph.pushforward and CGraph.pullback walk the list of Function nodes and
+for each node rebuild the argument lists, check the argument types and look up
+the pullback function. When the same tape is evaluated many times (e.g. by
+repeated calls of CGraph.gradient or CGraph.hessian) it pays off to do this
+work only once.
+
+CGraph.compile() lowers the tape to a Program, i.e. a flat list of
+Instruction objects. Each Function node of the tape is assigned an integer
+slot and each instruction stores
+
+    * the opcode, i.e. the name of the elementary function
+    * the forward callable func
+    * a template of the arguments where the constant arguments are filled in
+    * the slot indices of the Function arguments
+    * the slot index of the result
+
+The forward and reverse sweeps are then simple loops over the instructions
+that read and write the slot lists Program.values and Program.adjoints.
+
+Example:
+
+    >>> cg = algopy.CGraph()
+    >>> x = algopy.Function(numpy.ones(3))
+    >>> y = algopy.sum(algopy.sin(x) * x)
+    >>> cg.trace_off()
+    >>> cg.independentFunctionList = [x]
+    >>> cg.dependentFunctionList = [y]
+    >>> program = cg.compile()
+    >>> print(program)
+    0: Id        <- [0]
+    1: sin       <- [0]
+    2: mul       <- [1, 0]
+    3: sum       <- [2, c, c, c]
+"""
+
+import traceback
+import numpy
+
+import algopy
+from .tracer import Function, NotSet, get_pullback_function
+from .passes import value_free_pullbacks, fresh_opcodes, activity_analysis
+
+_unallocated = NotSet('adjoint has not been allocated')
+
+
+class Instruction(object):
+    """
+    A single operation x[result] = func(*args) of a compiled CGraph.
+
+    Attributes
+    ----------
+    opcode: str
+        name of the elementary function, e.g. 'mul' or 'getitem'
+    func: callable
+        the function that is evaluated in the forward sweep
+    result: int
+        slot index of the result
+    args: list
+        argument template, constant arguments are stored as they are,
+        the entries of Function arguments are None
+    slots: tuple of (int, int)
+        pairs (position in args, slot index) of the Function arguments
+    setitem: tuple or None
+        (sl, store) if the instruction is a setitem, see Function.__setitem__
+    release: list of (int, bool)
+        pairs (slot index, recyclable) of the values that are not needed
+        anymore after this instruction has been evaluated, see
+        Program.analyze_liveness
+    lift: bool
+        if True, constant arguments (e.g. numpy.ndarray) are converted to
+        UTPM instances before func is evaluated, see Program.__init__
+    """
+
+    __slots__ = ('opcode', 'func', 'result', 'args', 'slots', 'setitem',
+                 'release', 'lift', 'pullback_class', 'pullback_function')
+
+    def __init__(self, func, result, args, slots, setitem=None):
+        self.opcode = func.__name__
+        self.func = func
+        self.result = result
+        self.args = args
+        self.slots = tuple(slots)
+        self.setitem = setitem
+        self.release = []
+        self.lift = False
+
+        # pre-resolve the pullback for UTPM, which is by far the most common
+        # case in the reverse sweep
+        self.pullback_class = None
+        self.pullback_function = None
+        try:
+            self.get_pullback_function(algopy.UTPM)
+        except AttributeError:
+            pass
+
+    def get_pullback_function(self, xcls):
+        if self.pullback_class is not xcls:
+            self.pullback_function = get_pullback_function(xcls, self.func)
+            self.pullback_class = xcls
+        return self.pullback_function
+
+    def __str__(self):
+        arg_slots = ['c'] * len(self.args)
+        for pos, s in self.slots:
+            arg_slots[pos] = s
+        return '%d: %-9s <- [%s]'%(self.result, self.opcode,
+                                   ', '.join(str(a) for a in arg_slots))
+
+
+class Program(object):
+    """
+    Compiled representation of a CGraph.
+
+    Use CGraph.compile() to create an instance.
+    The Function nodes of the CGraph are mapped to the slots 0,...,len(functionList)-1
+    in the order of the functionList.
+
+    If the independent and dependent slots are provided, an activity
+    analysis is performed (see algopy.tracer.passes.activity_analysis):
+
+        * nodes that are not useful, i.e. that the dependents do not depend on,
+          are removed from both sweeps
+        * nodes that are not varied, i.e. that do not depend on the
+          independents selected by wrt_slots, are evaluated on the
+          degree 0 coefficients only (i.e. as numpy.ndarray) and are
+          removed from the reverse sweep
+
+    The adjoints are allocated lazily, i.e. when they receive the first
+    contribution in the reverse sweep, and nodes whose adjoint has not
+    received any contribution are skipped.
+
+    If release_buffers is True, the program additionally
+
+        * releases forward values that are not needed anymore, i.e. after
+          their last use in the forward sweep if no pullback needs them
+        * releases adjoints as soon as the pullback of their node is done
+        * recycles released buffers of the same shape and dtype for the
+          adjoints that are allocated later in the reverse sweep
+
+    A released value is replaced by a zero-strided placeholder of the same
+    class, shape and dtype that does not hold any memory.
+
+    Only the allocation of adjoints reuses released buffers. The forward
+    values are created by the elementary functions themselves, which do not
+    accept preallocated output buffers. Released forward values that are not
+    recyclable are dropped immediately, recyclable ones are kept in the pool
+    until the end of the reverse sweep.
+
+    Attributes
+    ----------
+    instructions: list of Instruction
+        all instructions, including the identity nodes
+    forward: list of Instruction
+        instructions that have to be evaluated in the forward sweep
+    reverse: list of Instruction
+        instructions that have to be evaluated in the reverse sweep,
+        stored in reverse order
+    values: list
+        the current values of the slots, i.e. the Function.x attributes
+    adjoints: list
+        the current adjoints of the slots, i.e. the Function.xbar attributes
+    varied: list of bool
+        varied[n] is True if slot n depends on the selected independents
+    useful: list of bool
+        useful[n] is True if the dependents depend on slot n
+    """
+
+    def __init__(self, functionList, independent_slots=None, dependent_slots=None,
+                 wrt_slots=None, release_buffers=True):
+
+        self.slot_of = {}
+        for n, f in enumerate(functionList):
+            self.slot_of[id(f)] = n
+
+        self.instructions = []
+        self.values = [None] * len(functionList)
+        self.adjoints = [_unallocated] * len(functionList)
+
+        for n, f in enumerate(functionList):
+            args = []
+            slots = []
+            for k, a in enumerate(f.args):
+                if isinstance(a, Function):
+                    if id(a) not in self.slot_of:
+                        err_str = 'argument %d of node %d (%s) is not in the '\
+                                  'functionList of this CGraph'%(k, n, f.func.__name__)
+                        raise ValueError(err_str)
+                    args.append(None)
+                    slots.append((k, self.slot_of[id(a)]))
+                else:
+                    args.append(a)
+
+            setitem = f.setitem if 'setitem' in f.__dict__ else None
+            self.instructions.append(Instruction(f.func, n, args, slots, setitem))
+
+            # identity nodes are not evaluated in the sweeps, their value is
+            # either set to the input or remains the traced constant
+            self.values[n] = f.x
+
+        self.independent_slots = independent_slots
+        self.dependent_slots = dependent_slots
+        self.wrt_slots = wrt_slots
+
+        if dependent_slots is None:
+            self.varied = [True] * len(functionList)
+            self.useful = [True] * len(functionList)
+        else:
+            if wrt_slots is None:
+                wrt_slots = independent_slots
+            self.varied, self.useful = activity_analysis(functionList,
+                                                         wrt_slots, dependent_slots)
+
+        varied = self.varied
+        self.forward = [ins for ins in self.instructions
+                        if ins.func != Function.Id and self.useful[ins.result]]
+        self.reverse = [ins for ins in self.forward
+                        if varied[ins.result] or ins.setitem is not None][::-1]
+
+        # nodes that are varied only because a buffer they alias is modified
+        # by setitem need UTPM arguments, e.g. out = zeros(N, dtype=c)
+        for ins in self.forward:
+            ins.lift = varied[ins.result] and \
+                       not any([varied[s] for pos, s in ins.slots])
+
+        # the independents that are not selected are evaluated at degree 0
+        self._degree_zero_slots = set()
+        if wrt_slots is not None and independent_slots is not None:
+            self._degree_zero_slots = set(independent_slots) - set(wrt_slots)
+        self._DP = None
+
+        self.release_buffers = release_buffers
+        if release_buffers:
+            self.analyze_liveness()
+
+        # buffers that can be recycled, stored by (class, shape, dtype)
+        self._pool = {}
+        # OWNDATA flag of the released values
+        self._owndata = {}
+        # slots whose adjoint has been allocated as a new zero buffer
+        self._zero_adjoints = set()
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def __str__(self):
+        return '\n'.join(str(ins) for ins in self.instructions)
+
+    def get_slots(self, function_list):
+        """ returns the slot indices of the Function nodes in function_list """
+        return [self.slot_of[id(f)] for f in function_list]
+
+    def analyze_liveness(self):
+        """
+        Computes for each forward instruction which values can be released
+        after it has been evaluated.
+
+        A value is needed in the reverse sweep if it is an argument or the result
+        of an instruction whose pullback depends on the values (e.g. mul, exp or dot,
+        but not add or getitem) or if it is a buffer modified by setitem.
+        All other values are released after their last use in the forward sweep.
+        The values of identity nodes (independent variables and constants) are
+        never released.
+
+        A released value is recyclable if it has been created by and is only
+        used by operations that return new memory, i.e. when no other value
+        can be a view of it. Recyclable buffers are reused for adjoints only,
+        see Program.
+        """
+
+        N = len(self.instructions)
+        position = [-1] * N
+        last_use = [-1] * N
+        recyclable = [True] * N
+        reverse_needed = [False] * N
+
+        for i, ins in enumerate(self.forward):
+            position[ins.result] = i
+            recyclable[ins.result] = ins.opcode in fresh_opcodes
+            ins.release = []
+
+            for pos, s in ins.slots:
+                last_use[s] = i
+                if ins.opcode not in fresh_opcodes:
+                    recyclable[s] = False
+
+        for ins in self.reverse:
+            if ins.opcode not in value_free_pullbacks:
+                reverse_needed[ins.result] = True
+                for pos, s in ins.slots:
+                    reverse_needed[s] = True
+
+            if ins.setitem is not None:
+                reverse_needed[ins.slots[0][1]] = True
+
+        for s in range(N):
+            if position[s] < 0 or reverse_needed[s]:
+                continue
+            i = max(position[s], last_use[s])
+            self.forward[i].release.append((s, recyclable[s]))
+
+    def _lift(self, x):
+        """ converts a constant x to a UTPM instance with the current D and P """
+        if isinstance(x, algopy.UTPM) or self._DP is None:
+            return x
+        if not (numpy.isscalar(x) or isinstance(x, numpy.ndarray)):
+            return x
+        x = numpy.asarray(x)
+        data = numpy.zeros(self._DP + x.shape, dtype=x.dtype)
+        data[0, ...] = x
+        return algopy.UTPM(data)
+
+    def _recycle(self, x):
+        """ puts the UTPM instance x into the pool of recyclable buffers """
+        key = (x.__class__, x.data.shape, x.data.dtype)
+        self._pool.setdefault(key, []).append(x)
+
+    def _zeros_like(self, x):
+        """ returns a zero UTPM instance like x, recycles a buffer if possible """
+        buffers = self._pool.get((x.__class__, x.data.shape, x.data.dtype))
+        if buffers:
+            y = buffers.pop()
+            y.data[...] = 0
+            return y
+        return x.zeros_like()
+
+    def get_adjoint(self, s):
+        """
+        returns the adjoint of the slot s and allocates it if necessary
+
+        Equivalent to Function.xbar_from_x.
+        In particular, the adjoint of a view (e.g. y = x[1:]) is the
+        corresponding view of the adjoint of the base.
+        """
+
+        xbar = self.adjoints[s]
+        if xbar is not _unallocated:
+            return xbar
+
+        x = self.values[s]
+        ins = self.instructions[s]
+
+        if isinstance(x, algopy.UTPM):
+            owndata = self._owndata.get(s)
+            if owndata is None:
+                owndata = x.owndata
+
+            if owndata == True or ins.func == Function.Id:
+                xbar = self._zeros_like(x)
+                self._zero_adjoints.add(s)
+
+            else:
+                args = list(ins.args)
+                for pos, t in ins.slots:
+                    args[pos] = self.get_adjoint(t)
+                xbar = ins.func(*args)
+
+        elif numpy.isscalar(x):
+            xbar = 0.
+
+        elif isinstance(x, tuple):
+            xbar = tuple([xi.zeros_like() if isinstance(xi, algopy.UTPM)
+                          else None for xi in x])
+
+        else:
+            xbar = None
+
+        self.adjoints[s] = xbar
+        return xbar
+
+    def pushforward(self, x_list, independent_slots, dependent_slots=()):
+        """
+        Evaluates the program for the inputs x_list.
+
+        Parameters
+        ----------
+        x_list: list
+            values of the independent Functions, e.g. UTPM instances
+        independent_slots: list of int
+            slot indices of the independent Functions
+        dependent_slots: list of int
+            slot indices of the dependent Functions, their values are not released
+        """
+
+        values = self.values
+        protected = set(independent_slots) | set(dependent_slots)
+        self._pool = {}
+        self._owndata = {}
+        self._set_independents(x_list, independent_slots)
+
+        ins = None
+        try:
+            for ins in self.forward:
+                self._evaluate(ins)
+
+                for s, recyclable in ins.release:
+                    x = values[s]
+                    if s in protected or not isinstance(x, algopy.UTPM):
+                        continue
+                    owndata = x.owndata
+                    self._owndata[s] = owndata
+                    values[s] = x.__class__(numpy.broadcast_to(
+                        numpy.zeros((), dtype=x.data.dtype), x.data.shape))
+                    if recyclable and owndata:
+                        self._recycle(x)
+
+        except Exception as e:
+            err_str = 'pushforward of node %d failed (%s)\n'%(ins.result, ins.opcode)
+            err_str += 'reported error is:\n%s\n'%e
+            err_str += 'traceback:\n%s'%traceback.format_exc()
+            raise Exception(err_str)
+
+        self._lift_dependents(dependent_slots)
+
+    def _set_independents(self, x_list, independent_slots):
+        values = self.values
+        self._DP = None
+        for nx, s in enumerate(independent_slots):
+            x = x_list[nx]
+            if s in self._degree_zero_slots:
+                if isinstance(x, algopy.UTPM):
+                    x = x.data[0, 0]
+            elif self._DP is None and isinstance(x, algopy.UTPM):
+                self._DP = x.data.shape[:2]
+            values[s] = x
+
+    def _evaluate(self, ins):
+        """ evaluates a single instruction of the forward sweep """
+        values = self.values
+        args = list(ins.args)
+        if ins.lift:
+            for pos, s in ins.slots:
+                args[pos] = self._lift(values[s])
+        else:
+            for pos, s in ins.slots:
+                args[pos] = values[s]
+        values[ins.result] = ins.func(*args)
+
+    def _lift_dependents(self, dependent_slots):
+        # dependents that do not depend on the selected independents
+        values = self.values
+        for s in dependent_slots:
+            if not isinstance(values[s], (algopy.UTPM, tuple)) and values[s] is not None:
+                values[s] = self._lift(values[s])
+
+    def pullback(self, xbar_list, dependent_slots, independent_slots=()):
+        """
+        Evaluates the adjoint program, i.e. the reverse sweep.
+
+        The forward sweep has to be done before.
+
+        Parameters
+        ----------
+        xbar_list: list
+            adjoints of the dependent Functions, e.g. UTPM instances
+        dependent_slots: list of int
+            slot indices of the dependent Functions
+        independent_slots: list of int
+            slot indices of the independent Functions, their adjoints are
+            the result of the reverse sweep and are not released
+        """
+
+        protected = set(independent_slots) | set(dependent_slots)
+        self._seed_adjoints(xbar_list, dependent_slots)
+
+        ins = None
+        try:
+            for ins in self.reverse:
+                self._pull_back(ins, protected, self.release_buffers)
+
+        except Exception as e:
+            err_str = '\npullback of node %d failed (%s)\n\n'%(ins.result, ins.opcode)
+            err_str += '\n%s'%traceback.format_exc()
+            raise Exception(err_str)
+
+        for s in independent_slots:
+            self.get_adjoint(s)
+
+        self._pool = {}
+
+    def _seed_adjoints(self, xbar_list, dependent_slots):
+        """ resets all adjoints and sets the adjoints of the dependents """
+        adjoints = self.adjoints
+        for n in range(len(adjoints)):
+            adjoints[n] = _unallocated
+        self._zero_adjoints = set()
+
+        for nf, s in enumerate(dependent_slots):
+            self.get_adjoint(s)[...] = xbar_list[nf]
+
+    def _pull_back(self, ins, protected, release):
+        """
+        evaluates the pullback of a single instruction, the adjoint of the
+        result is released afterwards if release is True and the slot is
+        not protected
+        """
+
+        values = self.values
+        adjoints = self.adjoints
+        r = ins.result
+        y = values[r]
+
+        if numpy.isscalar(y) or isinstance(y, numpy.ndarray):
+            return
+
+        if y is None:
+            # e.g. setitem, the relevant adjoint is the one of the buffer
+            ybar = adjoints[ins.slots[0][1]]
+        else:
+            ybar = adjoints[r]
+
+        if ybar is _unallocated or ybar is None:
+            # the adjoint is zero, hence there is nothing to pull back
+            if ins.setitem is not None:
+                values[ins.slots[0][1]][ins.setitem[0]] = ins.setitem[1]
+            return
+
+        args = list(ins.args)
+        argsbar = [None] * len(args)
+        for pos, s in ins.slots:
+            args[pos] = values[s]
+            argsbar[pos] = self.get_adjoint(s)
+
+        if isinstance(y, algopy.UTPM):
+            f = ins.get_pullback_function(y.__class__)
+            args = [ybar] + args + [y]
+
+        elif isinstance(y, tuple):
+            f = ins.get_pullback_function(y[0].__class__)
+            args = list(ybar) + args + list(y)
+
+        elif y is None:
+            f = ins.get_pullback_function(args[0].__class__)
+
+        elif ins.opcode in ('__getitem__', 'getitem'):
+            return
+
+        else:
+            raise NotImplementedError('do not know how to pull back %s'%type(y))
+
+        f(*args, out=argsbar)
+
+        # restore the buffer that has been changed by setitem
+        if ins.setitem is not None:
+            values[ins.slots[0][1]][ins.setitem[0]] = ins.setitem[1]
+
+        # the adjoint of this node is not needed anymore
+        if release and y is not None and r not in protected:
+            adjoints[r] = None
+            if r in self._zero_adjoints:
+                self._recycle(ybar)
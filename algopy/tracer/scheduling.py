@@ -0,0 +1,232 @@
+"""
+Level-scheduled parallel execution of compiled CGraph programs.
+
+The forward instructions of a Program are grouped into levels (wavefronts):
+the level of an instruction is one more than the highest level of the
+instructions that compute its arguments. Instructions of the same level do
+not depend on each other and are evaluated concurrently on a thread pool.
+The heavy UTPM kernels (dot, solve, eigh, ...) spend most of their time in
+BLAS and LAPACK routines that release the GIL, hence wide tapes (e.g. sums of
+independent likelihood terms or blockwise solves) are evaluated faster.
+
+The reverse sweep processes the levels in reverse order. The pullbacks of
+a level accumulate into the adjoints of their arguments, hence two
+pullbacks that write into the same adjoint (or into views of the same
+buffer) must not run at the same time. Each level is therefore split into
+batches of instructions that touch pairwise disjoint alias classes (see
+algopy.tracer.passes.alias_classes), the adjoints are allocated before a batch
+is dispatched, and the batches of a level run one after another.
+
+Buffers modified by setitem impose an order on all instructions that touch
+them, these instructions are chained in the order of the tape.
+
+Example:
+
+    >>> program = cg.compile(threads=8)
+    >>> g = cg.gradient(x)
+    >>> program.levels      # the instructions of each level
+
+The thread pool is created on first use and terminated by program.close(),
+which CGraph calls when the program is replaced (e.g. by a recompilation or
+by a pass that rewrites the graph). A program that is used on its own can be
+closed by a with statement:
+
+    >>> with ParallelProgram(cg.functionList, threads=8) as program:
+    ...     program.pushforward(x_list, program.get_slots(cg.independentFunctionList))
+"""
+
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from .program import Program
+from .passes import mutated_alias_classes
+
+
+def compute_levels(instructions, root, mutated):
+    """
+    Groups instructions into levels of mutually independent instructions.
+
+    Parameters
+    ----------
+    instructions: list of Instruction
+        the instructions in the order of the tape
+    root: list of int
+        alias class representatives of the slots, see alias_classes
+    mutated: set of int
+        representatives of the alias classes that are modified by setitem,
+        all instructions that touch such a class are evaluated in tape order
+
+    Returns
+    -------
+    levels: list of list of Instruction
+    """
+
+    level_of = {}
+    last_in_class = {}
+    levels = []
+
+    for ins in instructions:
+        slots = [s for pos, s in ins.slots]
+        level = 0
+        for s in slots:
+            level = max(level, level_of.get(s, -1) + 1)
+
+        classes = set([root[s] for s in slots + [ins.result] if root[s] in mutated])
+        for c in classes:
+            level = max(level, last_in_class.get(c, -1) + 1)
+        for c in classes:
+            last_in_class[c] = level
+
+        level_of[ins.result] = level
+        while len(levels) <= level:
+            levels.append([])
+        levels[level].append(ins)
+
+    return levels
+
+
+def split_batches(instructions, root):
+    """
+    Splits the instructions of one level into batches such that the
+    instructions of a batch touch pairwise disjoint alias classes.
+    setitem instructions form batches of their own.
+
+    Returns
+    -------
+    batches: list of list of Instruction
+    """
+
+    batches = []
+    touched = []
+    for ins in instructions:
+        classes = set([root[s] for pos, s in ins.slots] + [root[ins.result]])
+        if ins.setitem is not None:
+            batches.append([ins])
+            touched.append(None)
+            continue
+
+        for batch, used in zip(batches, touched):
+            if used is not None and not (used & classes):
+                batch.append(ins)
+                used |= classes
+                break
+        else:
+            batches.append([ins])
+            touched.append(classes)
+
+    return batches
+
+
+class ParallelProgram(Program):
+    """
+    Program whose sweeps evaluate independent instructions concurrently,
+    see the module docstring.
+
+    Buffers are not released during the sweeps, i.e. the program behaves
+    like Program(..., release_buffers=False).
+
+    Parameters
+    ----------
+    functionList, independent_slots, dependent_slots, wrt_slots:
+        see Program
+    threads: int
+        number of worker threads
+
+    Attributes
+    ----------
+    levels: list of list of Instruction
+        the forward instructions grouped by level
+    reverse_batches: list of list of Instruction
+        the reverse instructions in the order of the batches that are
+        dispatched one after another in the reverse sweep
+    """
+
+    def __init__(self, functionList, independent_slots=None, dependent_slots=None,
+                 wrt_slots=None, threads=2):
+
+        if threads < 1:
+            raise ValueError('threads must be at least 1 but provided %r'%threads)
+
+        Program.__init__(self, functionList, independent_slots, dependent_slots,
+                         wrt_slots, release_buffers=False)
+
+        self.threads = threads
+        mutated, root = mutated_alias_classes(functionList)
+        self.levels = compute_levels(self.forward, root, mutated)
+
+        reverse = set([id(ins) for ins in self.reverse])
+        self.reverse_batches = []
+        for level in self.levels[::-1]:
+            self.reverse_batches.extend(
+                split_batches([ins for ins in level[::-1] if id(ins) in reverse], root))
+
+        self._threads = None
+
+    def _map(self, func, instructions):
+        if len(instructions) == 1 or self.threads == 1:
+            for ins in instructions:
+                func(ins)
+        else:
+            if self._threads is None:
+                self._threads = ThreadPool(self.threads)
+            self._threads.map(func, instructions, chunksize=1)
+
+    def close(self):
+        """ terminates the worker threads """
+        if self._threads is not None:
+            self._threads.close()
+            self._threads.join()
+            self._threads = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def pushforward(self, x_list, independent_slots, dependent_slots=()):
+        """
+        Evaluates the program level by level for the inputs x_list,
+        see Program.pushforward.
+        """
+
+        self._set_independents(x_list, independent_slots)
+
+        try:
+            for level in self.levels:
+                self._map(self._evaluate, level)
+
+        except Exception as e:
+            err_str = 'pushforward failed, reported error is:\n%s'%e
+            err_str += 'traceback:\n%s'%traceback.format_exc()
+            raise Exception(err_str)
+
+        self._lift_dependents(dependent_slots)
+
+    def pullback(self, xbar_list, dependent_slots, independent_slots=()):
+        """
+        Evaluates the adjoint program batch by batch, see Program.pullback.
+        """
+
+        protected = set(independent_slots) | set(dependent_slots)
+        self._seed_adjoints(xbar_list, dependent_slots)
+
+        def pull_back(ins):
+            self._pull_back(ins, protected, False)
+
+        try:
+            for batch in self.reverse_batches:
+                # the adjoints are allocated lazily, which must not happen
+                # concurrently
+                for ins in batch:
+                    for pos, s in ins.slots:
+                        self.get_adjoint(s)
+                self._map(pull_back, batch)
+
+        except Exception as e:
+            err_str = '\npullback failed, reported error is:\n%s'%e
+            err_str += '\n%s'%traceback.format_exc()
+            raise Exception(err_str)
+
+        for s in independent_slots:
+            self.get_adjoint(s)
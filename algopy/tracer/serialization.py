@@ -0,0 +1,426 @@
+"""
+Persistent file format of a CGraph.
+
+CGraph.save(path) writes the recorded computational graph to a file and
+CGraph.load(path) reconstructs the CGraph without re-executing the traced
+Python function.
+
+File format
+-----------
+
+The file is an uncompressed NumPy .npz container (see numpy.savez) with
+the following members:
+
+    * ``tape``: 0-d unicode array that contains a JSON document (the manifest)
+    * ``const_<k>``: the constant arrays referenced by the manifest, k=0,1,...
+
+The manifest is a JSON object::
+
+    {
+     "format": "algopy.CGraph",
+     "version": 1,
+     "nodes": [node_0, node_1, ...],
+     "independent": [slot, ...],
+     "dependent": [slot, ...],
+     "guards": [guard_0, guard_1, ...]
+    }
+
+where "independent" and "dependent" are the positions of the
+independentFunctionList and dependentFunctionList in the list of nodes.
+The optional "guards" are the comparisons recorded while tracing
+(see CGraph.check_guards), each guard is a JSON object
+``{"op": "operator.lt", "args": [arg_0, arg_1], "outcome": constant}``.
+Each node is a JSON object::
+
+    {
+     "opcode": "operator.mul",           # module.qualname of Function.func
+     "args": [arg_0, arg_1, ...],        # argument wiring, see below
+     "x": value,                         # only for identity nodes (Function.Id)
+     "shape": signature,                 # only for all other nodes
+     "setitem": [sl, store]              # only for setitem nodes
+    }
+
+An argument is either ``{"slot": n}``, i.e. the output of node n, or an
+encoded constant. Constants are encoded as
+
+    * null, true/false, numbers and strings as they are
+    * ``{"array": k, "scalar": false}``: numpy.ndarray stored in ``const_<k>``,
+      with "scalar": true it is a NumPy scalar stored as a 0-d array
+    * ``{"utpm": k}``: UTPM instance with UTPM.data stored in ``const_<k>``
+    * ``{"tuple": [...]}``, ``{"list": [...]}``
+    * ``{"slice": [start, stop, step]}``, ``{"ellipsis": null}``
+    * ``{"type": "module.qualname"}``, ``{"dtype": "float64"}``
+
+The value of identity nodes (constants and independent variables) are
+stored as encoded constants. For all other nodes only the signature of
+the value is stored, i.e. ``{"array": [shape, dtype]}``,
+``{"utpm": [data shape, dtype]}``, ``{"scalar": dtype}``,
+``{"tuple": [...]}`` or ``null``.
+Until the first pushforward these nodes hold zero-strided placeholders
+of that shape, which do not allocate memory.
+
+Since the members are stored uncompressed, the constant arrays can be
+memory-mapped directly from the .npz file with CGraph.load(path, mmap_mode='r')
+or mmap_mode='c'. Many processes can then share one tape file.
+"""
+
+import json
+import struct
+import zipfile
+import importlib
+import operator
+
+import numpy
+import numpy.lib.format
+
+import algopy
+from .tracer import Function, CGraph
+
+FORMAT_NAME = 'algopy.CGraph'
+FORMAT_VERSION = 1
+
+
+def func_to_opcode(func):
+    """ returns the name 'module.qualname' of the elementary function func """
+
+    name = func.__name__
+    if getattr(operator, name, None) is func:
+        return 'operator.' + name
+
+    module = getattr(func, '__module__', None)
+    qualname = getattr(func, '__qualname__', name)
+
+    if module is None or '<' in qualname:
+        raise ValueError('cannot serialize the function %r, only functions that '
+                         'can be imported by their name are supported'%func)
+
+    try:
+        imported = opcode_to_func(module + '.' + qualname)
+    except (AttributeError, ImportError):
+        imported = None
+
+    if imported != func:
+        raise ValueError('cannot serialize the function %r, it cannot be '
+                         'imported as %s.%s'%(func, module, qualname))
+
+    return module + '.' + qualname
+
+
+def opcode_to_func(opcode):
+    """ inverse of func_to_opcode """
+
+    parts = opcode.split('.')
+    for n in range(len(parts) - 1, 0, -1):
+        try:
+            obj = importlib.import_module('.'.join(parts[:n]))
+        except ImportError:
+            continue
+        for attr in parts[n:]:
+            obj = getattr(obj, attr)
+        return obj
+
+    raise ValueError('cannot import %s'%opcode)
+
+
+class _Encoder(object):
+    """ encodes constants as JSON objects, arrays are collected in self.arrays """
+
+    def __init__(self):
+        self.arrays = {}
+
+    def add_array(self, x):
+        key = 'const_%d'%len(self.arrays)
+        self.arrays[key] = x
+        return len(self.arrays) - 1
+
+    def encode(self, c):
+
+        if c is None or isinstance(c, (bool, str)):
+            return c
+
+        elif isinstance(c, (int, float)) and not isinstance(c, numpy.generic):
+            return c
+
+        elif isinstance(c, numpy.ndarray):
+            if c.dtype == object:
+                raise ValueError('cannot serialize arrays of dtype object')
+            return {'array': self.add_array(c), 'scalar': False}
+
+        elif isinstance(c, numpy.generic):
+            return {'array': self.add_array(numpy.asarray(c)), 'scalar': True}
+
+        elif isinstance(c, algopy.UTPM):
+            return {'utpm': self.add_array(c.data)}
+
+        elif isinstance(c, tuple):
+            return {'tuple': [self.encode(ci) for ci in c]}
+
+        elif isinstance(c, list):
+            return {'list': [self.encode(ci) for ci in c]}
+
+        elif isinstance(c, slice):
+            return {'slice': [self.encode(c.start), self.encode(c.stop), self.encode(c.step)]}
+
+        elif c is Ellipsis:
+            return {'ellipsis': None}
+
+        elif isinstance(c, numpy.dtype):
+            return {'dtype': c.str}
+
+        elif isinstance(c, type):
+            return {'type': func_to_opcode(c)}
+
+        else:
+            raise ValueError('cannot serialize the constant %r of type %s'%(c, type(c)))
+
+    def signature(self, x):
+
+        if x is None:
+            return None
+
+        elif isinstance(x, tuple):
+            return {'tuple': [self.signature(xi) for xi in x]}
+
+        elif isinstance(x, algopy.UTPM):
+            return {'utpm': [list(x.data.shape), x.data.dtype.str]}
+
+        elif isinstance(x, numpy.ndarray):
+            return {'array': [list(x.shape), x.dtype.str]}
+
+        elif numpy.isscalar(x):
+            return {'scalar': numpy.asarray(x).dtype.str}
+
+        else:
+            raise ValueError('cannot serialize the signature of %r'%type(x))
+
+
+class _Decoder(object):
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def decode(self, c):
+
+        if not isinstance(c, dict):
+            return c
+
+        elif 'array' in c:
+            x = self.arrays['const_%d'%c['array']]
+            return x[()] if c['scalar'] else x
+
+        elif 'utpm' in c:
+            return algopy.UTPM(self.arrays['const_%d'%c['utpm']])
+
+        elif 'tuple' in c:
+            return tuple([self.decode(ci) for ci in c['tuple']])
+
+        elif 'list' in c:
+            return [self.decode(ci) for ci in c['list']]
+
+        elif 'slice' in c:
+            return slice(*[self.decode(ci) for ci in c['slice']])
+
+        elif 'ellipsis' in c:
+            return Ellipsis
+
+        elif 'dtype' in c:
+            return numpy.dtype(c['dtype'])
+
+        elif 'type' in c:
+            return opcode_to_func(c['type'])
+
+        else:
+            raise ValueError('unknown constant %s'%c)
+
+    def placeholder(self, s):
+        """ returns a value with signature s that does not allocate memory """
+
+        if s is None:
+            return None
+
+        elif 'tuple' in s:
+            return tuple([self.placeholder(si) for si in s['tuple']])
+
+        elif 'utpm' in s:
+            shp, dtype = s['utpm']
+            return algopy.UTPM(numpy.broadcast_to(numpy.zeros((), dtype=dtype), shp))
+
+        elif 'array' in s:
+            shp, dtype = s['array']
+            return numpy.broadcast_to(numpy.zeros((), dtype=dtype), shp)
+
+        elif 'scalar' in s:
+            return numpy.zeros((), dtype=s['scalar'])[()]
+
+        else:
+            raise ValueError('unknown signature %s'%s)
+
+
+def save(cg, path):
+    """
+    Writes the CGraph cg to the file path, see the module docstring for the format.
+    """
+
+    slot_of = {}
+    for n, f in enumerate(cg.functionList):
+        slot_of[id(f)] = n
+
+    encoder = _Encoder()
+    nodes = []
+
+    for n, f in enumerate(cg.functionList):
+        node = {'opcode': func_to_opcode(f.func)}
+
+        args = []
+        for a in f.args:
+            if isinstance(a, Function):
+                args.append({'slot': slot_of[id(a)]})
+            else:
+                args.append(encoder.encode(a))
+        node['args'] = args
+
+        if f.func == Function.Id:
+            node['x'] = encoder.encode(f.x)
+        else:
+            node['shape'] = encoder.signature(f.x)
+
+        if 'setitem' in f.__dict__:
+            node['setitem'] = [encoder.encode(f.setitem[0]), encoder.encode(f.setitem[1])]
+
+        nodes.append(node)
+
+    manifest = {'format': FORMAT_NAME,
+                'version': FORMAT_VERSION,
+                'nodes': nodes,
+                'independent': [slot_of[id(f)] for f in cg.independentFunctionList],
+                'dependent': [slot_of[id(f)] for f in cg.dependentFunctionList]}
+
+    if cg.guards:
+        manifest['guards'] = [{'op': func_to_opcode(g.op),
+                               'args': [{'slot': slot_of[id(a)]} if isinstance(a, Function)
+                                        else encoder.encode(a) for a in g.args],
+                               'outcome': encoder.encode(g.outcome)}
+                              for g in cg.guards]
+
+    if hasattr(path, 'write'):
+        fobj = path
+    else:
+        fobj = open(path, 'wb')
+
+    try:
+        numpy.savez(fobj, tape=numpy.array(json.dumps(manifest)), **encoder.arrays)
+    finally:
+        if fobj is not path:
+            fobj.close()
+
+
+def _memmap_npz_member(path, name, mode):
+    """
+    memory-maps the member name.npy of the uncompressed .npz file path
+    """
+
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(name + '.npy')
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None
+
+    with open(path, 'rb') as fobj:
+        # skip the local file header of the zip member
+        fobj.seek(info.header_offset + 26)
+        n_name, n_extra = struct.unpack('<HH', fobj.read(4))
+        fobj.seek(info.header_offset + 30 + n_name + n_extra)
+
+        version = numpy.lib.format.read_magic(fobj)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(fobj)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(fobj)
+        offset = fobj.tell()
+
+    if dtype.hasobject:
+        return None
+
+    if numpy.prod(shape) == 0:
+        return numpy.zeros(shape, dtype=dtype)
+
+    order = 'F' if fortran_order else 'C'
+    return numpy.memmap(path, dtype=dtype, mode=mode, offset=offset,
+                        shape=shape, order=order)
+
+
+def load(path, mmap_mode=None):
+    """
+    Reads a CGraph that has been written with save(cg, path).
+
+    Parameters
+    ----------
+    path: str
+        filename
+    mmap_mode: None, 'r' or 'c'
+        if not None, the constant arrays are memory-mapped instead of read
+        into memory, see numpy.memmap. Use 'c' (copy-on-write) if the
+        traced function modifies constant buffers with setitem.
+
+    Returns
+    -------
+    cg: CGraph instance
+    """
+
+    if mmap_mode not in (None, 'r', 'c'):
+        raise ValueError("mmap_mode must be None, 'r' or 'c' but provided %r"%mmap_mode)
+
+    with numpy.load(path) as npz:
+        manifest = json.loads(str(npz['tape']))
+
+        if manifest.get('format') != FORMAT_NAME:
+            raise ValueError('%s is not an algopy.CGraph file'%path)
+
+        if manifest['version'] > FORMAT_VERSION:
+            raise ValueError('unsupported file format version %d'%manifest['version'])
+
+        arrays = {}
+        for key in npz.files:
+            if key == 'tape':
+                continue
+            x = None
+            if mmap_mode is not None:
+                x = _memmap_npz_member(path, key, mmap_mode)
+            if x is None:
+                x = npz[key]
+            arrays[key] = x
+
+    decoder = _Decoder(arrays)
+
+    # create the CGraph without changing the current tracing state
+    cgraph = Function.cgraph
+    cg = CGraph()
+    Function.cgraph = cgraph
+
+    functionList = [Function() for node in manifest['nodes']]
+    for n, node in enumerate(manifest['nodes']):
+        f = functionList[n]
+        f.ID = n
+        f.func = opcode_to_func(node['opcode'])
+        f.args = [functionList[a['slot']] if isinstance(a, dict) and 'slot' in a
+                  else decoder.decode(a) for a in node['args']]
+
+        if 'x' in node:
+            f.x = decoder.decode(node['x'])
+        else:
+            f.x = decoder.placeholder(node['shape'])
+
+        if 'setitem' in node:
+            f.setitem = (decoder.decode(node['setitem'][0]),
+                         decoder.decode(node['setitem'][1]))
+
+    cg.functionList = functionList
+    cg.functionCount = len(functionList)
+    cg.independentFunctionList = [functionList[n] for n in manifest['independent']]
+    cg.dependentFunctionList = [functionList[n] for n in manifest['dependent']]
+
+    for guard in manifest.get('guards', []):
+        cg.add_guard(opcode_to_func(guard['op']),
+                     [functionList[a['slot']] if isinstance(a, dict) and 'slot' in a
+                      else decoder.decode(a) for a in guard['args']],
+                     decoder.decode(guard['outcome']))
+    return cg
@@ -0,0 +1,444 @@
+"""
+Sparsity pattern detection by propagating index sets through a CGraph.
+
+Instead of Taylor coefficients, each value on the tape is represented by an
+array of the same shape whose entries are index sets, stored as bitsets
+(Python ints): bit i of an entry is set if the entry depends on the i-th
+independent variable. The independent variables are numbered by
+concatenating the flattened independent Functions.
+
+The arrays have dtype object, hence getitem, reshape and transpose return
+views and setitem modifies the buffer in place, exactly as for the values
+on the tape.
+
+The Jacobian pattern is given by the index sets of the dependent Functions.
+The Hessian pattern is obtained with the nonlinear interaction domains of
+
+    Walther, A., "Computing sparse Hessians with automatic differentiation",
+    ACM TOMS 34(1), 2008.
+
+i.e. each nonlinear operation with arguments depending on the index sets U
+and V adds V to the interactions of all i in U and vice versa. Only nodes
+that contribute to the dependent Functions are taken into account.
+
+The rules for the operations are collected in the dictionary
+``pattern_rules`` (opcode -> rule). Operations without a rule are treated
+conservatively: all entries of the result depend on all entries of the
+arguments and interact nonlinearly with each other.
+"""
+
+import numpy
+import scipy.sparse
+
+from .passes import activity_analysis
+
+
+def bits(s):
+    """ returns the positions of the set bits of the bitset s """
+    retval = []
+    while s:
+        low = s & -s
+        retval.append(low.bit_length() - 1)
+        s ^= low
+    return retval
+
+
+def union(a):
+    """ returns the union of all index sets in the pattern array a """
+    a = numpy.asarray(a, dtype=object)
+    if a.size == 0:
+        return 0
+    return numpy.bitwise_or.reduce(a.ravel())
+
+
+def reduce_rows(a):
+    """ returns the union of the rows of the two-dimensional pattern array a """
+    if a.shape[0] == 0:
+        return empty_pattern(a.shape[1:])
+    return numpy.bitwise_or.reduce(a, axis=0)
+
+
+def empty_pattern(shape):
+    """ returns a pattern array without dependencies """
+    return numpy.zeros(shape, dtype=object)
+
+
+def as_pattern_array(a):
+    """ wraps scalar results of ufuncs into 0-d pattern arrays """
+    if isinstance(a, (numpy.ndarray, tuple)):
+        return a
+    return numpy.array(a, dtype=object)
+
+
+def get_shape(x):
+    """ returns the shape of a value on the tape """
+    return getattr(x, 'shape', ())
+
+
+class Interactions(object):
+    """
+    The nonlinear interaction domains, i.e. domains[i] is the bitset of
+    the independent variables that interact nonlinearly with the i-th one.
+    """
+
+    def __init__(self, N):
+        self.domains = [0] * N
+        self.active = True
+
+    def cross(self, U, V):
+        """ records the nonlinear interaction of the index sets U and V """
+        if not (self.active and U and V):
+            return
+        domains = self.domains
+        for i in bits(U):
+            domains[i] |= V
+        if U != V:
+            for i in bits(V):
+                domains[i] |= U
+
+    def elementwise(self, a):
+        """ nonlinear interactions of a unary elementwise operation """
+        for s in set(numpy.asarray(a, dtype=object).ravel().tolist()):
+            self.cross(s, s)
+
+    def pairs(self, a, b):
+        """ nonlinear interactions of the elementwise products a*b """
+        if not self.active:
+            return
+        a, b = numpy.broadcast_arrays(numpy.asarray(a, dtype=object),
+                                      numpy.asarray(b, dtype=object))
+        for s, t in set(zip(a.ravel().tolist(), b.ravel().tolist())):
+            self.cross(s, t)
+
+
+# elementwise operations that are (piecewise) linear in all arguments
+linear_elementwise = set([
+    'add', 'sub', 'neg', 'negative', '__add__', '__sub__', '__neg__',
+    'absolute', 'minimum', 'maximum', 'botched_clip',
+    ])
+
+# elementwise operations that are nonlinear in all arguments
+nonlinear_elementwise = set([
+    'exp', 'expm1', 'log', 'log1p', 'sqrt', 'square', 'reciprocal',
+    'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'sinh', 'cosh', 'tanh',
+    'erf', 'erfi', 'dawsn', 'logit', 'expit', 'gammaln', 'psi', 'polygamma',
+    'hyp1f1', 'dpm_hyp1f1', 'hyperu', 'hyp2f0', 'dpm_hyp2f0', 'hyp0f1',
+    # fused elementwise kernels (see CGraph.fuse) are treated conservatively
+    'fused',
+    ])
+
+# elementwise operations with vanishing derivatives
+constant_elementwise = set(['sign'])
+
+
+def broadcast_union(patterns):
+    retval = numpy.zeros((), dtype=object)
+    for p in patterns:
+        retval = retval | p
+    return as_pattern_array(retval)
+
+
+def rule_linear_elementwise(f, args, patterns, constants, interactions):
+    return broadcast_union(patterns)
+
+
+def rule_nonlinear_elementwise(f, args, patterns, constants, interactions):
+    retval = broadcast_union(patterns)
+    interactions.elementwise(retval)
+    return retval
+
+
+def rule_constant_elementwise(f, args, patterns, constants, interactions):
+    return empty_pattern(get_shape(f.x))
+
+
+def rule_mul(f, args, patterns, constants, interactions):
+    a, b = patterns
+    interactions.pairs(a, b)
+    return broadcast_union(patterns)
+
+
+def rule_truediv(f, args, patterns, constants, interactions):
+    a, b = patterns
+    interactions.pairs(a, b)
+    interactions.elementwise(b)
+    return broadcast_union(patterns)
+
+
+def rule_pow(f, args, patterns, constants, interactions):
+    if len(patterns) == 1:
+        r = args[1]
+        if numpy.all(numpy.asarray(r) == 0):
+            return empty_pattern(get_shape(f.x))
+        retval = patterns[0].copy()
+        if not numpy.all(numpy.asarray(r) == 1):
+            interactions.elementwise(retval)
+        return retval
+    return rule_nonlinear_elementwise(f, args, patterns, constants, interactions)
+
+
+def rule_getitem(f, args, patterns, constants, interactions):
+    a = patterns[0]
+    if isinstance(a, tuple):
+        return a[args[1]]
+    return as_pattern_array(a[args[1]])
+
+
+def rule_setitem(f, args, patterns, constants, interactions):
+    buf, rhs = patterns
+    # a 0-d array would be stored as an entry of the object array
+    buf[args[1]] = rhs[()] if rhs.ndim == 0 else rhs
+    return None
+
+
+def rule_reshape(f, args, patterns, constants, interactions):
+    return patterns[0].reshape(get_shape(f.x))
+
+
+def rule_transpose(f, args, patterns, constants, interactions):
+    return numpy.transpose(patterns[0], *args[1:])
+
+
+def rule_structural(func):
+    def rule(f, args, patterns, constants, interactions):
+        return as_pattern_array(func(patterns[0]))
+    return rule
+
+
+def rule_trace(f, args, patterns, constants, interactions):
+    return as_pattern_array(union(numpy.diagonal(patterns[0])))
+
+
+def rule_sum(f, args, patterns, constants, interactions):
+    a = patterns[0]
+    axis = args[1] if len(args) > 1 else None
+    if axis is None:
+        return as_pattern_array(union(a))
+    if a.shape[axis] == 0:
+        return empty_pattern(get_shape(f.x))
+    return as_pattern_array(numpy.bitwise_or.reduce(a, axis=axis))
+
+
+def rule_prod(f, args, patterns, constants, interactions):
+    u = union(patterns[0])
+    interactions.cross(u, u)
+    return as_pattern_array(u)
+
+
+def rule_zeros(f, args, patterns, constants, interactions):
+    return empty_pattern(get_shape(f.x))
+
+
+def rule_dot(f, args, patterns, constants, interactions):
+    """
+    dot(A, B): entry (i, k) depends on A[i, j] and B[j, k] for all j.
+    The zeros of constant matrices are taken into account.
+    """
+
+    A, B = patterns
+    cA, cB = constants
+    A2 = A.reshape((1, -1)) if A.ndim == 1 else A
+    B2 = B.reshape((-1, 1)) if B.ndim == 1 else B
+    n, m = A2.shape
+    k = B2.shape[1]
+
+    if A.ndim == 0 or B.ndim == 0:
+        interactions.pairs(A, B)
+        return broadcast_union(patterns)
+
+    if cA is not None:
+        cA2 = numpy.asarray(cA).reshape(A2.shape) != 0
+        R = empty_pattern((n, k))
+        for i in range(n):
+            R[i, :] = reduce_rows(B2[cA2[i], :])
+
+    elif cB is not None:
+        cB2 = numpy.asarray(cB).reshape(B2.shape) != 0
+        R = empty_pattern((n, k))
+        for l in range(k):
+            R[:, l] = reduce_rows(A2[:, cB2[:, l]].T)
+
+    else:
+        R = empty_pattern((n, k))
+        for j in range(m):
+            R = R | (A2[:, j:j+1] | B2[j:j+1, :])
+            interactions.cross(union(A2[:, j]), union(B2[j, :]))
+
+    return as_pattern_array(R.reshape(get_shape(f.x)))
+
+
+def rule_outer(f, args, patterns, constants, interactions):
+    a, b = [p.ravel() for p in patterns]
+    interactions.cross(union(a), union(b))
+    return a[:, numpy.newaxis] | b[numpy.newaxis, :]
+
+
+def rule_solve(f, args, patterns, constants, interactions):
+    """
+    x = solve(A, b): the column k of x depends on all entries of A and on
+    the column k of b, x is nonlinear in A and bilinear in A and b.
+    """
+
+    A, B = patterns
+    u = union(A)
+    B2 = B.reshape((B.shape[0], -1))
+    interactions.cross(u, u | union(B2))
+    R = reduce_rows(B2) | u
+    return as_pattern_array(numpy.broadcast_to(R, B2.shape).reshape(B.shape).copy())
+
+
+def rule_dense(f, args, patterns, constants, interactions):
+    """
+    conservative rule: each entry of the result depends nonlinearly on all
+    entries of the arguments
+    """
+
+    u = 0
+    for p in patterns:
+        if isinstance(p, tuple):
+            u |= union(numpy.concatenate([numpy.ravel(q) for q in p]))
+        else:
+            u |= union(p)
+    interactions.cross(u, u)
+
+    def fill(x):
+        if isinstance(x, tuple):
+            return tuple([fill(xi) for xi in x])
+        retval = empty_pattern(get_shape(x))
+        retval[...] = u
+        return retval
+
+    return fill(f.x)
+
+
+def rule_symvec(f, args, patterns, constants, interactions):
+    A = patterns[0]
+    rows, cols = numpy.triu_indices(A.shape[0])
+    return A[rows, cols] | A[cols, rows]
+
+
+def rule_vecsym(f, args, patterns, constants, interactions):
+    v = patterns[0]
+    N = get_shape(f.x)[0]
+    rows, cols = numpy.triu_indices(N)
+    A = empty_pattern((N, N))
+    A[rows, cols] = v
+    A[cols, rows] = v
+    return A
+
+
+pattern_rules = {
+    'mul': rule_mul, '__mul__': rule_mul,
+    'truediv': rule_truediv, 'div': rule_truediv,
+    '__truediv__': rule_truediv, '__div__': rule_truediv,
+    'pow': rule_pow, '__pow__': rule_pow,
+    'getitem': rule_getitem, '__getitem__': rule_getitem,
+    'setitem': rule_setitem, '__setitem__': rule_setitem,
+    'reshape': rule_reshape,
+    'transpose': rule_transpose,
+    'diag': rule_structural(numpy.diag),
+    'tril': rule_structural(numpy.tril),
+    'triu': rule_structural(numpy.triu),
+    'trace': rule_trace,
+    'sum': rule_sum,
+    'prod': rule_prod,
+    'zeros': rule_zeros, 'ones': rule_zeros,
+    'dot': rule_dot,
+    'outer': rule_outer,
+    'solve': rule_solve,
+    'symvec': rule_symvec,
+    'vecsym': rule_vecsym,
+    }
+
+for name in linear_elementwise:
+    pattern_rules[name] = rule_linear_elementwise
+for name in nonlinear_elementwise:
+    pattern_rules[name] = rule_nonlinear_elementwise
+for name in constant_elementwise:
+    pattern_rules[name] = rule_constant_elementwise
+
+
+def propagate_patterns(functionList, independent_slots, dependent_slots, hessian=False):
+    """
+    Propagates index sets through the functionList.
+
+    Parameters
+    ----------
+    functionList: list of Function
+    independent_slots: list of int
+        positions of the independent nodes in functionList
+    dependent_slots: list of int
+        positions of the dependent nodes in functionList
+    hessian: bool
+        if True, the nonlinear interaction domains are computed as well
+
+    Returns
+    -------
+    jacobian: scipy.sparse.csr_matrix
+        the Jacobian pattern, shape (M, N), where M and N are the total
+        sizes of the dependent and the independent Functions
+    hessian: scipy.sparse.csr_matrix or None
+        the pattern of the Hessians of all dependent Functions, shape (N, N)
+    """
+    from .tracer import Function
+
+    slot_of = {}
+    for n, f in enumerate(functionList):
+        slot_of[id(f)] = n
+
+    independent = {}
+    N = 0
+    for s in independent_slots:
+        shp = get_shape(functionList[s].x)
+        size = int(numpy.prod(shp))
+        seeds = numpy.array([1 << (N + i) for i in range(size)], dtype=object)
+        independent[s] = seeds.reshape(shp)
+        N += size
+
+    interactions = Interactions(N)
+    useful = [True] * len(functionList)
+    if hessian:
+        useful = activity_analysis(functionList, independent_slots, dependent_slots)[1]
+
+    values = [None] * len(functionList)
+    constants = [None] * len(functionList)
+
+    for n, f in enumerate(functionList):
+        opcode = f.func.__name__
+
+        if opcode == 'Id':
+            if n in independent:
+                values[n] = independent[n]
+            else:
+                values[n] = empty_pattern(get_shape(f.x))
+                if isinstance(f.x, (numpy.ndarray, float, int)):
+                    constants[n] = f.x
+            continue
+
+        fargs = [a for a in f.args if isinstance(a, Function)]
+        patterns = [values[slot_of[id(a)]] for a in fargs]
+        interactions.active = hessian and useful[n]
+        args_constants = [constants[slot_of[id(a)]] for a in fargs]
+        rule = pattern_rules.get(opcode, rule_dense)
+        values[n] = rule(f, f.args, patterns, args_constants, interactions)
+
+    rows = []
+    for s in dependent_slots:
+        rows.extend(numpy.ravel(values[s]).tolist())
+
+    jacobian = index_sets_to_csr(rows, N)
+    if not hessian:
+        return jacobian, None
+    return jacobian, index_sets_to_csr(interactions.domains, N)
+
+
+def index_sets_to_csr(sets, N):
+    """ converts a list of bitsets to a scipy.sparse.csr_matrix with N columns """
+    indptr = [0]
+    indices = []
+    for s in sets:
+        indices.extend(bits(s))
+        indptr.append(len(indices))
+    data = numpy.ones(len(indices), dtype=numpy.int8)
+    return scipy.sparse.csr_matrix((data, numpy.array(indices, dtype=int), indptr),
+                                   shape=(len(sets), N))
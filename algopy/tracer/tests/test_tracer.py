@@ -1,11 +1,13 @@
 from numpy.testing import *
 from .environment import Settings
 import os
+import sys
 
 import numpy
 
 import algopy
 from algopy.tracer.tracer import *
+from algopy.tracer import codegen
 from algopy.utpm import UTPM
 from algopy import dot, eigh, qr, trace, solve, inv
 
@@ -2290,6 +2292,26 @@ class Test_CGgraph_on_UTPM(TestCase):
         assert_array_almost_equal(g1,UTPM.extract_jacobian(algopy.tan(x)))
 
 
+    def test_pullback_function_cache(self):
+        cg = CGraph()
+        fx = Function(UTPM(numpy.random.random((2,1,3))))
+        fy = algopy.sum(algopy.sin(fx) * fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        x = numpy.random.random(3)
+        g1 = cg.gradient(x)
+        for f in cg.functionList[1:]:
+            assert_equal(f.pullback_class, UTPM)
+            assert_equal(f.pullback_function,
+                         getattr(UTPM, 'pb_' + f.func.__name__))
+
+        g2 = cg.gradient(x)
+        assert_array_almost_equal(g1, numpy.sin(x) + x*numpy.cos(x))
+        assert_array_almost_equal(g1, g2)
+
+
 class Test_UserFriendlyDrivers(TestCase):
 
     def test_most_drivers(self):
@@ -2447,6 +2469,1161 @@ class Test_UserFriendlyDrivers(TestCase):
 
         assert_almost_equal(aJ.data, aJ2.data)
 
+    def test_jacobian_mode(self):
+
+        def f(x):
+            y = algopy.outer(x, algopy.sin(x)).reshape((x.size**2,))
+            return algopy.exp(y) * y
+
+        x = numpy.random.random(4)
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        J = UTPM.extract_jacobian(f(UTPM.init_jacobian(x)))
+        assert_array_almost_equal(J, cg.jacobian(x))
+        assert_array_almost_equal(J, cg.jacobian(x, mode='forward'))
+
+        # M = N**2 > N, hence the forward mode is cheaper
+        assert_array_almost_equal(J, cg.jacobian(x, mode='auto'))
+        info = cg.jacobian_info
+        assert_equal(info['mode'], 'forward')
+        assert_equal(info['calibrated'], False)
+        assert_equal(info['forward'] < info['reverse'], True)
+        assert_equal(info['nodes'], len(cg.functionList))
+
+        # the reverse mode is cheaper for many inputs and one output
+        assert_equal(cg.jacobian_cost(10**5, 1)['mode'], 'reverse')
+
+        # calibration by a trial run
+        assert_array_almost_equal(J, cg.jacobian(x, mode='auto', calibrate=True))
+        assert_equal(cg.jacobian_info['calibrated'], True)
+        assert_equal(cg.jacobian_cost(4, 16)['calibrated'], True)
+        assert_equal(cg.jacobian_cost(5, 16)['calibrated'], False)
+
+        assert_raises(ValueError, cg.jacobian, x, mode='sideways')
+
+    def test_jacobian_chunks(self):
+
+        def f(x):
+            y = algopy.zeros(5, dtype=x)
+            y[0] = x[0] * x[1]
+            y[1:4] = algopy.sin(x[2:5]) * x[:3]
+            y[4] = algopy.sum(x * x)
+            return y
+
+        x = numpy.random.random(7)
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        J = UTPM.extract_jacobian(f(UTPM.init_jacobian(x)))
+        for i in range(2):
+            for mode in ('forward', 'reverse'):
+                for chunk_size in (1, 2, 3, 7):
+                    assert_array_almost_equal(J, cg.jacobian(x, mode=mode, chunk_size=chunk_size))
+            cg.compile()
+
+        assert_array_almost_equal(J, cg.jacobian(x, memory_budget=2000))
+        assert_raises(ValueError, cg.jacobian, x, memory_budget=10)
+        assert_raises(ValueError, cg.jacobian, x, chunk_size=0)
+
+    def test_matrix_products(self):
+        A = numpy.random.random((4, 4))
+
+        def f(x):
+            return algopy.dot(A, algopy.sin(x)) * x
+
+        x = numpy.random.random(4)
+        V = numpy.random.random((4, 3))
+        W = numpy.random.random((2, 4))
+
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        J = cg.jacobian(x)
+        assert_array_almost_equal(cg.jac_mat(x, V), numpy.dot(J, V))
+        assert_array_almost_equal(cg.mat_jac(W, x), numpy.dot(W, J))
+        assert_array_almost_equal(cg.jac_mat(x, V)[:, 1], cg.jac_vec(x, V[:, 1]))
+        assert_array_almost_equal(cg.mat_jac(W, x)[1], cg.vec_jac(W[1], x))
+        assert_raises(ValueError, cg.jac_mat, x, V.T)
+        assert_raises(ValueError, cg.mat_jac, W.T, x)
+
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = algopy.sum(f(fx) * fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        H = cg.hessian(x)
+        assert_array_almost_equal(cg.hess_mat(x, V), numpy.dot(H, V))
+        assert_array_almost_equal(cg.hess_mat(x, V)[:, 2], cg.hess_vec(x, V[:, 2]))
+
+    def test_gradient_batch(self):
+
+        A = numpy.random.random((3, 3)) + 3*numpy.eye(3)
+
+        def f(x, z):
+            y = algopy.zeros(3, dtype=x)
+            y[0] = algopy.exp(x[0]) * z
+            y[1:] = algopy.sin(x[1:])
+            u = algopy.dot(algopy.inv(A + algopy.outer(y, y)), algopy.dot(A, x))
+            return algopy.sum(u * y) / z
+
+        B = 5
+        X = numpy.random.random((B, 3))
+        Z = numpy.random.random(B) + 1
+
+        cg = algopy.CGraph()
+        fx = algopy.Function(X[0])
+        fz = algopy.Function(Z[0])
+        fy = f(fx, fz)
+        cg.trace_off()
+        cg.independentFunctionList = [fx, fz]
+        cg.dependentFunctionList = [fy]
+
+        G = [cg.gradient([X[b], Z[b]]) for b in range(B)]
+
+        for i in range(2):
+            GX, GZ = cg.gradient_batch([X, Z])
+            assert_equal(GX.shape, (B, 3))
+            assert_equal(GZ.shape, (B,))
+            assert_array_almost_equal(GX, [g[0] for g in G])
+            assert_array_almost_equal(GZ, [g[1] for g in G])
+            cg.compile()
+
+        # single independent Function
+        cg = algopy.CGraph()
+        fx = algopy.Function(X[0])
+        fy = f(fx, 2.)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+        assert_array_almost_equal(cg.gradient_batch(X),
+                                  [cg.gradient(X[b]) for b in range(B)])
+
+    def test_sparse_jacobian(self):
+
+        def f(x):
+            y = algopy.zeros(x.shape, dtype=x)
+            y[0] = x[0]**2 - x[1]
+            y[1:-1] = x[:-2] - 2*algopy.sin(x[1:-1]) + x[2:]*x[1:-1]
+            y[-1] = algopy.exp(x[-1]) + x[-2]
+            return y
+
+        N = 20
+        cg = algopy.CGraph()
+        fx = algopy.Function(numpy.ones(N))
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        x = numpy.random.random(N)
+        J = cg.jacobian(x)
+
+        for mode in ['forward', 'reverse', 'auto']:
+            Js = cg.sparse_jacobian(x, mode=mode)
+            assert_equal(Js.nnz, 3*N - 2)
+            assert_array_almost_equal(Js.toarray(), J)
+            assert_equal(cg.jacobian_info['forward'], 3)
+            assert_equal(cg.jacobian_info['reverse'], 3)
+
+        # arrowhead: one dense row, only the reverse mode can compress it
+        def g(x):
+            y = algopy.zeros(x.shape, dtype=x)
+            y[0] = algopy.sum(x**2)
+            y[1:] = algopy.sin(x[1:])
+            return y
+
+        cg = algopy.CGraph()
+        fx = algopy.Function(numpy.ones(N))
+        fy = g(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        pattern = numpy.eye(N)
+        pattern[0, :] = 1
+        Js = cg.sparse_jacobian(x, pattern=pattern)
+        assert_equal(cg.jacobian_info['mode'], 'reverse')
+        assert_equal(cg.jacobian_info['forward'], N)
+        assert_equal(cg.jacobian_info['reverse'], 2)
+        assert_array_almost_equal(Js.toarray(), cg.jacobian(x))
+
+    def test_sparse_hessian(self):
+
+        def f(x):
+            return algopy.sum(100*(x[1:] - x[:-1]**2)**2 + (1 - x[:-1])**2) \
+                 + algopy.sum(algopy.sin(x[:-2] * x[2:]))
+
+        N = 20
+        cg = algopy.CGraph()
+        fx = algopy.Function(numpy.ones(N))
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        x = numpy.random.random(N)
+        H = cg.hessian(x)
+        Hs = cg.sparse_hessian(x)
+        assert_equal(Hs.nnz, 5*N - 6)
+        assert_equal(cg.hessian_info['colors'], 5)
+        assert_array_almost_equal(Hs.toarray(), H)
+
+        # arrowhead: a star coloring needs only two colors
+        def g(x):
+            return x[0] * algopy.sum(x**2) + algopy.sum(algopy.exp(x))
+
+        cg = algopy.CGraph()
+        fx = algopy.Function(numpy.ones(N))
+        fy = g(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        pattern = numpy.eye(N)
+        pattern[0, :] = 1
+        Hs = cg.sparse_hessian(x, pattern=pattern)
+        assert_equal(cg.hessian_info['colors'], 2)
+        assert_array_almost_equal(Hs.toarray(), cg.hessian(x))
+
+    def test_sparsity_patterns(self):
+
+        A = numpy.array([[1., 0, 0, 2], [0, 3, 0, 0]])
+
+        def f(x):
+            y = algopy.zeros(5, dtype=x)
+            y[0] = x[0]**2 - x[1]
+            y[1:3] = algopy.dot(A, x[:4].reshape((4, 1))).reshape((2,)) * x[4]
+            M = algopy.zeros((2, 2), dtype=x)
+            M[0, 0] = x[2]
+            M[1, 1] = 1.
+            M[1, 0] = x[3]
+            y[3:] = algopy.solve(M, x[4:].reshape((2, 1))).reshape((2,))
+            return y
+
+        cg = algopy.CGraph()
+        fx = algopy.Function(numpy.ones(6))
+        fy = f(fx)
+        fz = algopy.sum(algopy.sin(fy[:3])) + fy[3]
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        J = cg.jacobian_pattern()
+        assert cg.jacobian_pattern() is J
+        assert_array_equal(J.toarray(), [[1, 1, 0, 0, 0, 0],
+                                          [1, 0, 0, 1, 1, 0],
+                                          [0, 1, 0, 0, 1, 0],
+                                          [0, 0, 1, 1, 1, 1],
+                                          [0, 0, 1, 1, 1, 1]])
+
+        cg.dependentFunctionList = [fz]
+        cg._jacobian_pattern = None
+        H = cg.hessian_pattern().toarray()
+        assert_array_equal(H, H.T)
+
+        x = numpy.random.random(6) + 1
+        assert numpy.all(H >= (cg.hessian(x) != 0))
+        assert_array_equal(H[5], [0, 0, 1, 1, 0, 0])
+        assert_array_equal(H[0], [1, 1, 0, 1, 1, 0])
+        assert_array_almost_equal(cg.sparse_hessian(x).toarray(), cg.hessian(x))
+
+    def test_star_coloring(self):
+        from algopy.tracer.coloring import (star_coloring, symmetric_pattern,
+                                            seed_matrix, recover_symmetric)
+
+        numpy.random.seed(1)
+        for trial in range(20):
+            N = numpy.random.randint(1, 30)
+            pattern = symmetric_pattern(numpy.random.random((N, N)) < 0.1)
+            H = pattern.toarray() * numpy.random.random((N, N))
+            H = H + H.T
+            colors = star_coloring(pattern)
+            B = dot(H, seed_matrix(colors))
+            assert_array_almost_equal(recover_symmetric(pattern, colors, B).toarray(), H)
+
+
+class Test_CGraph_compile(TestCase):
+
+    def trace(self, f, x):
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+        return cg
+
+    def test_compiled_drivers(self):
+
+        def g(x):
+            out = algopy.zeros(3, dtype=x)
+            out[0] = algopy.sin(x[0]*x[1])
+            out[1] = algopy.exp(x[0]*algopy.cos(x[0]))
+            out[2] = algopy.dot(x, x)
+            Q, R = algopy.qr(algopy.outer(x, x) + numpy.eye(3))
+            out[2] += algopy.trace(R)
+            return out
+
+        x = numpy.random.random(3)
+        v = numpy.random.random(3)
+        w = numpy.random.random(3)
+
+        cg = self.trace(g, x)
+        J1 = cg.jacobian(x)
+        Jv1 = cg.jac_vec(x, v)
+        wH1 = cg.vec_hess(w, x)
+
+        program = cg.compile()
+        assert_equal(len(program), len(cg.functionList))
+
+        for i in range(2):
+            assert_array_almost_equal(J1, cg.jacobian(x))
+            assert_array_almost_equal(Jv1, cg.jac_vec(x, v))
+            assert_array_almost_equal(wH1, cg.vec_hess(w, x))
+
+    def test_compiled_gradient_and_hessian(self):
+
+        def f(x):
+            return algopy.sum(algopy.exp(x) * algopy.log1p(x*x)) / algopy.dot(x, x)
+
+        x = numpy.random.random(4)
+        cg = self.trace(f, x)
+        g1 = cg.gradient(x)
+        H1 = cg.hessian(x)
+        cg.compile()
+        assert_array_almost_equal(g1, cg.gradient(x))
+        assert_array_almost_equal(H1, cg.hessian(x))
+
+    def test_release_buffers(self):
+
+        def f(x):
+            y = x
+            for i in range(5):
+                y = algopy.exp(-y) + y - x
+            return algopy.sum(y * y)
+
+        x = numpy.random.random(5)
+        cg = self.trace(f, x)
+        g1 = cg.gradient(x)
+        H1 = cg.hessian(x)
+
+        program = cg.compile(release_buffers=False)
+        assert_array_almost_equal(g1, cg.gradient(x))
+        assert_array_almost_equal(H1, cg.hessian(x))
+        assert_equal([v for v in program.values if isinstance(v, UTPM) and
+                      0 in v.data.strides], [])
+
+        program = cg.compile(release_buffers=True)
+        for i in range(2):
+            assert_array_almost_equal(g1, cg.gradient(x))
+            assert_array_almost_equal(H1, cg.hessian(x))
+
+        # the values only needed by the pullback of add and sub are released
+        released = [v for v in program.values if isinstance(v, UTPM) and
+                    v.data.size > 1 and max(v.data.strides) == 0]
+        assert_equal(len(released) > 0, True)
+
+        # only the adjoints of the independent and dependent Functions are kept
+        kept = [s for s, xbar in enumerate(program.adjoints) if xbar is not None]
+        assert_equal(kept, [0, len(program) - 1])
+
+    def test_recording_discards_program(self):
+        cg = algopy.CGraph()
+        fx = algopy.Function(3.)
+        cg.compile()
+        fy = fx * fx
+        assert_equal(cg.program, None)
+
+    def test_activity_analysis(self):
+        cg = algopy.CGraph()
+        fx = algopy.Function(numpy.random.random(3))
+        fz = algopy.Function(numpy.random.random(3))
+        fu = algopy.exp(fx)
+        fd = algopy.sum(algopy.sin(fu))          # diagnostics, not a dependent
+        fc = algopy.dot(fz, fz)                  # does not depend on fx
+        fy = algopy.sum(fu * fz) + fc
+        cg.trace_off()
+        cg.independentFunctionList = [fx, fz]
+        cg.dependentFunctionList = [fy]
+
+        program = cg.compile(wrt=[fx])
+        forward = [ins.result for ins in program.forward]
+        reverse = [ins.result for ins in program.reverse]
+
+        assert_equal(fd.ID in forward, False)
+        assert_equal(program.useful[fd.ID], False)
+        assert_equal(program.varied[fc.ID], False)
+        assert_equal(fc.ID in forward, True)
+        assert_equal(fc.ID in reverse, False)
+        assert_equal(program.varied[fy.ID], True)
+
+    def test_gradient_wrt(self):
+
+        def f(x, z):
+            d = algopy.sum(algopy.sin(x))
+            c = algopy.dot(z, z) * z
+            out = algopy.zeros(3, dtype=z)
+            out[0] = c[0]
+            out[1] = x[1] * c[1]
+            out[2] = algopy.sum(x * algopy.exp(z))
+            return algopy.sum(out * out)
+
+        x = numpy.random.random(3)
+        z = numpy.random.random(3)
+
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fz = algopy.Function(z)
+        fy = f(fx, fz)
+        cg.trace_off()
+        cg.independentFunctionList = [fx, fz]
+        cg.dependentFunctionList = [fy]
+
+        gx, gz = cg.gradient([x, z])
+        for i in range(2):
+            assert_array_almost_equal([gx], cg.gradient([x, z], wrt=[fx]))
+            assert_array_almost_equal([gz], cg.gradient([x, z], wrt=[1]))
+            assert_array_almost_equal([gz, gx], cg.gradient([x, z], wrt=[1, 0]))
+
+        # the full tape is not affected
+        assert_array_almost_equal(gx, cg.gradient([x, z])[0])
+
+    def test_threads(self):
+
+        A = [numpy.random.random((3, 3)) + 3*numpy.eye(3) for i in range(4)]
+
+        def f(x):
+            y = algopy.zeros(4, dtype=x)
+            for i in range(4):
+                xi = x[i:i+3].reshape((3, 1))
+                u = algopy.solve(A[i] + algopy.dot(xi, xi.T), xi)
+                y[i] = algopy.sum(algopy.sin(u)) * x[i]
+            return algopy.sum(y * algopy.exp(x[:4])) + algopy.sum(x[1:] * x[:-1])
+
+        x = numpy.random.random(6)
+        cg = self.trace(f, x)
+        g1 = cg.gradient(x)
+        H1 = cg.hessian(x)
+
+        program = cg.compile(threads=4)
+        for i in range(2):
+            assert_array_almost_equal(g1, cg.gradient(x))
+            assert_array_almost_equal(H1, cg.hessian(x))
+
+        # the independent blocks are evaluated in the same levels
+        assert_equal(max([len(level) for level in program.levels]) >= 4, True)
+        assert_equal(sum([len(level) for level in program.levels]), len(program.forward))
+
+        # the setitem instructions and all users of the buffer are ordered
+        position = {}
+        for k, level in enumerate(program.levels):
+            for ins in level:
+                position[ins.result] = k
+        setitems = [ins for ins in program.forward if ins.setitem is not None]
+        assert_equal(len(set([position[ins.result] for ins in setitems])), 4)
+
+        # the instructions of a batch do not share adjoints
+        from algopy.tracer.passes import alias_classes
+        root = alias_classes(cg.functionList)
+        for batch in program.reverse_batches:
+            classes = [set([root[s] for pos, s in ins.slots] + [root[ins.result]])
+                       for ins in batch]
+            assert_equal(len(set.union(*classes)), sum([len(c) for c in classes]))
+
+        program.close()
+
+    def test_close(self):
+        def f(x):
+            return algopy.sum(algopy.sin(x[:3]) * algopy.cos(x[3:]))
+
+        x = numpy.random.random(6)
+        cg = self.trace(f, x)
+        g1 = cg.gradient(x)
+
+        # the thread pool of a replaced program is terminated
+        program = cg.compile(threads=2)
+        assert_array_almost_equal(g1, cg.gradient(x))
+        assert_equal(program._threads is None, False)
+        cg.compile(threads=2)
+        assert_equal(program._threads, None)
+        assert_array_almost_equal(g1, cg.gradient(x))
+        program = cg.program
+        cg.cse()
+        assert_equal(program._threads, None)
+
+        # and so is the thread pool of a program used in a with statement
+        from algopy.tracer.scheduling import ParallelProgram
+        with ParallelProgram(cg.functionList, threads=2) as program:
+            dependent_slots = program.get_slots(cg.dependentFunctionList)
+            program.pushforward([algopy.UTPM.init_jacobian(x)],
+                                program.get_slots(cg.independentFunctionList),
+                                dependent_slots)
+            assert_equal(program._threads is None, False)
+        assert_equal(program._threads, None)
+        y = program.values[dependent_slots[0]]
+        assert_array_almost_equal(g1, algopy.UTPM.extract_jacobian(y))
+
+
+class Test_CGraph_passes(TestCase):
+
+    def trace(self, f, x):
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+        return cg
+
+    def test_cse(self):
+
+        def f(x):
+            # numpy style code that recomputes the same expressions
+            Q = algopy.outer(algopy.exp(x[:3]), algopy.exp(x[:3]))
+            Q = Q * algopy.dot(algopy.exp(x[:3]), x[:3])
+            Q = Q - algopy.outer(algopy.exp(x[:3]), algopy.exp(x[:3]))
+            return algopy.sum(algopy.dot(Q, x[:3]) * algopy.exp(x[:3]))
+
+        x = numpy.random.random(4)
+        cg = self.trace(f, x)
+        N = len(cg.functionList)
+        g1 = cg.gradient(x)
+        H1 = cg.hessian(x)
+
+        stats = cg.cse()
+        assert_equal(stats['nodes'] > 0, True)
+        assert_equal(stats['nbytes'] > 0, True)
+        assert_equal(len(cg.functionList), N - stats['nodes'])
+        assert_equal(cg.pass_statistics['cse'], stats)
+        assert_equal([f.ID for f in cg.functionList], list(range(len(cg.functionList))))
+
+        funcs = [f.func.__name__ for f in cg.functionList]
+        assert_equal(funcs.count('exp'), 1)
+        assert_equal(funcs.count('getitem'), 1)
+        assert_equal(funcs.count('outer'), 1)
+
+        assert_array_almost_equal(g1, cg.gradient(x))
+        assert_array_almost_equal(H1, cg.hessian(x))
+
+        # nothing is left to merge
+        assert_equal(cg.cse()['nodes'], 0)
+
+    def test_cse_setitem(self):
+
+        def f(x):
+            y = algopy.zeros(3, dtype=x)
+            y[0] = x[0]
+            a = algopy.sin(y[0])
+            y[0] = x[1]
+            b = algopy.sin(y[0])
+            return a * b * algopy.sin(x[2]) * algopy.sin(x[2])
+
+        x = numpy.random.random(3)
+        cg = self.trace(f, x)
+        g1 = cg.gradient(x)
+
+        stats = cg.cse()
+        assert_equal(stats['nodes'], 2)
+        assert_array_almost_equal(g1, cg.gradient(x))
+
+    def test_cse_dependent(self):
+        cg = algopy.CGraph()
+        fx = algopy.Function(numpy.random.random(3))
+        fy1 = algopy.sum(algopy.sin(fx))
+        fy2 = algopy.sum(algopy.sin(fx))
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy1, fy2]
+
+        x = numpy.random.random(3)
+        y1 = cg.function([x])
+        assert_equal(cg.cse()['nodes'], 2)
+        assert_equal(cg.dependentFunctionList[1] is fy1, True)
+        assert_array_almost_equal(y1, cg.function([x]))
+
+
+    def test_fold_constants(self):
+        X = numpy.random.random((5, 3))
+        t = numpy.random.random(5)
+        x = numpy.random.random(3)
+
+        cg = algopy.CGraph()
+        fX = algopy.Function(X)
+        ft = algopy.Function(t)
+        fx = algopy.Function(x)
+        XtX = algopy.dot(fX.T, fX)
+        Xtt = algopy.dot(fX.T, ft)
+        buf = algopy.zeros(2, dtype=fx)
+        buf[0] = algopy.sum(fx)
+        buf[1] = algopy.sum(ft)
+        fy = algopy.dot(fx, algopy.dot(XtX, fx)) - 2*algopy.dot(Xtt, fx)
+        fy = fy * algopy.prod(buf)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        g1 = cg.gradient(x)
+        H1 = cg.hessian(x)
+
+        stats = cg.fold_constants()
+        assert_equal(stats['nodes'], 8)
+        assert_equal(stats['nbytes'], 12*8)
+        assert_equal(cg.pass_statistics['fold_constants'], stats)
+        assert_equal(cg.dependentFunctionList[0] is fy, True)
+
+        # the buffer that is modified by setitem is kept
+        assert_equal(any([f is buf for f in cg.functionList]), True)
+
+        for i in range(2):
+            assert_array_almost_equal(g1, cg.gradient(x))
+            assert_array_almost_equal(H1, cg.hessian(x))
+            cg.compile()
+
+        assert_equal(cg.fold_constants()['nodes'], 0)
+
+
+class Test_CGraph_checkpointing(TestCase):
+
+    def trace(self, nsteps, mark):
+        # explicit Euler for the ODE x' = (x_1, -p x_0)
+        cg = algopy.CGraph()
+        fx = algopy.Function(numpy.array([1., 0.]))
+        fp = algopy.Function(3.)
+        y = fx
+        for i in range(nsteps):
+            if mark:
+                cg.mark_step()
+            r = algopy.zeros(2, dtype=y)
+            r[0] = y[1]
+            r[1] = -fp*y[0]
+            y = y + 0.01 * r
+        fz = algopy.sum(y*y) * fp
+        cg.trace_off()
+        cg.independentFunctionList = [fx, fp]
+        cg.dependentFunctionList = [fz]
+        return cg
+
+    def test_revolve_schedule(self):
+        from algopy.tracer.checkpointing import revolve_schedule, binomial
+
+        for n, c in [(1, 1), (7, 1), (10, 2), (50, 2), (50, 3), (20, 20)]:
+            schedule = revolve_schedule(n, c)
+
+            # each step is reversed exactly once and in reverse order
+            assert_equal([a[1] for a in schedule if a[0] == 'reverse'],
+                         list(range(n))[::-1])
+
+            # at most c checkpoints are stored at the same time
+            stored = 0
+            for a in schedule:
+                stored += {'store': 1, 'free': -1}.get(a[0], 0)
+                assert_equal(stored <= c, True)
+
+            # number of step evaluations of the binomial schedule,
+            # i.e. the minimal number of advances plus one tape per step
+            r = 0
+            while binomial(c + r, c) < n:
+                r += 1
+            evaluations = sum([a[2] - a[1] if a[0] == 'advance' else 1
+                               for a in schedule if a[0] in ('advance', 'tape')])
+            assert_equal(evaluations, r*n - binomial(c + r, c + 1) + n)
+
+    def test_marked_steps(self):
+        cg = self.trace(50, True)
+        x = [numpy.array([1., 0.2]), 3.]
+        g1 = cg.gradient(x)
+
+        recomputations = []
+        for c in [1, 2, 5, 50]:
+            program = cg.compile(checkpoints=c)
+            assert_equal(len(program.steps), 50)
+            for i in range(2):
+                g2 = cg.gradient(x)
+                assert_array_almost_equal(g1[0], g2[0])
+                assert_array_almost_equal(g1[1], g2[1])
+            recomputations.append(program.recomputations)
+
+        assert_equal(recomputations, [1225, 285, 122, 49])
+
+    def test_marked_steps_after_cse(self):
+        cg = self.trace(20, True)
+        x = [numpy.array([1., 0.2]), 3.]
+        g1 = cg.gradient(x)
+
+        # -fp is merged into the first step
+        assert_equal(cg.cse()['nodes'], 19)
+        program = cg.compile(checkpoints=2)
+        assert_equal(len(program.steps), 20)
+        assert_equal(len(set([len(step) for step in program.steps[1:-1]])), 1)
+
+        g2 = cg.gradient(x)
+        assert_array_almost_equal(g1[0], g2[0])
+        assert_array_almost_equal(g1[1], g2[1])
+
+    def test_inferred_steps_and_memory_budget(self):
+
+        def f(x):
+            y = x
+            for i in range(30):
+                y = y + 0.1 * algopy.sin(y) * x
+            return algopy.sum(y)
+
+        x = numpy.random.random(3)
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+        g1 = cg.gradient(x)
+        H1 = cg.hessian(x)
+
+        program = cg.compile(checkpoints=3)
+        assert_equal(len(program.steps) >= 30, True)
+        assert_array_almost_equal(g1, cg.gradient(x))
+        assert_array_almost_equal(H1, cg.hessian(x))
+
+        # D*P = 6 Taylor coefficients, a state (y) needs 6*24 bytes and
+        # the values of the largest step 6*104 bytes
+        program = cg.compile(memory_budget=6*(104 + 24) + 100)
+        assert_array_almost_equal(H1, cg.hessian(x))
+        assert_equal(program.snapshots, 1)
+        program = cg.compile(memory_budget=10**6)
+        assert_array_almost_equal(H1, cg.hessian(x))
+        assert_equal(program.snapshots, len(program.steps))
+
+        program = cg.compile(memory_budget=10)
+        assert_raises(ValueError, cg.gradient, x)
+
+    def test_setitem_across_boundaries(self):
+        cg = algopy.CGraph()
+        fx = algopy.Function(numpy.random.random(3))
+        y = algopy.zeros(3, dtype=fx)
+        for i in range(3):
+            cg.mark_step()
+            y[i] = algopy.sin(fx[i])
+        cg.mark_step()
+        fz = algopy.sum(y * fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fz]
+
+        x = numpy.random.random(3)
+        g1 = cg.gradient(x)
+        program = cg.compile(checkpoints=1)
+        assert_array_almost_equal(g1, cg.gradient(x))
+        assert_equal(len(program.steps), 1)
+
+
+class Test_traced(TestCase):
+
+    def test_cache(self):
+        calls = []
+
+        @algopy.traced(maxsize=2, static_argnums=(2,))
+        def f(x, y, p):
+            calls.append(p)
+            return algopy.sum(algopy.exp(x) * y) ** p
+
+        x = numpy.random.random(3)
+        y = numpy.random.random(3)
+
+        assert_almost_equal(f(x, y, 2), numpy.sum(numpy.exp(x) * y)**2)
+        gx, gy = f.gradient(x, y, 2)
+        assert_array_almost_equal(gx, 2*numpy.sum(numpy.exp(x) * y) * numpy.exp(x) * y)
+        assert_array_almost_equal(gy, 2*numpy.sum(numpy.exp(x) * y) * numpy.exp(x))
+        assert_equal(f.cache_info(), (1, 1, 2, 1))
+
+        # new static argument and new shape
+        assert_almost_equal(f(x, y, 1), numpy.sum(numpy.exp(x) * y))
+        assert_almost_equal(f(x[:2], y[:2], 2), numpy.sum(numpy.exp(x[:2]) * y[:2])**2)
+        assert_equal(f.cache_info(), (1, 3, 2, 2))
+
+        # the least recently used CGraph (x.shape == (3,), p == 2) has been evicted
+        f(x, y, 1)
+        f(x, y, 2)
+        assert_equal(f.cache_info(), (2, 4, 2, 2))
+        assert_equal(calls, [2, 1, 2, 2])
+
+        f.cache_clear()
+        assert_equal(f.cache_info(), (0, 0, 2, 0))
+
+    def test_drivers(self):
+
+        @algopy.traced
+        def f(x):
+            return algopy.sum(algopy.sin(x) * x[0])
+
+        @algopy.traced
+        def g(x):
+            return algopy.sin(x) * x[0]
+
+        x = numpy.random.random(3)
+        for i in range(2):
+            assert_array_almost_equal(f.hessian(x), f.hessian(x))
+            assert_array_almost_equal(g.jacobian(x),
+                                      numpy.diag(numpy.cos(x) * x[0]) +
+                                      numpy.outer(numpy.sin(x), [1, 0, 0]))
+            assert_array_almost_equal(g(x), numpy.sin(x) * x[0])
+        H = numpy.diag(-numpy.sin(x) * x[0])
+        H[0, :] += numpy.cos(x)
+        H[:, 0] += numpy.cos(x)
+        assert_array_almost_equal(f.hessian(x), H)
+        assert_equal(f.cache_info().misses, 1)
+        assert_equal(f.__name__, 'f')
+
+
+class Test_CGraph_guards(TestCase):
+
+    def trace(self, f, x):
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+        return cg
+
+    def f(self, x):
+        if x[0] < 0:
+            return algopy.sum(x**2)
+        return algopy.sum(algopy.sin(x) * x[1])
+
+    def test_pushforward_and_drivers(self):
+        cg = self.trace(self.f, numpy.array([-1., 2., 3.]))
+        assert_equal(len(cg.guards), 1)
+
+        x = numpy.array([-2., 1., 0.5])
+        assert_array_almost_equal(cg.gradient(x), 2*x)
+        assert_array_almost_equal(cg.hessian(x), 2*numpy.eye(3))
+
+        y = numpy.array([2., 1., 0.5])
+        assert_raises(algopy.GuardError, cg.gradient, y)
+        assert_raises(algopy.GuardError, cg.hessian, y)
+        assert_raises(algopy.GuardError, cg.function, [y])
+        assert_raises(algopy.GuardError, cg.gradient, y, wrt=[0])
+
+        # the guards are also checked by the compiled program
+        cg.compile()
+        assert_array_almost_equal(cg.gradient(x), 2*x)
+        assert_raises(algopy.GuardError, cg.gradient, y)
+
+    def test_gradient_batch(self):
+        cg = self.trace(self.f, numpy.array([-1., 2., 3.]))
+
+        X = numpy.array([[-2., 1., 0.5], [-1., 2., 3.]])
+        assert_array_almost_equal(cg.gradient_batch(X), 2*X)
+
+        # the second point takes the other branch
+        X = numpy.array([[-2., 1., 0.5], [2., 1., 0.5]])
+        assert_raises(algopy.GuardError, cg.gradient_batch, X)
+        assert_raises(algopy.GuardError, cg.gradient_batch, X[::-1])
+
+        cg.compile()
+        assert_raises(algopy.GuardError, cg.gradient_batch, X)
+
+    def test_constant_operands(self):
+
+        def f(x):
+            c = algopy.Function(numpy.array([1., 2.]))
+            if c[1] > x[0]:
+                return x[0] * c[0]
+            return x[1]
+
+        cg = self.trace(f, numpy.array([1., 2.]))
+        cg.fold_constants()
+        assert_equal(len(cg.guards), 1)
+        assert_almost_equal(cg.function([numpy.array([1.5, 2.])])[0], 1.5)
+        assert_raises(algopy.GuardError, cg.function, [numpy.array([3., 2.])])
+
+    def test_vector_comparison(self):
+
+        def f(x):
+            m = x > 0
+            if m[0] and not m[1]:
+                return algopy.sum(x**2)
+            return algopy.sum(x**3)
+
+        x = numpy.array([1., -2., 3.])
+        cg = self.trace(f, x)
+        assert_equal(len(cg.guards), 1)
+        assert_array_almost_equal(cg.gradient(x), 2*x)
+        assert_array_almost_equal(cg.gradient(numpy.array([2., -1., 1.])), [4., -2., 2.])
+        assert_raises(algopy.GuardError, cg.gradient, numpy.array([1., 2., 3.]))
+
+        @algopy.traced
+        def g(x):
+            return f(x)
+
+        y = numpy.array([1., 2., 3.])
+        assert_array_almost_equal(g.gradient(x), 2*x)
+        assert_array_almost_equal(g.gradient(y), 3*y**2)
+
+    def test_save_load(self):
+        cg = self.trace(self.f, numpy.array([-1., 2., 3.]))
+        fname = os.path.join(Settings.output_dir, 'test_guards.npz')
+        cg.save(fname)
+        try:
+            cg2 = algopy.CGraph.load(fname)
+        finally:
+            os.remove(fname)
+
+        assert_equal(len(cg2.guards), 1)
+        assert_raises(algopy.GuardError, cg2.gradient, numpy.array([2., 1., 0.5]))
+
+    def test_traced_branches(self):
+
+        @algopy.traced
+        def f(x):
+            return self.f(x)
+
+        x = numpy.array([-2., 1., 0.5])
+        y = numpy.array([2., 1., 0.5])
+
+        assert_array_almost_equal(f.gradient(x), 2*x)
+        assert_array_almost_equal(f.gradient(y), numpy.cos(y)*y[1] + [0, numpy.sum(numpy.sin(y)), 0])
+        assert_array_almost_equal(f.gradient(x), 2*x)
+        assert_array_almost_equal(f.gradient(y), numpy.cos(y)*y[1] + [0, numpy.sum(numpy.sin(y)), 0])
+        assert_equal(f.cache_info(), (2, 2, 32, 1))
+
+
+class Test_CGraph_fuse(TestCase):
+
+    def trace(self, f, x):
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+        return cg
+
+    def test_logistic_regression(self):
+        N = 50
+        vY = (numpy.random.random(N) > 0.5) * 1.
+
+        def f(alpha):
+            return algopy.sum(vY*algopy.log1p(algopy.exp(-alpha)) +
+                              (1-vY)*algopy.log1p(algopy.exp(alpha)))
+
+        alpha = numpy.random.random(N)
+        cg = self.trace(f, alpha)
+        g, H = cg.gradient(alpha), cg.hessian(alpha)
+
+        # a small block size forces several blocks per kernel
+        stats = cg.fuse(block_size=40)
+        assert_equal(stats, cg.pass_statistics['fuse'])
+        assert_equal(stats['kernels'], 1)
+        assert_equal(len([f for f in cg.functionList if f.func.__name__ == 'fused']), 1)
+
+        for i in range(2):
+            assert_array_almost_equal(cg.gradient(alpha), g)
+            assert_array_almost_equal(cg.hessian(alpha), H)
+            assert_array_almost_equal(cg.function([alpha])[0], f(alpha))
+            cg.compile()
+
+    def test_shared_intermediate(self):
+
+        def f(x):
+            y = algopy.sin(x) * x
+            z = algopy.exp(y)
+            return algopy.sum(z * y + algopy.sqrt(z))
+
+        x = numpy.random.random(7)
+        cg = self.trace(f, x)
+        H = cg.hessian(x)
+        cg.fuse(block_size=2)
+
+        # y is used twice and the dependent is a sum, hence there are two kernels
+        assert_equal(cg.pass_statistics['fuse']['kernels'], 2)
+        assert_array_almost_equal(cg.hessian(x), H)
+        assert_equal(cg.jacobian_pattern().toarray(), numpy.ones((1, 7)))
+
+    def test_save_fused(self):
+        cg = self.trace(lambda x: algopy.sum(algopy.exp(x) * x), numpy.ones(3))
+        cg.fuse()
+        fname = os.path.join(Settings.output_dir, 'test_fused.npz')
+        assert_raises(ValueError, cg.save, fname)
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+class Test_CGraph_codegen(TestCase):
+
+    def trace(self, f, x):
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+        return cg
+
+    def test_gradient_and_hessian(self):
+        A = numpy.random.random((4, 4))
+
+        def f(x):
+            y = algopy.dot(A, x) * algopy.sin(x)
+            return algopy.sum(y * algopy.exp(-x)) + x[0] * x[1]
+
+        x = numpy.random.random(4)
+        cg = self.trace(f, x)
+        g, H = cg.gradient(x), cg.hessian(x)
+
+        source = cg.to_python_source()
+        assert 'def forward(C, x0):' in source
+        assert 'def reverse(C, saved, ybar0):' in source
+
+        program = cg.codegen()
+        assert_equal(program.source, source)
+        for i in range(2):
+            assert_array_almost_equal(cg.gradient(x), g)
+            assert_array_almost_equal(cg.hessian(x), H)
+
+    def test_setitem_and_views(self):
+
+        def f(x):
+            y = algopy.zeros(3, dtype=x)
+            y[0] = x[0] * x[1]
+            y[1] = algopy.exp(x[2])
+            y[2] = x[1]
+            return algopy.sum(y * y) + algopy.sum(x[1:] * x[:-1])
+
+        x = numpy.random.random(3)
+        cg = self.trace(f, x)
+        g, H = cg.gradient(x), cg.hessian(x)
+        cg.codegen()
+        assert_array_almost_equal(cg.gradient(x), g)
+        assert_array_almost_equal(cg.hessian(x), H)
+
+    def test_module_on_disk(self):
+        A = numpy.random.random((3, 3))
+        cg = self.trace(lambda x: algopy.dot(A, x) * x, numpy.ones(3))
+        x = numpy.random.random(3)
+        J = cg.jacobian(x)
+
+        path = os.path.join(Settings.output_dir, 'test_codegen')
+        bytecode = codegen.cached_bytecode(path + '.py')
+        try:
+            program = cg.codegen(path)
+            assert_array_almost_equal(cg.jacobian(x), J)
+            assert_equal(os.path.exists(bytecode), not sys.dont_write_bytecode)
+
+            # the module can be used without the CGraph
+            C = program.module.constants()
+            (y,), saved = program.module.forward(C, UTPM.init_jacobian(x))
+            assert_array_almost_equal(UTPM.extract_jacobian(y), J)
+
+            # a different module at the same path replaces the cached bytecode
+            cg2 = self.trace(lambda x: algopy.dot(A, x) + x, numpy.ones(3))
+            cg2.codegen(path)
+            assert_array_almost_equal(cg2.jacobian(x), A + numpy.eye(3))
+        finally:
+            for fname in (path + '.py', path + '.npz', bytecode):
+                if os.path.exists(fname):
+                    os.remove(fname)
+
+    def test_fused_on_disk(self):
+        cg = self.trace(lambda x: algopy.sum(algopy.exp(x) * x), numpy.ones(3))
+        cg.fuse()
+        path = os.path.join(Settings.output_dir, 'test_codegen_fused')
+        assert_raises(ValueError, cg.codegen, path)
+        assert not os.path.exists(path + '.py')
+
+        x = numpy.random.random(3)
+        g = cg.gradient(x)
+        cg.codegen()
+        assert_array_almost_equal(cg.gradient(x), g)
+
+
+class Test_CGraph_save_load(TestCase):
+
+    def trace(self, f, x):
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+        return cg
+
+    def save_load(self, cg, mmap_mode=None):
+        fname = os.path.join(Settings.output_dir, 'test_save_load.npz')
+        cg.save(fname)
+        try:
+            return algopy.CGraph.load(fname, mmap_mode=mmap_mode)
+        finally:
+            os.remove(fname)
+
+    def test_gradient_and_hessian(self):
+        A = numpy.random.random((4,4))
+
+        def f(x):
+            y = algopy.dot(A, x)
+            return algopy.sum(algopy.exp(y[1:]) * y[:-1]) + algopy.log(x[0]) / 2.
+
+        x = numpy.random.random(4) + 1
+        cg = self.trace(f, x)
+        cg2 = self.save_load(cg)
+
+        assert_equal(len(cg2.functionList), len(cg.functionList))
+        assert_array_almost_equal(cg.gradient(x), cg2.gradient(x))
+        assert_array_almost_equal(cg.hessian(x), cg2.hessian(x))
+
+    def test_setitem_qr_and_mmap(self):
+
+        def g(x):
+            out = algopy.zeros(3, dtype=x)
+            out[0] = algopy.sin(x[0]*x[1])
+            Q, R = algopy.qr(algopy.outer(x, x) + numpy.eye(3))
+            out[1:] = algopy.diag(R)[1:] * x[2]
+            return out
+
+        x = numpy.random.random(3)
+        cg = self.trace(g, x)
+        J = cg.jacobian(x)
+
+        for mmap_mode in [None, 'r', 'c']:
+            cg2 = self.save_load(cg, mmap_mode=mmap_mode)
+            assert_array_almost_equal(J, cg2.jacobian(x))
+
+        cg2.compile()
+        assert_array_almost_equal(J, cg2.jacobian(x))
+
+    def test_load_keeps_tracing_state(self):
+        cg = self.trace(lambda x: x * x, 3.)
+        assert_equal(Function.cgraph, None)
+        cg2 = self.save_load(cg)
+        assert_equal(Function.cgraph, None)
+        assert_array_almost_equal(cg2.gradient(3.), 6.)
+
+    def test_unsupported_function(self):
+        cg = algopy.CGraph()
+        fx = algopy.Function(3.)
+        fy = Function.pushforward(lambda x: x, [fx])
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+        fname = os.path.join(Settings.output_dir, 'test_save_load.npz')
+        assert_raises(ValueError, cg.save, fname)
+        if os.path.exists(fname):
+            os.remove(fname)
+
 
 class Test_CGraph_Plotting(TestCase):
     def test_simple(self):
@@ -1,3 +1,4 @@
+import time
 import traceback
 import numpy
 import algopy
@@ -6,6 +7,14 @@ from algopy.base_type import Ring
 
 class PlotError(Exception): pass
 
+class GuardError(Exception):
+    """
+    Raised when a CGraph is evaluated at a point where a comparison that
+    has been recorded while tracing has a different outcome, i.e. when the
+    traced function would have taken a different branch.
+    """
+    pass
+
 class NotSet:
     def __init__(self, descr=None):
         if descr is None:
@@ -17,6 +26,88 @@ class NotSet:
 def is_set(o):
     return not isinstance(o, NotSet)
 
+_pullback_registry = {}
+
+def get_pullback_function(xcls, func):
+    """
+    returns the pullback function of func for arguments of class xcls
+
+    For a function ``func`` with ``func.__name__ == 'foo'`` this is the
+    class method ``xcls.pb_foo``, e.g. ``UTPM.pb_foo``.
+    The lookup is done only once per (xcls, func) pair and stored in the
+    module level registry ``_pullback_registry``.
+
+    Callable objects that provide their own pullback as method ``pullback``,
+    e.g. the fused kernels of CGraph.fuse, are not looked up.
+    """
+    if hasattr(func, 'pullback'):
+        return func.pullback
+
+    key = (xcls, func)
+    try:
+        return _pullback_registry[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # func is not hashable
+        return getattr(xcls, 'pb_' + func.__name__)
+
+    f = getattr(xcls, 'pb_' + func.__name__)
+    _pullback_registry[key] = f
+    return f
+
+def _guard_value(x, p=0):
+    """
+    returns the value x as it enters a comparison, i.e. the degree 0
+    coefficient of direction p if x is a UTPM instance
+    """
+    if isinstance(x, algopy.UTPM):
+        return x.data[0, p]
+    return x
+
+
+class Guard(object):
+    """
+    Outcome of a comparison of Function instances during tracing.
+
+    Comparisons like ``x < 0`` usually determine the control flow of the
+    traced function, hence the recorded tape is only valid for inputs
+    for which the comparison has the same outcome.
+
+    Attributes
+    ----------
+    op: callable
+        the comparison, e.g. operator.lt
+    args: list
+        the operands, Function instances on the tape or constants
+    outcome: bool or numpy.ndarray
+        the result of the comparison while tracing, evaluated elementwise
+        on the degree 0 coefficients of UTPM operands
+    """
+
+    def __init__(self, op, args, outcome):
+        self.op = op
+        self.args = args
+        self.outcome = outcome
+
+    def check(self, values):
+        """
+        returns True if op(*values) has the recorded outcome, for UTPM
+        values in all directions, e.g. for all points of
+        CGraph.gradient_batch
+        """
+        P = max([v.data.shape[1] for v in values if isinstance(v, algopy.UTPM)] + [1])
+        for p in range(P):
+            outcome = self.op(*[_guard_value(v, p) for v in values])
+            if not numpy.array_equal(outcome, self.outcome):
+                return False
+        return True
+
+    def __str__(self):
+        args = ['v%s'%a.ID if isinstance(a, Function) else str(a) for a in self.args]
+        return '%s(%s) == %s'%(self.op.__name__, ', '.join(args), self.outcome)
+
+
 class CGraph:
     """
     The CGraph (short for Computational Graph) represents a computational
@@ -50,6 +141,19 @@ class CGraph:
         self.functionList = []
         self.dependentFunctionList = []
         self.independentFunctionList = []
+        self.program = None
+        self._programs = {}
+        self.pass_statistics = {}
+        self.step_marks = []
+        self.jacobian_info = None
+        self._jacobian_timings = {}
+        self._jacobian_pattern = None
+        self._jacobian_coloring = None
+        self.hessian_info = None
+        self._hessian_pattern = None
+        self._hessian_coloring = None
+        self.guards = []
+        self._guard_program = None
         Function.cgraph = self
 
     def trace_on(self):
@@ -63,6 +167,457 @@ class CGraph:
     def append(self, func):
         self.functionCount += 1
         self.functionList.append(func)
+        self._set_program(None)
+        self._programs = {}
+        self._guard_program = None
+        self._jacobian_timings = {}
+        self._jacobian_pattern = None
+        self._jacobian_coloring = None
+        self._hessian_pattern = None
+        self._hessian_coloring = None
+
+    def mark_step(self):
+        """
+        Marks the beginning of a new step, e.g. of a time step of an
+        integrator, at the current position of the tape.
+
+        The step boundaries are used by the checkpointed reverse mode,
+        see CGraph.compile.
+        """
+        self.step_marks.append(len(self.functionList))
+
+    def compile(self, release_buffers=True, wrt=None, checkpoints=None, memory_budget=None,
+                threads=None):
+        """
+        Lowers the recorded computational graph to a linear instruction program.
+
+        After calling compile(), pushforward and pullback (and hence all
+        drivers like gradient, jacobian and hessian) are evaluated by the
+        compiled program instead of walking the functionList.
+        This removes most of the interpretive overhead per node and is
+        worthwhile when the same CGraph is evaluated many times.
+
+        The values of the intermediate nodes are stored in the slots of the
+        program and not in the Function nodes. Only the independent and the
+        dependent Functions are updated by the sweeps.
+
+        If the dependentFunctionList has been set, an activity analysis
+        removes all nodes that do not contribute to the dependent Functions
+        from both sweeps. Nodes that do not depend on the independent
+        Functions selected by wrt are evaluated on the degree 0 coefficients
+        only and are skipped in the reverse sweep.
+
+        Recording further operations discards the program.
+
+        Parameters
+        ----------
+        release_buffers: bool
+            if True, a liveness analysis determines when intermediate values
+            and adjoints are not needed anymore. They are then released
+            during the sweeps and their buffers are recycled for the adjoints
+            (see algopy.tracer.program.Program). This reduces the peak
+            memory, but the intermediate values are not available after the
+            sweeps.
+
+        wrt: None or list of Function instances or int
+            the independent Functions (or their positions in the
+            independentFunctionList) with respect to which derivatives are
+            computed. All independent Functions are used if None.
+            The derivatives w.r.t. the other independent Functions are not
+            computed and their inputs are used at degree 0 only.
+
+        checkpoints: None or int
+            if provided, the reverse sweep uses binomial checkpointing with
+            this number of checkpoints, i.e. only the states at a few step
+            boundaries are stored and the steps are recomputed in reverse
+            order. The step boundaries are marked with CGraph.mark_step()
+            or, if no steps have been marked, inferred from repeated patterns
+            in the tape. See algopy.tracer.checkpointing.
+
+        memory_budget: None or int
+            number of bytes for the checkpoints and the values of one step,
+            the number of checkpoints is derived from it. Implies
+            checkpointing.
+
+        threads: None or int
+            if provided, independent nodes are evaluated concurrently by this
+            number of threads in both sweeps, level by level of the graph.
+            Buffers are not released. Cannot be combined with checkpointing.
+            See algopy.tracer.scheduling.
+
+        Returns
+        -------
+        program: algopy.tracer.program.Program instance,
+            algopy.tracer.checkpointing.CheckpointedProgram instance or
+            algopy.tracer.scheduling.ParallelProgram instance.
+            The CheckpointedProgram provides the number of step evaluations
+            in the last reverse sweep as program.recomputations.
+
+        """
+        self._set_program(self._compile(release_buffers=release_buffers, wrt=wrt,
+                                        checkpoints=checkpoints, memory_budget=memory_budget,
+                                        threads=threads))
+        return self.program
+
+    def _set_program(self, program):
+        """
+        replaces the compiled program, the worker threads of the replaced
+        program (see algopy.tracer.scheduling.ParallelProgram) are terminated
+        """
+        old_program = self.program
+        self.program = program
+        if old_program is not None and old_program is not program:
+            close = getattr(old_program, 'close', None)
+            if close is not None:
+                close()
+
+    def _compile(self, release_buffers=True, wrt=None, checkpoints=None, memory_budget=None,
+                 threads=None):
+        from .program import Program
+        from .checkpointing import CheckpointedProgram, infer_steps
+        from .scheduling import ParallelProgram
+
+        slot_of = {}
+        for n, f in enumerate(self.functionList):
+            slot_of[id(f)] = n
+
+        independent_slots = [slot_of[id(f)] for f in self.independentFunctionList]
+        dependent_slots = None
+        if len(self.dependentFunctionList) > 0:
+            dependent_slots = [slot_of[id(f)] for f in self.dependentFunctionList]
+
+        wrt_slots = None
+        if wrt is not None:
+            wrt_slots = []
+            for w in wrt:
+                if not isinstance(w, Function):
+                    w = self.independentFunctionList[w]
+                if not any([w is f for f in self.independentFunctionList]):
+                    raise ValueError('wrt must only contain independent Functions')
+                wrt_slots.append(slot_of[id(w)])
+
+        if threads is not None:
+            if checkpoints is not None or memory_budget is not None:
+                raise ValueError('threads cannot be combined with checkpointing')
+            return ParallelProgram(self.functionList, independent_slots, dependent_slots,
+                                   wrt_slots, threads=threads)
+
+        if checkpoints is None and memory_budget is None:
+            return Program(self.functionList, independent_slots, dependent_slots,
+                           wrt_slots, release_buffers=release_buffers)
+
+        program = CheckpointedProgram(self.functionList, independent_slots, dependent_slots,
+                                      wrt_slots, checkpoints=checkpoints,
+                                      memory_budget=memory_budget)
+
+        if self.step_marks:
+            # positions of the marks in the list of forward instructions
+            boundaries = [len([ins for ins in program.forward if ins.result < m])
+                          for m in self.step_marks]
+        else:
+            boundaries = infer_steps([ins.opcode for ins in program.forward])
+
+        program.set_boundaries(boundaries)
+        return program
+
+    def _get_program(self, wrt):
+        """ returns a program that only computes derivatives w.r.t. wrt """
+        key = tuple([w if isinstance(w, int) else id(w) for w in wrt])
+        program = self._programs.get(key)
+        if program is None:
+            program = self._compile(wrt=wrt)
+            self._programs[key] = program
+        return program
+
+    def _replace_nodes(self, replacement, old_functionList):
+        """
+        rewires the dependent Functions after nodes of old_functionList
+        have been removed
+        """
+        self.functionCount = len(self.functionList)
+        self.dependentFunctionList = [replacement.get(id(f), f)
+                                      for f in self.dependentFunctionList]
+        self._set_program(None)
+        self._programs = {}
+
+        # a step mark is the number of nodes before the step, i.e. it
+        # becomes the number of nodes before it that are still on the tape
+        on_tape = set([id(f) for f in self.functionList])
+        kept = numpy.cumsum([0] + [id(f) in on_tape for f in old_functionList])
+        self.step_marks = [int(kept[m]) for m in self.step_marks]
+
+        # operands that have been folded to constants cannot change their value,
+        # guards that only compare constants are dropped
+        guards = []
+        for g in self.guards:
+            args = []
+            for a in g.args:
+                if isinstance(a, Function):
+                    a = replacement.get(id(a), a)
+                    if id(a) not in on_tape:
+                        a = a.x
+                args.append(a)
+            if any([isinstance(a, Function) for a in args]):
+                guards.append(Guard(g.op, args, g.outcome))
+        self.guards = guards
+        self._guard_program = None
+
+    def add_guard(self, op, args, outcome):
+        """
+        Records that op(*args) had the value outcome while tracing,
+        see Function.__lt__ and CGraph.check_guards.
+        """
+        self.guards.append(Guard(op, args, outcome))
+        self._guard_program = None
+
+    def check_guards(self, x_list):
+        """
+        Checks that all recorded comparisons (guards) have the same outcome
+        for the inputs x_list as while tracing, i.e. that the tape is valid
+        at x_list.
+
+        Only the nodes the guards depend on are evaluated, on the degree 0
+        coefficients. This is done by a separate compiled program before
+        the actual pushforward, hence a failed check does not modify the
+        values of the CGraph. CGraph.pushforward (and hence all drivers)
+        calls this function.
+
+        Raises
+        ------
+        GuardError
+            if a comparison has a different outcome
+        """
+
+        if not self.guards:
+            return
+
+        program = self._guard_program
+        if program is None:
+            from .program import Program
+            program = Program(self.functionList,
+                              self._get_slots(self.independentFunctionList),
+                              self._get_slots([a for g in self.guards for a in g.args
+                                                   if isinstance(a, Function)]),
+                              release_buffers=False)
+            self._guard_program = program
+
+        independent_slots = program.get_slots(self.independentFunctionList)
+        program.pushforward([x.__class__(x.data[:1]) if isinstance(x, algopy.UTPM) else x
+                             for x in x_list], independent_slots)
+
+        for ng, g in enumerate(self.guards):
+            values = [program.values[program.slot_of[id(a)]] if isinstance(a, Function) else a
+                      for a in g.args]
+            if not g.check(values):
+                err_str = 'guard %d failed: the recorded comparison %s does not hold '\
+                          'for the provided inputs, the traced function takes a '\
+                          'different branch. Trace the function again, e.g. with '\
+                          'algopy.traced.'%(ng, g)
+                raise GuardError(err_str)
+
+    def cse(self):
+        """
+        Common subexpression elimination.
+
+        Nodes that evaluate the same function of the same arguments
+        (Function arguments and equal constant arguments) are merged and
+        their consumers are rewired, see
+        algopy.tracer.passes.common_subexpression_elimination.
+
+        Function instances that have been removed from the tape are not
+        updated by later sweeps. A previously compiled program is discarded.
+
+        Returns
+        -------
+        stats: dict
+            'nodes': number of removed nodes and 'nbytes': the number of bytes
+            of their values. The statistics are also stored in
+            self.pass_statistics['cse'].
+
+        Example
+        -------
+
+        >>> cg = algopy.CGraph()
+        >>> x = algopy.Function(numpy.ones(3))
+        >>> y = algopy.sum(algopy.exp(x) * algopy.exp(x))
+        >>> cg.trace_off()
+        >>> cg.independentFunctionList = [x]
+        >>> cg.dependentFunctionList = [y]
+        >>> cg.cse()['nodes']
+        1
+        """
+        from .passes import common_subexpression_elimination
+        old_functionList = list(self.functionList)
+        replacement, stats = common_subexpression_elimination(self.functionList)
+        self._replace_nodes(replacement, old_functionList)
+        self.pass_statistics['cse'] = stats
+        return stats
+
+    def fold_constants(self):
+        """
+        Constant folding.
+
+        The parts of the computational graph that do not depend on the
+        independent Functions (e.g. products of constant design matrices)
+        are evaluated once and their values are stored as constant arguments
+        of their consumers. The folded nodes are removed from the tape, see
+        algopy.tracer.passes.fold_constants.
+
+        A previously compiled program is discarded.
+
+        Returns
+        -------
+        stats: dict
+            'nodes': number of removed nodes and 'nbytes': the number of bytes
+            of the folded values. The statistics are also stored in
+            self.pass_statistics['fold_constants'].
+        """
+        from .passes import fold_constants
+
+        slot_of = {}
+        for n, f in enumerate(self.functionList):
+            slot_of[id(f)] = n
+
+        old_functionList = list(self.functionList)
+        folded, stats = fold_constants(self.functionList,
+                                       [slot_of[id(f)] for f in self.independentFunctionList],
+                                       [slot_of[id(f)] for f in self.dependentFunctionList])
+        self._replace_nodes({}, old_functionList)
+        self.pass_statistics['fold_constants'] = stats
+        return stats
+
+    def fuse(self, block_size=2**15):
+        """
+        Fusion of elementwise operations.
+
+        Maximal trees of elementwise nodes (e.g. exp, log1p, mul, add) whose
+        intermediate values are used only once are replaced by single nodes
+        that evaluate the whole tree block by block, i.e. the intermediate
+        values are never stored at full size. The pullback is fused the same
+        way. See algopy.tracer.fusion.
+
+        The independent and dependent Functions and the operands of guards
+        are not fused. A previously compiled program is discarded.
+        A fused CGraph cannot be saved.
+
+        Parameters
+        ----------
+        block_size: int
+            number of entries of the UTPM data of an intermediate value of
+            one block, i.e. D*P*(block length)
+
+        Returns
+        -------
+        stats: dict
+            'nodes': number of removed nodes, 'nbytes': the number of bytes
+            of their values and 'kernels': the number of fused nodes.
+            The statistics are also stored in self.pass_statistics['fuse'].
+        """
+        from .fusion import fuse_elementwise
+
+        protected = self.independentFunctionList + self.dependentFunctionList + \
+                    [a for g in self.guards for a in g.args if isinstance(a, Function)]
+        old_functionList = list(self.functionList)
+        stats = fuse_elementwise(self.functionList, self._get_slots(protected),
+                                 block_size=block_size)
+        self._replace_nodes({}, old_functionList)
+        self.pass_statistics['fuse'] = stats
+        return stats
+
+    def to_python_source(self):
+        """
+        Returns Python source code that evaluates the forward and the
+        reverse sweep of the computational graph as straight-line code.
+
+        The module defines the functions forward(C, x_0, ...) and
+        reverse(C, saved, ybar_0, ...), where C is the list of constants
+        that cannot be written as literals. See algopy.tracer.codegen.
+        """
+        from .codegen import generate
+
+        program = self._compile(release_buffers=False)
+        source, constants = generate(program,
+                                     program.get_slots(self.independentFunctionList),
+                                     program.get_slots(self.dependentFunctionList))
+        return source
+
+    def codegen(self, path=None):
+        """
+        Generates and compiles Python source code for the sweeps of the
+        computational graph, see CGraph.to_python_source.
+
+        Afterwards, pushforward and pullback (and hence all drivers like
+        gradient, jacobian and hessian) are evaluated by the generated code,
+        as after CGraph.compile(). Only the independent and the dependent
+        Functions are updated by the sweeps.
+
+        Parameters
+        ----------
+        path: None or str
+            if provided, the source is written to path + '.py' (only if it
+            has changed) and imported, and the constants are written to
+            path + '.npz'. The module can then be imported on its own, its
+            function constants() loads C. Raises a ValueError if a constant
+            cannot be saved, e.g. after CGraph.fuse().
+
+        Returns
+        -------
+        program: algopy.tracer.codegen.GeneratedProgram instance
+            the source is available as program.source
+        """
+        from .codegen import GeneratedProgram
+
+        if len(self.dependentFunctionList) == 0:
+            raise ValueError('the dependentFunctionList must be set before '
+                             'CGraph.codegen() is called')
+
+        program = self._compile(release_buffers=False)
+        self._set_program(GeneratedProgram(program,
+                                           program.get_slots(self.independentFunctionList),
+                                           program.get_slots(self.dependentFunctionList),
+                                           path=path))
+        return self.program
+
+    def save(self, path):
+        """
+        Writes the computational graph to the file path.
+
+        The file is an uncompressed .npz container with a JSON description
+        of the nodes, opcodes and argument wiring and the constant arrays.
+        See algopy.tracer.serialization for a description of the format.
+
+        Example:
+
+            cg.save('objective.npz')
+            cg2 = algopy.CGraph.load('objective.npz', mmap_mode='r')
+            cg2.gradient(x)
+
+        """
+        from .serialization import save
+        save(self, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+        Reads a computational graph that has been written with CGraph.save.
+
+        The traced Python function is not executed again.
+
+        Parameters
+        ----------
+        path: str
+            filename
+        mmap_mode: None, 'r' or 'c'
+            if not None, the constant arrays are memory-mapped from the file,
+            see numpy.memmap. This allows many processes to share one tape file.
+
+        Returns
+        -------
+        cg: CGraph instance
+
+        """
+        from .serialization import load
+        return load(path, mmap_mode=mmap_mode)
 
     def __str__(self):
         retval = '\n\n'
@@ -86,6 +641,11 @@ class CGraph:
         retval += '\n\nDependent Function List:\n'
         retval += str([f.ID for f in self.dependentFunctionList])
         retval += '\n'
+
+        if self.guards:
+            retval += '\nGuards:\n'
+            retval += '\n'.join([str(g) for g in self.guards])
+            retval += '\n'
         return retval
 
     def pushforward(self,x_list):
@@ -95,7 +655,16 @@ class CGraph:
 
         At first, the arguments of the global functions are read into the independent functions.
         Then the computational graph is walked and at each function node
+
+        If comparisons have been recorded while tracing, they are checked
+        first and a GuardError is raised if the inputs x_list take a
+        different branch, see CGraph.check_guards.
         """
+        self.check_guards(x_list)
+
+        if self.program is not None:
+            return self._pushforward_program(self.program, x_list)
+
         # populate independent arguments with new values
         for nf,f in enumerate(self.independentFunctionList):
             f.args[0].x = x_list[nf]
@@ -105,8 +674,8 @@ class CGraph:
             try:
                 f.__class__.pushforward(f.func, f.args, Fout = f)
             except Exception as e:
-                err_str = 'pushforward of node %d failed (%s)'%(nf,f.func.__name__)
-                err_str += 'reported error is:\n%s'%e
+                err_str = 'pushforward of node %d failed (%s)\n'%(nf,f.func.__name__)
+                err_str += 'reported error is:\n%s\n'%e
                 err_str += 'traceback:\n%s'%traceback.format_exc()
 
                 raise Exception(err_str)
@@ -128,12 +697,13 @@ class CGraph:
 
         """
 
-        import time
-
         if len(self.dependentFunctionList) == 0:
             raise Exception('You forgot to specify which variables are dependent!\n'\
                             ' e.g. with cg.dependentFunctionList = [F1,F2]')
 
+        if self.program is not None:
+            return self._pullback_program(self.program, xbar_list)
+
         # initial all xbar to zero
         for f in self.functionList:
             # print 'f=',f.func.__name__
@@ -175,6 +745,30 @@ class CGraph:
                 raise Exception(err_str)
             # print self
 
+    def _check_program(self, program):
+        independent_slots = program.get_slots(self.independentFunctionList)
+        dependent_slots = program.get_slots(self.dependentFunctionList)
+
+        if program.dependent_slots is not None and \
+           (program.dependent_slots != dependent_slots or
+            program.independent_slots != independent_slots):
+            raise ValueError('the independentFunctionList or dependentFunctionList '
+                             'has changed since CGraph.compile() has been called')
+
+        return independent_slots, dependent_slots
+
+    def _pushforward_program(self, program, x_list):
+        independent_slots, dependent_slots = self._check_program(program)
+        program.pushforward(x_list, independent_slots, dependent_slots)
+        for f in self.independentFunctionList + self.dependentFunctionList:
+            f.x = program.values[program.slot_of[id(f)]]
+
+    def _pullback_program(self, program, xbar_list):
+        independent_slots, dependent_slots = self._check_program(program)
+        program.pullback(xbar_list, dependent_slots, independent_slots)
+        for f in self.independentFunctionList + self.dependentFunctionList:
+            f.xbar = program.adjoints[program.slot_of[id(f)]]
+
     def function(self, x_list):
         """ computes the function of a function y = f(x_list), where y is a scalar
         and x_list is a list or tuple of input arguments.
@@ -189,7 +783,7 @@ class CGraph:
 
 
 
-    def gradient(self, x):
+    def gradient(self, x, wrt=None):
         """ computes the gradient of a function f: R^N --> R
 
         g = gradient(self, x_list)
@@ -199,6 +793,12 @@ class CGraph:
 
         x: array_like or list of array_like
 
+        wrt: None or list of Function instances or int
+            if provided, only the gradient w.r.t. these independent Functions
+            (or their positions in the independentFunctionList) is computed
+            and returned as list. The tape is pruned accordingly, see
+            CGraph.compile. x must still contain all independent variables.
+
 
         Example 1
         ---------
@@ -250,10 +850,20 @@ class CGraph:
             element = numpy.asarray(xi).reshape((1,1) + numpy.shape(xi))
             utpm_x_list.append(algopy.UTPM(element))
 
-        self.pushforward(utpm_x_list)
+        if wrt is not None:
+            program = self._get_program(wrt)
+            self.check_guards(utpm_x_list)
+            self._pushforward_program(program, utpm_x_list)
+        else:
+            self.pushforward(utpm_x_list)
 
         ybar =  self.dependentFunctionList[0].x.zeros_like()
         ybar.data[0,:] = 1.
+
+        if wrt is not None:
+            self._pullback_program(program, [ybar])
+            return [program.adjoints[s].data[0,0] for s in program.wrt_slots]
+
         self.pullback([ybar])
 
         if isinstance(x, list):
@@ -261,8 +871,140 @@ class CGraph:
         else:
             return self.independentFunctionList[0].xbar.data[0,0]
 
-    def jacobian(self, x):
-        """ computes the Jacobian of a function F:R^N --> R^M in the reverse mode
+    def gradient_batch(self, X):
+        """ computes the gradients of a function f: R^N --> R at many points
+
+        G = gradient_batch(self, X)
+
+        All points are propagated through a single pushforward and a single
+        pullback: the points are stored as the degree 0 coefficients of the
+        P directions of the UTPM instances, i.e. the P axis of the
+        (D,P,...) layout is used as batch axis. This amortizes the
+        per-node overhead of the sweeps over the whole batch.
+
+        Parameters
+        ----------
+
+        X: array_like or list of array_like
+            X[b] is the b-th point, i.e. X.shape = (B,) + x.shape.
+            If there is more than one independent Function, X is a list
+            and X[i][b] is the value of the i-th independent Function at the
+            b-th point.
+
+        Returns
+        -------
+
+        G: array or list of arrays
+            G[b] is the gradient at the b-th point, G.shape = (B,) + x.shape
+
+        Raises
+        ------
+
+        GuardError
+            if a recorded comparison has a different outcome at one of the
+            points, see CGraph.check_guards
+
+
+        Example
+        -------
+
+        import algopy
+
+        def f(x):
+            return x[0]*x[1]
+
+        cg = algopy.CGraph()
+        x = algopy.Function([3., 7.])
+        y = f(x)
+        cg.trace_off()
+        cg.independentFunctionList = [x]
+        cg.dependentFunctionList = [y]
+        print cg.gradient_batch([[1.,2.], [3., 4.], [5., 6.]])
+        """
+
+        if self.dependentFunctionList[0].ndim != 0:
+            raise Exception('you are trying to compute the gradient of a non-scalar valued function')
+
+        if isinstance(X, list) and len(self.independentFunctionList) > 1:
+            X_list = [numpy.asarray(Xi) for Xi in X]
+        else:
+            X_list = [numpy.asarray(X)]
+
+        if len(X_list) != len(self.independentFunctionList):
+            err_str = 'expected points for %d independent Functions but provided %d'%(
+                       len(self.independentFunctionList), len(X_list))
+            raise ValueError(err_str)
+
+        B = X_list[0].shape[0]
+        utpm_x_list = []
+        for Xi in X_list:
+            if Xi.shape[0] != B:
+                raise ValueError('all inputs must have the same batch size %d'%B)
+            utpm_x_list.append(algopy.UTPM(Xi.reshape((1,) + Xi.shape)))
+
+        self.pushforward(utpm_x_list)
+
+        ybar = self.dependentFunctionList[0].x.zeros_like()
+        ybar.data[0,:] = 1.
+        self.pullback([ybar])
+
+        G = [f.xbar.data[0] for f in self.independentFunctionList]
+        if len(self.independentFunctionList) > 1:
+            return G
+        else:
+            return G[0]
+
+    def jacobian_cost(self, N, M):
+        """ estimates the cost of the Jacobian of F:R^N --> R^M in both modes
+
+        The forward mode propagates N directions of degree 1 through the
+        tape, the reverse mode propagates M adjoint directions through the
+        pushforward (degree 0) and the pullback. The cost of each node is
+        modelled as a fixed overhead plus a term proportional to the size
+        of its value (taken from the traced values) and to the number of
+        directions.
+
+        If the Jacobian has been calibrated by a trial run
+        (jacobian(x, mode='auto', calibrate=True)), the measured run times
+        in seconds are returned instead.
+
+        Parameters
+        ----------
+        N: int
+            number of independent variables
+        M: int
+            number of dependent variables
+
+        Returns
+        -------
+        info: dict
+            'forward' and 'reverse': the estimated costs,
+            'mode': the cheaper mode,
+            'calibrated': True if the costs are measured run times,
+            'nodes': number of nodes of the tape,
+            'size': sum of the sizes of the values of the nodes
+        """
+
+        from .passes import tape_size, jacobian_cost_model
+
+        nodes, size = tape_size(self.functionList)
+
+        timings = self._jacobian_timings.get((N, M))
+        if timings is not None:
+            cost_forward, cost_reverse = timings
+        else:
+            cost_forward, cost_reverse = jacobian_cost_model(nodes, size, N, M)
+
+        return {'forward': cost_forward,
+                'reverse': cost_reverse,
+                'mode': 'forward' if cost_forward < cost_reverse else 'reverse',
+                'calibrated': timings is not None,
+                'nodes': nodes,
+                'size': size}
+
+    def jacobian(self, x, mode='reverse', calibrate=False, chunk_size=None,
+                 memory_budget=None):
+        """ computes the Jacobian of a function F:R^N --> R^M
 
         J = self.jacobian(x)
 
@@ -275,6 +1017,35 @@ class CGraph:
         x: array_like or UTPM instance
             x.ndim = 1
 
+        mode: str
+            'reverse': M adjoint directions are propagated in the reverse mode,
+            'forward': N directions are propagated in the forward mode,
+            'auto': the cheaper mode is chosen based on the cost estimate
+            of CGraph.jacobian_cost. The chosen mode and the estimated costs
+            are stored in self.jacobian_info.
+            The Taylor series of the Jacobian (x is a UTPM instance) is always
+            computed in the reverse mode.
+
+        calibrate: bool
+            only used if mode == 'auto'. If True and the CGraph has not been
+            calibrated for the current N and M yet, both modes are timed
+            in a trial run and the measured times are used for all further
+            calls with the same N and M.
+
+        chunk_size: None or int
+            if provided, at most chunk_size directions are propagated at once,
+            i.e. the N directions of the forward mode or the M adjoint
+            directions of the reverse mode are processed in chunks and the
+            Jacobian is assembled block by block. In the reverse mode, the
+            pushforward is done only once and its values are reused for the
+            pullbacks of all chunks. Not available for UTPM instances x.
+
+        memory_budget: None or int
+            number of bytes for the values and the adjoints (or derivatives)
+            of the nodes, the chunk_size is derived from it. The size of the
+            values is estimated from the traced values. Raises a ValueError
+            if the budget is too small for a single direction.
+
         Returns
         -------
         J: array_like or UTPM instance
@@ -310,11 +1081,22 @@ class CGraph:
                        len(self.dependentFunctionList)
             raise ValueError(err_str)
 
+        if mode not in ('reverse', 'forward', 'auto'):
+            raise ValueError("mode must be 'reverse', 'forward' or 'auto' but provided %r"%mode)
+
         if isinstance(x, algopy.UTPM):
 
             if x.ndim != 1:
                 raise ValueError("x.ndim must be 1 but provided %d"%x.ndim)
-                
+
+            if mode == 'forward':
+                raise NotImplementedError('the Taylor series of the Jacobian is '
+                                          'only available in the reverse mode')
+
+            if chunk_size is not None or memory_budget is not None:
+                raise NotImplementedError('the Taylor series of the Jacobian '
+                                          'cannot be computed in chunks')
+
             M = self.dependentFunctionList[0].size
 
             D,P = x.data.shape[:2]
@@ -349,19 +1131,245 @@ class CGraph:
                 raise ValueError("x.ndim must be 1 but provided %d"%x.ndim)
 
             M = self.dependentFunctionList[0].size
+            chunk_size = self._jacobian_chunk_size(chunk_size, memory_budget)
+
+            if mode == 'auto':
+                N = x.size
+                if calibrate and (N, M) not in self._jacobian_timings:
+                    start_time = time.time()
+                    self._jacobian_forward(x, M, chunk_size)
+                    t_forward = time.time() - start_time
+                    start_time = time.time()
+                    self._jacobian_reverse(x, M, chunk_size)
+                    t_reverse = time.time() - start_time
+                    self._jacobian_timings[(N, M)] = (t_forward, t_reverse)
+
+                self.jacobian_info = self.jacobian_cost(N, M)
+                mode = self.jacobian_info['mode']
+
+            if mode == 'forward':
+                return self._jacobian_forward(x, M, chunk_size)
+            else:
+                return self._jacobian_reverse(x, M, chunk_size)
 
-            tmp = numpy.zeros((1,M) + numpy.shape(x))
-            tmp[0,...] = x
-            utpm_x_list = [algopy.UTPM(tmp)]
+    def _jacobian_chunk_size(self, chunk_size, memory_budget):
+        """
+        returns the number of directions per chunk of the Jacobian drivers,
+        None means that all directions are propagated at once
+        """
 
-            self.pushforward(utpm_x_list)
+        from .passes import tape_size
+
+        if memory_budget is not None:
+            # per direction, each node stores the values and the adjoints
+            # (reverse mode) or two Taylor coefficients (forward mode)
+            nodes, size = tape_size(self.functionList)
+            direction_bytes = 2 * numpy.dtype(float).itemsize * max(size, 1)
+            budget_size = int(memory_budget // direction_bytes)
+            if budget_size < 1:
+                raise ValueError('the memory_budget of %d bytes is too small, at least '
+                                 '%d bytes are required'%(memory_budget, direction_bytes))
+            if chunk_size is None or budget_size < chunk_size:
+                chunk_size = budget_size
+
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError('chunk_size must be positive but provided %r'%chunk_size)
+
+        return chunk_size
+
+    def _jacobian_forward(self, x, M, chunk_size=None):
+        """ Jacobian in the forward mode with N directions, chunk_size at once """
+        N = x.size
+        if chunk_size is None or chunk_size >= N:
+            self.pushforward([algopy.UTPM.init_jacobian(x)])
+            y = self.dependentFunctionList[0].x
+            return y.data[1].reshape((N, M)).T.copy()
+
+        J = None
+        tmp = numpy.zeros((2, chunk_size) + x.shape)
+        tmp[0, ...] = x
+        for start in range(0, N, chunk_size):
+            K = min(chunk_size, N - start)
+            tmp[1, ...] = 0
+            tmp[1, numpy.arange(K), start + numpy.arange(K)] = 1.
+            self.pushforward([algopy.UTPM(tmp)])
+
+            y = self.dependentFunctionList[0].x
+            if J is None:
+                J = numpy.empty((M, N), dtype=y.data.dtype)
+            J[:, start:start + K] = y.data[1, :K].reshape((K, M)).T
+
+        return J
+
+    def _jacobian_reverse(self, x, M, chunk_size=None):
+        """
+        Jacobian in the reverse mode with M adjoint directions, chunk_size at
+        once. The pushforward is done once for all chunks.
+        """
+        if chunk_size is None or chunk_size >= M:
+            chunk_size = M
 
+        tmp = numpy.zeros((1,chunk_size) + numpy.shape(x))
+        tmp[0,...] = x
+        utpm_x_list = [algopy.UTPM(tmp)]
+
+        self.pushforward(utpm_x_list)
+
+        if chunk_size == M:
             ybar =  algopy.UTPM(numpy.zeros((1,M,M)))
             ybar.data[0,:,:] = numpy.eye(M)
             self.pullback([ybar])
 
             return self.independentFunctionList[0].xbar.data[0,:]
 
+        J = None
+        for start in range(0, M, chunk_size):
+            K = min(chunk_size, M - start)
+            ybar = algopy.UTPM(numpy.zeros((1,chunk_size,M)))
+            ybar.data[0, numpy.arange(K), start + numpy.arange(K)] = 1.
+            self.pullback([ybar])
+
+            xbar = self.independentFunctionList[0].xbar
+            if J is None:
+                J = numpy.empty((M,) + numpy.shape(x), dtype=xbar.data.dtype)
+            J[start:start + K] = xbar.data[0, :K]
+
+        return J
+
+    def jacobian_pattern(self):
+        """ detects the sparsity pattern of the Jacobian of F:R^N --> R^M
+
+        The index sets of the independent variables are propagated through
+        the tape, see algopy.tracer.sparsity. The pattern does not depend on
+        the point of evaluation and is cached on the CGraph until the tape
+        changes. It is used by sparse_jacobian if no pattern is provided.
+
+        Returns
+        -------
+        pattern: scipy.sparse.csr_matrix
+            shape (M, N), entries 1 at the structural nonzeros, where M and N
+            are the total sizes of the dependent and the independent Functions
+        """
+
+        from .sparsity import propagate_patterns
+
+        if self._jacobian_pattern is None:
+            self._jacobian_pattern = propagate_patterns(
+                self.functionList, self._get_slots(self.independentFunctionList),
+                self._get_slots(self.dependentFunctionList))[0]
+
+        return self._jacobian_pattern
+
+    def _get_slots(self, functions):
+        slot_of = {}
+        for n, f in enumerate(self.functionList):
+            slot_of[id(f)] = n
+        return [slot_of[id(f)] for f in functions]
+
+    def sparse_jacobian(self, x, pattern=None, mode='auto'):
+        """ computes a sparse Jacobian of a function F:R^N --> R^M
+
+        J = self.sparse_jacobian(x)
+
+        Structurally orthogonal columns (rows) of the Jacobian are grouped by
+        a distance-2 coloring (Curtis-Powell-Reid) and evaluated together,
+        i.e. the forward mode propagates one direction per column color and the
+        reverse mode one adjoint direction per row color, see
+        algopy.tracer.coloring.
+
+        Parameters
+        ----------
+        x: array_like
+            x.ndim = 1
+
+        pattern: scipy.sparse matrix, array_like or None
+            sparsity pattern of the Jacobian, shape (M, N). If None, the
+            pattern is detected by CGraph.jacobian_pattern.
+
+        mode: str
+            'forward': column compression in the forward mode,
+            'reverse': row compression in the reverse mode,
+            'auto': the mode with fewer colors is chosen.
+            The chosen mode and the numbers of colors are stored in
+            self.jacobian_info.
+
+        Returns
+        -------
+        J: scipy.sparse.csr_matrix
+            the Jacobian evaluated at x, shape (M, N)
+        """
+
+        from .coloring import (as_pattern, column_coloring, row_coloring,
+                               seed_matrix, recover_columns, recover_rows)
+
+        if len(self.independentFunctionList) != 1:
+            err_str = 'len(self.independentFunctionList) must be 1 but provided %d' % \
+                       len(self.independentFunctionList)
+            raise ValueError(err_str)
+
+        if len(self.dependentFunctionList) != 1:
+            err_str = 'len(self.dependentFunctionList) must be 1 but provided %d' % \
+                       len(self.dependentFunctionList)
+            raise ValueError(err_str)
+
+        if mode not in ('reverse', 'forward', 'auto'):
+            raise ValueError("mode must be 'reverse', 'forward' or 'auto' but provided %r"%mode)
+
+        x = numpy.asarray(x, dtype=float)
+
+        if x.ndim != 1:
+            raise ValueError("x.ndim must be 1 but provided %d"%x.ndim)
+
+        N = x.size
+        M = self.dependentFunctionList[0].size
+
+        if pattern is None:
+            pattern = self.jacobian_pattern()
+        else:
+            pattern = as_pattern(pattern)
+
+        if pattern.shape != (M, N):
+            raise ValueError('pattern.shape must be %s but provided %s'%((M, N), pattern.shape))
+
+        # the colorings only depend on the pattern and are cached
+        key = id(pattern) if pattern is self._jacobian_pattern else None
+        coloring = self._jacobian_coloring
+        if key is None or coloring is None or coloring[0] != key:
+            coloring = (key, column_coloring(pattern), row_coloring(pattern))
+            if key is not None:
+                self._jacobian_coloring = coloring
+        column_colors, row_colors = coloring[1:]
+
+        p_forward = column_colors.max() + 1 if N > 0 else 0
+        p_reverse = row_colors.max() + 1 if M > 0 else 0
+
+        if mode == 'auto':
+            mode = 'forward' if p_forward <= p_reverse else 'reverse'
+
+        self.jacobian_info = {'mode': mode,
+                              'forward': p_forward,
+                              'reverse': p_reverse}
+
+        if mode == 'forward':
+            S = seed_matrix(column_colors)
+            tmp = numpy.zeros((2, S.shape[1], N))
+            tmp[0, ...] = x
+            tmp[1, ...] = S.T
+            self.pushforward([algopy.UTPM(tmp)])
+            B = self.dependentFunctionList[0].x.data[1].reshape((S.shape[1], M)).T
+            return recover_columns(pattern, column_colors, B)
+
+        else:
+            W = seed_matrix(row_colors)
+            tmp = numpy.zeros((1, W.shape[1], N))
+            tmp[0, ...] = x
+            self.pushforward([algopy.UTPM(tmp)])
+            ybar = self.dependentFunctionList[0].x.zeros_like()
+            ybar.data[0, ...] = W.T.reshape(ybar.data.shape[1:])
+            self.pullback([ybar])
+            C = self.independentFunctionList[0].xbar.data[0]
+            return recover_rows(pattern, row_colors, C)
+
     def jac_vec(self, x, v):
         """ computes the Jacobian-vector product J*v of a function
         F:R^N --> R^M in the forward mode
@@ -405,6 +1413,49 @@ class CGraph:
         self.pushforward(utpm_x_list)
         return  self.dependentFunctionList[0].x.data[1,0,...]
 
+    def jac_mat(self, x, V):
+        """ computes the Jacobian-matrix product J*V of a function
+        F:R^N --> R^M in the forward mode
+
+        JV = self.jac_mat(x, V)
+
+        The K columns of V are propagated at once as K directions of a single
+        pushforward.
+
+        Parameters
+        ----------
+        x: array_like
+            x.ndim = 1
+
+        V: array_like
+            V.shape = (N, K)
+
+        Returns
+        -------
+        JV: array_like
+            the Jacobian-matrix product, JV.shape = (M, K)
+        """
+
+        x = numpy.asarray(x)
+        V = numpy.asarray(V)
+
+        if x.ndim != 1:
+            raise ValueError("x.ndim must be 1 but provided %d"%x.ndim)
+
+        if V.ndim != 2 or V.shape[0] != x.size:
+            raise ValueError("V.shape must be (%d, K) but provided V.shape=%s"%(x.size, V.shape))
+
+        K = V.shape[1]
+
+        tmp = numpy.zeros((2,K) + numpy.shape(x))
+        tmp[0,...] = x
+        tmp[1,...] = V.T
+        utpm_x_list = [algopy.UTPM(tmp)]
+
+        self.pushforward(utpm_x_list)
+        y = self.dependentFunctionList[0].x
+        return y.data[1].reshape((K, y.size)).T.copy()
+
     def vec_jac(self, w, x):
         """ computes the Jacobian-vector product w^T*J of a function
         F:R^N --> R^M in the reverse mode
@@ -448,6 +1499,54 @@ class CGraph:
 
         return self.independentFunctionList[0].xbar.data[0,0,...]
 
+    def mat_jac(self, W, x):
+        """ computes the matrix-Jacobian product W*J of a function
+        F:R^N --> R^M in the reverse mode
+
+        WJ = self.mat_jac(W, x)
+
+        The K rows of W are propagated at once as K adjoint directions of a
+        single pushforward and pullback.
+
+        Parameters
+        ----------
+        W: array_like
+            W.shape = (K, M)
+
+        x: array_like
+            x.ndim = 1
+
+        Returns
+        -------
+        WJ: array_like
+            the matrix-Jacobian product, WJ.shape = (K, N)
+        """
+
+        x = numpy.asarray(x)
+        W = numpy.asarray(W)
+
+        if x.ndim != 1:
+            raise ValueError("x.ndim must be 1 but provided %d"%x.ndim)
+
+        M = self.dependentFunctionList[0].size
+
+        if W.ndim != 2 or W.shape[1] != M:
+            raise ValueError("W.shape must be (K, %d) but provided W.shape=%s"%(M, W.shape))
+
+        K = W.shape[0]
+
+        tmp = numpy.zeros((1,K) + numpy.shape(x))
+        tmp[0,...] = x
+        utpm_x_list = [algopy.UTPM(tmp)]
+
+        self.pushforward(utpm_x_list)
+
+        ybar =  algopy.UTPM(numpy.zeros((1,K,M)))
+        ybar.data[0,...] = W
+        self.pullback([ybar])
+
+        return self.independentFunctionList[0].xbar.data[0,...].copy()
+
     def hessian(self, x):
         """ computes the Hessian
 
@@ -521,6 +1620,157 @@ class CGraph:
 
         return self.independentFunctionList[0].xbar.data[1,0]
 
+    def hess_mat(self, x, V):
+        """ computes the Hessian matrix product  dot(H,V)
+
+        HV = self.hess_mat(x, V)
+
+        The K columns of V are propagated at once as K directions of a single
+        pushforward and pullback, i.e. this is hess_vec for K directions.
+
+        Parameters
+        ----------
+        x: array_like
+            x.ndim == 1
+
+        V: array_like
+            V.shape == (N, K)
+
+        Returns
+        -------
+        HV: array
+            two-dimensional array containing the Hessian matrix product,
+            HV.shape == (N, K)
+
+        """
+
+        x = numpy.asarray(x)
+        V = numpy.asarray(V)
+
+        if x.ndim != 1:
+            raise ValueError("x.ndim must be 1 but provided %d"%x.ndim)
+
+        if V.ndim != 2 or V.shape[0] != x.size:
+            raise ValueError("V.shape must be (%d, K) but provided V.shape=%s"%(x.size, V.shape))
+
+        K = V.shape[1]
+
+        xtmp = numpy.zeros((2,K) + numpy.shape(x))
+        xtmp[0,:] = x; xtmp[1,:] = V.T
+        xtmp = algopy.UTPM(xtmp)
+
+        self.pushforward([xtmp])
+        ybar =  self.dependentFunctionList[0].x.zeros_like()
+        ybar.data[0,:] = 1.
+        self.pullback([ybar])
+
+        return self.independentFunctionList[0].xbar.data[1].T.copy()
+
+    def hessian_pattern(self):
+        """ detects the sparsity pattern of the Hessian of f:R^N --> R
+
+        The index sets of the independent variables and their nonlinear
+        interactions are propagated through the tape, see
+        algopy.tracer.sparsity. The pattern does not depend on the point of
+        evaluation and is cached on the CGraph (together with the Jacobian
+        pattern) until the tape changes. It is used by sparse_hessian if no
+        pattern is provided.
+
+        Returns
+        -------
+        pattern: scipy.sparse.csr_matrix
+            shape (N, N), entries 1 at the structural nonzeros
+        """
+
+        from .sparsity import propagate_patterns
+
+        if self._hessian_pattern is None:
+            self._jacobian_pattern, self._hessian_pattern = propagate_patterns(
+                self.functionList, self._get_slots(self.independentFunctionList),
+                self._get_slots(self.dependentFunctionList), hessian=True)
+
+        return self._hessian_pattern
+
+    def sparse_hessian(self, x, pattern=None):
+        """ computes a sparse Hessian of a function f:R^N --> R
+
+        H = self.sparse_hessian(x)
+
+        The columns of the Hessian are grouped by a star coloring of its
+        adjacency graph. The compressed Hessian H S, where S has one column
+        per color, is computed by one Hessian-vector product per color
+        (evaluated together as in hess_vec with several directions) and the
+        symmetric result is recovered from it, see algopy.tracer.coloring.
+        The number of colors is stored in self.hessian_info.
+
+        Parameters
+        ----------
+        x: array_like
+            x.ndim = 1
+
+        pattern: scipy.sparse matrix, array_like or None
+            sparsity pattern of the Hessian, shape (N, N). It is symmetrized.
+            If None, the pattern is detected by CGraph.hessian_pattern.
+
+        Returns
+        -------
+        H: scipy.sparse.csr_matrix
+            the Hessian evaluated at x, shape (N, N)
+        """
+
+        from .coloring import (symmetric_pattern, star_coloring, seed_matrix,
+                               recover_symmetric)
+
+        if len(self.independentFunctionList) != 1:
+            err_str = 'len(self.independentFunctionList) must be 1 but provided %d' % \
+                       len(self.independentFunctionList)
+            raise ValueError(err_str)
+
+        if len(self.dependentFunctionList) != 1:
+            err_str = 'len(self.dependentFunctionList) must be 1 but provided %d' % \
+                       len(self.dependentFunctionList)
+            raise ValueError(err_str)
+
+        x = numpy.asarray(x, dtype=float)
+
+        if x.ndim != 1:
+            raise ValueError("x.ndim must be 1 but provided %d"%x.ndim)
+
+        N = x.size
+
+        if pattern is None:
+            pattern = self.hessian_pattern()
+        else:
+            pattern = symmetric_pattern(pattern)
+
+        if pattern.shape != (N, N):
+            raise ValueError('pattern.shape must be %s but provided %s'%((N, N), pattern.shape))
+
+        # the coloring only depends on the pattern and is cached
+        coloring = self._hessian_coloring
+        if pattern is self._hessian_pattern and coloring is not None and coloring[0] == id(pattern):
+            colors = coloring[1]
+        else:
+            colors = star_coloring(pattern)
+            if pattern is self._hessian_pattern:
+                self._hessian_coloring = (id(pattern), colors)
+
+        S = seed_matrix(colors)
+        P = S.shape[1]
+        self.hessian_info = {'colors': P}
+
+        xtmp = numpy.zeros((2, P, N))
+        xtmp[0, ...] = x
+        xtmp[1, ...] = S.T
+        self.pushforward([algopy.UTPM(xtmp)])
+
+        ybar = self.dependentFunctionList[0].x.zeros_like()
+        ybar.data[0, :] = 1.
+        self.pullback([ybar])
+
+        B = self.independentFunctionList[0].xbar.data[1].T
+        return recover_symmetric(pattern, colors, B)
+
     def vec_hess(self, w, x):
         """ computes  the hessian of dot(w, F(x)), where F:R^N ---> R^M
 
@@ -699,6 +1949,8 @@ class Function(Ring):
 
     xbar = NotSet()
     setitem = NotSet()
+    pullback_class = None
+    pullback_function = None
 
     def __init__(self, x = None):
         """
@@ -852,8 +2104,6 @@ class Function(Ring):
         Thus, pullback(F) computes F.args[i].xbar
         """
 
-        func_name = F.func.__name__
-
         # STEP 1: extract arguments
         args = []
         argsbar = []
@@ -868,11 +2118,11 @@ class Function(Ring):
         if isinstance(F.x,tuple):
             # case if the function F has several outputs, e.g. (y1,y2) = F(x)
             args = list(F.xbar) + args + list(F.x)
-            f = eval('__import__("algopy.utpm").utpm.'+F.x[0].__class__.__name__+'.pb_'+func_name)
+            f = F.get_pullback_function(F.x[0].__class__)
 
         elif type(F.x) == type(None):
             # case if the function F has no output, e.g. None = F(x)
-            f = eval('__import__("algopy.utpm").utpm.'+F.args[0].x.__class__.__name__+'.pb_'+func_name)
+            f = F.get_pullback_function(F.args[0].x.__class__)
 
         elif numpy.isscalar(F.x) or isinstance(F.x, numpy.ndarray):
             return lambda x: None
@@ -881,23 +2131,10 @@ class Function(Ring):
 
             # case if the function F has output, e.g. y1 = F(x)
             args = [F.xbar] + args + [F.x]
+            f = F.get_pullback_function(F.x.__class__)
 
-            # print '-------'
-            # print func_name
-            # print F.x
-            # print F.xbar
-
-            # get the pullback function
-
-            f = eval('__import__("algopy.utpm").utpm.'+F.x.__class__.__name__+'.pb_'+func_name)
-
-        elif func_name == '__getitem__' or func_name == 'getitem':
+        elif F.func.__name__ in ('__getitem__', 'getitem'):
             return  lambda x: None
-            # raise NotImplementedError('should implement that')
-
-        # elif func_name == '__getitem__':
-        #     return  lambda x: None
-            # raise NotImplementedError('should implement that')
 
         # STEP 2: call the pullback function
         kwargs = {'out': list(argsbar)}
@@ -921,6 +2158,18 @@ class Function(Ring):
         return F
 
 
+    def get_pullback_function(self, xcls):
+        """
+        returns the pullback function ``xcls.pb_<func name>`` of this node
+
+        The result is cached on the node, so that repeated reverse sweeps
+        only have to check that the class of the stored value is unchanged.
+        """
+        if self.pullback_class is not xcls:
+            self.pullback_function = get_pullback_function(xcls, self.func)
+            self.pullback_class = xcls
+        return self.pullback_function
+
     @classmethod
     def totype(cls, x):
         """
@@ -1310,14 +2559,25 @@ class Function(Ring):
     def extract_UTPM_jacobian(self):
         return Function.pushforward(algopy.extract_jacobian, [self])
 
+    def _compare(self, op, other):
+        """
+        evaluates the comparison op(self, other) and records its outcome
+        as a guard of the current CGraph, see CGraph.check_guards
+        """
+        other_x = other.x if isinstance(other, Function) else other
+        if self.cgraph is not None:
+            self.cgraph.add_guard(op, [self, other],
+                                  op(_guard_value(self.x), _guard_value(other_x)))
+        return op(self.x, other_x)
+
     def __lt__(self, other):
-        return self.x.__lt__(other.x)
+        return self._compare(operator.lt, other)
 
     def __le__(self, other):
-        return self.x.__le__(other.x)
+        return self._compare(operator.le, other)
 
     def __ge__(self, other):
-        return self.x.__ge__(other.x)
+        return self._compare(operator.ge, other)
 
     def __gt__(self, other):
-        return self.x.__gt__(other.x)
+        return self._compare(operator.gt, other)
@@ -24,7 +24,7 @@ try:
     import scipy.linalg
     import scipy.special
 except ImportError:
-    pass
+    scipy = None
 
 try:
     import pytpcore
@@ -32,6 +32,8 @@ except ImportError:
     pytpcore = None
 
 from algopy import nthderiv
+from algopy.utpm import series
+from algopy._npversion import NumpyVersion
 
 
 def _plus_const(x_data, c, out=None):
@@ -242,6 +244,167 @@ def truncated_triple_dot(X,Y,Z, D):
     else:
         return retval[0]
 
+# numpy.matmul calls BLAS for each matrix of a stack since numpy 1.16. Before,
+# it is only faster than a loop of numpy.dot calls for small matrices, i.e.
+# when N*K*M is at most this number.
+if NumpyVersion(numpy.version.version) >= '1.16.0':
+    _stacked_matmul_max_size = None
+else:
+    _stacked_matmul_max_size = 500
+
+
+def _as_matrices(x_data, y_data, z_data, x_constant=False, y_constant=False):
+    """
+    returns views of the UTPM data of z = dot(x, y) with two trailing axes,
+    i.e. vectors x of shape (K,) become (1, K) and vectors y become (K, 1),
+    or None if x or y has not one or two trailing axes.
+    x and y can also be constant arrays without the axes (D, P).
+    """
+    xdim = x_data.ndim - (0 if x_constant else 2)
+    ydim = y_data.ndim - (0 if y_constant else 2)
+    if xdim not in (1, 2) or ydim not in (1, 2):
+        return None
+
+    z_m = z_data
+    if xdim == 1:
+        x_data = x_data[..., None, :]
+        z_m = z_m[..., None, :] if ydim == 2 else z_m[..., None]
+    if ydim == 1:
+        y_data = y_data[..., None]
+        z_m = z_m[..., None]
+    return x_data, y_data, z_m
+
+
+def _use_stacked_matmul(x_m, y_m):
+    return _stacked_matmul_max_size is None or \
+           x_m.shape[-2] * x_m.shape[-1] * y_m.shape[-1] <= _stacked_matmul_max_size
+
+
+def _add_taylor_matmul(x_m, y_m, z_m):
+    """
+    z_m += x_m y_m in Taylor arithmetic for UTPM data with two trailing axes,
+    i.e. z_m[d] += sum_c matmul(x_m[c], y_m[d-c]), with one stacked matmul
+    of all degrees and directions per c if that is faster than numpy.dot
+    """
+    D, P = x_m.shape[:2]
+    if _use_stacked_matmul(x_m, y_m):
+        for c in range(D):
+            z_m[c:] += numpy.matmul(x_m[c:c+1], y_m[:D-c])
+        return
+
+    for d in range(D):
+        for p in range(P):
+            for c in range(d+1):
+                z_m[d,p] += numpy.dot(x_m[c,p], y_m[d-c,p])
+
+
+def _is_constant_gemm(x_m, y_m):
+    """
+    returns True if matmul(x_m, y_m) of UTPM data and a constant matrix is
+    computed by one GEMM, see _add_constant_matmul
+    """
+    return y_m.ndim == 2 or y_m.shape[-1] == 1 or _use_stacked_matmul(x_m, y_m)
+
+
+def _add_constant_matmul(x_m, y_m, z_m):
+    """
+    z_m += matmul(x_m, y_m) for UTPM data and a constant matrix x_m or y_m
+    (all with two trailing axes). A constant on the right, or on the left of
+    column vectors, is applied to all degrees and directions by one GEMM.
+    """
+    if y_m.ndim == 2:
+        z_m += numpy.tensordot(x_m, y_m, axes=([-1], [0]))
+
+    elif y_m.shape[-1] == 1:
+        z_m[..., 0] += numpy.tensordot(y_m[..., 0], x_m, axes=([-1], [1]))
+
+    elif _use_stacked_matmul(x_m, y_m):
+        z_m += numpy.matmul(x_m, y_m)
+
+    else:
+        D, P = y_m.shape[:2]
+        for d in range(D):
+            for p in range(P):
+                z_m[d,p] += numpy.dot(x_m, y_m[d,p])
+
+
+_lapack_functions = {}
+
+
+def _lapack_function(name, *arrays):
+    """ scipy.linalg.get_lapack_funcs for a single name, cached by the dtypes """
+    key = (name,) + tuple([a.dtype.char for a in arrays])
+    if key not in _lapack_functions:
+        _lapack_functions[key], = scipy.linalg.get_lapack_funcs((name,), arrays)
+    return _lapack_functions[key]
+
+
+def _distinct_base_points(A0_data):
+    """
+    returns A0_data[:1] if all directions p share the same base point
+    A0_data[p], and A0_data otherwise
+    """
+    if numpy.all(A0_data == A0_data[:1]):
+        return A0_data[:1]
+    return A0_data
+
+
+def _lu_factor_directions(A0_data):
+    """
+    returns the LU factors (lu, piv) of the base points A0_data[p] of all
+    directions p in the format of scipy.linalg.lu_factor. If all directions
+    share the same base point, a list with a single factorization is
+    returned. Raises numpy.linalg.LinAlgError for singular matrices.
+
+    Without scipy, the base points themselves are returned and
+    _lu_solve_directions uses numpy.linalg.solve.
+    """
+    A0_data = _distinct_base_points(A0_data)
+    if scipy is None:
+        return list(A0_data)
+
+    getrf = _lapack_function('getrf', A0_data)
+    factors = []
+    for A0 in A0_data:
+        lu, piv, info = getrf(A0)
+        if info > 0:
+            raise numpy.linalg.LinAlgError('Singular matrix')
+        factors.append((lu, piv))
+    return factors
+
+
+def _lu_solve_directions(factors, b_data):
+    """
+    solves A0_data[p] y[p] = b_data[p] for all directions p with the factors
+    of _lu_factor_directions, i.e. with one LAPACK getrs call (see
+    scipy.linalg.lu_solve) for the right-hand sides of all directions if
+    they share the base point
+    """
+    if scipy is None:
+        solve = numpy.linalg.solve
+    else:
+        getrs = _lapack_function('getrs', factors[0][0], b_data)
+
+        def solve(factor, b):
+            return getrs(factor[0], factor[1], b)[0]
+
+    if len(factors) == 1:
+        P, M = b_data.shape[:2]
+        y = solve(factors[0], b_data.swapaxes(0, 1).reshape((M, -1)))
+        return y.reshape((M, P) + b_data.shape[2:]).swapaxes(0, 1)
+
+    return numpy.array([solve(f, b) for f, b in zip(factors, b_data)])
+
+
+def _lu_solve_constant(factors, b):
+    """
+    solves A0_data[p] y[p] = b for a constant right-hand side b with the
+    factors of _lu_factor_directions. The returned array broadcasts to the
+    shape of y.
+    """
+    return _lu_solve_directions(factors, numpy.broadcast_to(b, (len(factors),) + numpy.shape(b)))
+
+
 def broadcast_arrays_shape(x_shp,y_shp):
 
     if len(x_shp) < len(y_shp):
@@ -291,6 +454,12 @@ class RawAlgorithmsMixIn:
         if numpy.shape(x_data) != numpy.shape(y_data):
             raise NotImplementedError
         D, P = x_data.shape[:2]
+        if series.applicable(series.mul_degree_threshold, x_data, y_data):
+            z_data = series.mul(x_data, y_data)
+            if out is None:
+                return z_data.astype(numpy.result_type(x_data, y_data), copy=False)
+            out[...] = z_data
+            return out
         #FIXME: there is a memoryview and buffer contiguity checking error
         # which may or may not be caused by a bug in numpy or cython.
         if pytpcore and all(s > 1 for s in x_data.shape):
@@ -306,16 +475,37 @@ class RawAlgorithmsMixIn:
             else:
                 return z_data
         else:
-            # numpy.sum is careful about aliasing so we can use out=z_data
             if out is None:
                 z_data = numpy.empty_like(x_data)
+            elif numpy.may_share_memory(out, x_data) or \
+                 numpy.may_share_memory(out, y_data):
+                # the result is accumulated in z_data, which must not
+                # alias the arguments, e.g. in x *= y
+                out[...] = cls._mul(x_data, y_data)
+                return out
             else:
                 z_data = out
-            for d in range(D)[::-1]:
-                numpy.sum(
-                        x_data[:d+1,:,...] * y_data[d::-1,:,...],
-                        axis=0,
-                        out = z_data[d,:,...])
+
+            if D > 2 and D * x_data.size <= 2**14:
+                # small arrays: the Cauchy product as a single contraction
+                # z[d] = sum_k T[d,k] x[k] with the lower triangular
+                # Toeplitz matrix T[d,k] = y[d-k] (a strided view of y
+                # padded with D-1 zero coefficients)
+                y_pad = numpy.zeros((2*D-1,) + y_data.shape[1:], dtype=y_data.dtype)
+                y_pad[D-1:] = y_data
+                strides = y_pad.strides
+                T = as_strided(y_pad[D-1:], shape=(D, D) + y_data.shape[1:],
+                               strides=(strides[0], -strides[0]) + strides[1:])
+                return numpy.einsum('dk...,k...->d...', T, x_data, out=z_data)
+
+            # z[k:] += x[k] * y[:D-k] for k = 0,...,D-1, i.e. D vectorized
+            # updates of all degrees with one temporary that is reused
+            numpy.multiply(x_data[:1], y_data, out=z_data)
+            if D > 1:
+                tmp = numpy.empty_like(z_data[1:])
+                for k in range(1, D):
+                    numpy.multiply(x_data[k:k+1], y_data[:D-k], out=tmp[:D-k])
+                    numpy.add(z_data[k:], tmp[:D-k], out=z_data[k:])
             return z_data
 
 
@@ -382,6 +572,10 @@ class RawAlgorithmsMixIn:
         if out is None:
             raise NotImplementedError
 
+        if series.applicable(series.newton_degree_threshold, x_data, y_data):
+            out[...] = series.truediv(x_data, y_data)
+            return out
+
         z_data = numpy.empty_like(out)
         (D,P) = z_data.shape[:2]
         for d in range(D):
@@ -399,7 +593,9 @@ class RawAlgorithmsMixIn:
         # it was copypasted from div
         z_data = numpy.empty_like(y_data)
         D = y_data.shape[0]
-        if pytpcore:
+        if series.applicable(series.newton_degree_threshold, y_data):
+            z_data[...] = series.reciprocal(y_data)
+        elif pytpcore:
             y_data_reshaped = y_data.reshape((D, -1))
             z_data_reshaped = z_data.reshape((D, -1))
             pytpcore.tp_reciprocal(y_data_reshaped, z_data_reshaped)
@@ -502,6 +698,11 @@ class RawAlgorithmsMixIn:
 
 
 
+        if series.applicable(series.newton_degree_threshold, x_data) and \
+           numpy.isrealobj(x_data) and numpy.all(x_data[0] > 0):
+            y_data[...] = series.pow_real(x_data, r)
+            return y_data
+
         y_data[0] = x_data[0]**r
         for d in range(1,D):
             y_data[d] = r * numpy.sum([y_data[d-k] * k * x_data[k] for k in range(1,d+1)], axis = 0) - \
@@ -663,6 +864,11 @@ class RawAlgorithmsMixIn:
     def _sqrt(cls, x_data, out = None):
         if out is None:
             raise NotImplementedError('should implement that')
+
+        if series.applicable(series.newton_degree_threshold, x_data):
+            out[...] = series.sqrt(x_data)
+            return out
+
         y_data = numpy.zeros_like(x_data)
         D,P = x_data.shape[:2]
 
@@ -691,7 +897,9 @@ class RawAlgorithmsMixIn:
         else:
             y_data = out
         D,P = x_data.shape[:2]
-        if pytpcore:
+        if series.applicable(series.newton_degree_threshold, x_data):
+            y_data[...] = series.exp(x_data)
+        elif pytpcore:
             x_data_reshaped = x_data.reshape((D, -1))
             y_data_reshaped = y_data.reshape((D, -1))
             tmp = numpy.empty_like(x_data_reshaped)
@@ -810,6 +1018,11 @@ class RawAlgorithmsMixIn:
     def _log(cls, x_data, out = None):
         if out is None:
             raise NotImplementedError('should implement that')
+
+        if series.applicable(series.newton_degree_threshold, x_data):
+            out[...] = series.log(x_data)
+            return out
+
         y_data = numpy.empty_like(x_data)
         D,P = x_data.shape[:2]
 
@@ -1175,7 +1388,10 @@ class RawAlgorithmsMixIn:
         """
 
         if out is None:
-            new_shp = x_data.shape[:-1] + y_data.shape[2:-2] + (y_data.shape[-1],)
+            if y_data.ndim == 3:
+                new_shp = x_data.shape[:-1]
+            else:
+                new_shp = x_data.shape[:-1] + y_data.shape[2:-2] + (y_data.shape[-1],)
             out = numpy.zeros(new_shp, dtype=numpy.promote_types(x_data.dtype, y_data.dtype) )
 
         z_data = out
@@ -1183,9 +1399,10 @@ class RawAlgorithmsMixIn:
 
         D,P = x_data.shape[:2]
 
-        # print 'x_data.shape=', x_data.shape
-        # print 'y_data.shape=', y_data.shape
-        # print 'z_data.shape=', z_data.shape
+        matrices = _as_matrices(x_data, y_data, z_data)
+        if matrices is not None:
+            _add_taylor_matmul(*matrices)
+            return out
 
         for d in range(D):
             for p in range(P):
@@ -1203,6 +1420,16 @@ class RawAlgorithmsMixIn:
 
         (xbar_data, ybar_data) = out
 
+        x_matrices = _as_matrices(xbar_data, y_data, zbar_data)
+        y_matrices = _as_matrices(x_data, ybar_data, zbar_data)
+        if x_matrices is not None:
+            # xbar += zbar y^T and ybar += x^T zbar on views with two trailing axes
+            xbar_m, y_m, zbar_m = x_matrices
+            x_m, ybar_m = y_matrices[:2]
+            _add_taylor_matmul(zbar_m, y_m.swapaxes(-1, -2), xbar_m)
+            _add_taylor_matmul(x_m.swapaxes(-1, -2), zbar_m, ybar_m)
+            return out
+
         xbar_data += cls._dot(zbar_data, cls._transpose(y_data), out = xbar_data.copy())
         ybar_data += cls._dot(cls._transpose(x_data), zbar_data, out = ybar_data.copy())
 
@@ -1218,12 +1445,14 @@ class RawAlgorithmsMixIn:
             raise NotImplementedError('should implement that')
 
         z_data = out
-        z_data[...] = 0.
+        matrices = _as_matrices(x_data, y_data, z_data, y_constant=True)
+        if matrices is not None and _is_constant_gemm(*matrices[:2]):
+            z_data[...] = 0.
+            _add_constant_matmul(*matrices)
+            return out
 
         D,P = x_data.shape[:2]
 
-        # print 'z_data=',z_data
-
         for d in range(D):
             for p in range(P):
                 z_data[d,p,...] = numpy.dot(x_data[d,p,...], y_data[...])
@@ -1240,7 +1469,11 @@ class RawAlgorithmsMixIn:
             raise NotImplementedError('should implement that')
 
         z_data = out
-        z_data[...] = 0.
+        matrices = _as_matrices(x_data, y_data, z_data, x_constant=True)
+        if matrices is not None and _is_constant_gemm(*matrices[:2]):
+            z_data[...] = 0.
+            _add_constant_matmul(*matrices)
+            return out
 
         D,P = y_data.shape[:2]
 
@@ -1250,6 +1483,38 @@ class RawAlgorithmsMixIn:
 
         return out
 
+    @classmethod
+    def _dot_pullback_non_UTPM_x(cls, zbar_data, x_data, y_data, z_data, out = None):
+        """
+        pullback of z = dot(x,y) w.r.t. y for a constant x, i.e. ybar += dot(x.T, zbar)
+        """
+        if out is None:
+            raise NotImplementedError('should implement that')
+
+        matrices = _as_matrices(x_data, out, zbar_data, x_constant=True)
+        if matrices is None:
+            raise NotImplementedError('should implement that')
+
+        x_m, ybar_m, zbar_m = matrices
+        _add_constant_matmul(x_m.T, zbar_m, ybar_m)
+        return out
+
+    @classmethod
+    def _dot_pullback_non_UTPM_y(cls, zbar_data, x_data, y_data, z_data, out = None):
+        """
+        pullback of z = dot(x,y) w.r.t. x for a constant y, i.e. xbar += dot(zbar, y.T)
+        """
+        if out is None:
+            raise NotImplementedError('should implement that')
+
+        matrices = _as_matrices(out, y_data, zbar_data, y_constant=True)
+        if matrices is None:
+            raise NotImplementedError('should implement that')
+
+        xbar_m, y_m, zbar_m = matrices
+        _add_constant_matmul(zbar_m, y_m.T, xbar_m)
+        return out
+
     @classmethod
     def _outer(cls, x_data, y_data, out = None):
         """
@@ -1324,7 +1589,7 @@ class RawAlgorithmsMixIn:
         (xbar_data, ybar_data) = out
 
         xbar_data += cls._dot(zbar_data, y_data, out = xbar_data.copy())
-        ybar_data += cls._dot(zbar_data, x_data, out = ybar_data.copy())
+        ybar_data += cls._dot(numpy.swapaxes(zbar_data, 2, 3), x_data, out = ybar_data.copy())
 
         return out
 
@@ -1340,9 +1605,8 @@ class RawAlgorithmsMixIn:
         y_data, = out
         (D,P,N,M) = y_data.shape
 
-        # tc[0] element
-        for p in range(P):
-            y_data[0,p,:,:] = numpy.linalg.inv(x_data[0,p,:,:])
+        # tc[0] element, shared by all directions with the same base point
+        y_data[0,...] = numpy.linalg.inv(_distinct_base_points(x_data[0]))
 
         # tc[d] elements
         for d in range(1,D):
@@ -1417,6 +1681,9 @@ class RawAlgorithmsMixIn:
             raise NotImplementedError('should implement that')
 
         y_data = out
+        if x_data.ndim == 3:
+            x_data = x_data[..., None]
+            y_data = y_data[..., None]
 
         x_shp = x_data.shape
         A_shp = A_data.shape
@@ -1425,18 +1692,18 @@ class RawAlgorithmsMixIn:
         D,P,M,K = x_shp
 
         # d = 0:  base point
-        for p in range(P):
-            y_data[0,p,...] = numpy.linalg.solve(A_data[0,p,...], x_data[0,p,...])
+        factors = _lu_factor_directions(A_data[0])
+        y_data[0,...] = _lu_solve_directions(factors, x_data[0])
 
         # d = 1,...,D-1
         dtype = numpy.promote_types(A_data.dtype, x_data.dtype)
-        tmp = numpy.zeros((M,K),dtype=dtype)
+        tmp = numpy.zeros((P,M,K),dtype=dtype)
         for d in range(1, D):
+            tmp[...] = x_data[d]
             for p in range(P):
-                tmp[:,:] = x_data[d,p,:,:]
                 for k in range(1,d+1):
-                    tmp[:,:] -= numpy.dot(A_data[k,p,:,:],y_data[d-k,p,:,:])
-                y_data[d,p,:,:] = numpy.linalg.solve(A_data[0,p,:,:],tmp)
+                    tmp[p,:,:] -= numpy.dot(A_data[k,p,:,:],y_data[d-k,p,:,:])
+            y_data[d,...] = _lu_solve_directions(factors, tmp)
 
         return out
 
@@ -1459,13 +1726,14 @@ class RawAlgorithmsMixIn:
         x_shp = numpy.shape(x_data)
         A_shp = numpy.shape(A_data)
         M,N = A_shp
-        D,P,M,K = x_shp
+        D,P = x_shp[:2]
 
         assert M == N
 
-        for d in range(D):
-            for p in range(P):
-                y_data[d,p,...] = numpy.linalg.solve(A_data[:,:], x_data[d,p,...])
+        # one factorization and one lu_solve for all degrees and directions
+        factors = _lu_factor_directions(numpy.asarray(A_data)[None])
+        y = _lu_solve_directions(factors, x_data.reshape((D*P,) + x_shp[2:]))
+        y_data[...] = y.reshape(y_data.shape)
 
         return out
 
@@ -1484,6 +1752,10 @@ class RawAlgorithmsMixIn:
 
         y_data = out
 
+        if numpy.ndim(x_data) == 1:
+            x_data = numpy.asarray(x_data)[:, None]
+            y_data = y_data[..., None]
+
         x_shp = numpy.shape(x_data)
         A_shp = numpy.shape(A_data)
         D,P,M,N = A_shp
@@ -1492,18 +1764,17 @@ class RawAlgorithmsMixIn:
         assert M==N
 
         # d = 0:  base point
-        for p in range(P):
-            y_data[0,p,...] = numpy.linalg.solve(A_data[0,p,...], x_data[...])
+        factors = _lu_factor_directions(A_data[0])
+        y_data[0,...] = _lu_solve_constant(factors, x_data)
 
         # d = 1,...,D-1
-        tmp = numpy.zeros((M,K),dtype=float)
+        tmp = numpy.zeros((P,M,K),dtype=y_data.dtype)
         for d in range(1, D):
+            tmp[...] = 0.
             for p in range(P):
-                tmp[:,:] = 0.
                 for k in range(1,d+1):
-                    tmp[:,:] -= numpy.dot(A_data[k,p,:,:],y_data[d-k,p,:,:])
-                y_data[d,p,:,:] = numpy.linalg.solve(A_data[0,p,:,:],tmp)
-
+                    tmp[p,:,:] -= numpy.dot(A_data[k,p,:,:],y_data[d-k,p,:,:])
+            y_data[d,...] = _lu_solve_directions(factors, tmp)
 
         return out
 
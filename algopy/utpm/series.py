@@ -0,0 +1,213 @@
+"""
+Arithmetic of univariate Taylor polynomials of high degree.
+
+The recurrences of RawAlgorithmsMixIn (e.g. _mul, _reciprocal, _exp) need
+O(D^2) operations on the trailing axes of the data array. For a high degree
+D (e.g. in series expansions or Taylor ODE integrators) the functions of this
+module are used instead:
+
+    * the truncated Cauchy product is computed by an FFT along the degree
+      axis, i.e. in O(D log D)
+    * the reciprocal, exp and sqrt are computed by Newton iterations that
+      double the number of correct coefficients in each step, the log is
+      computed as the integral of x'/x
+
+All functions operate on arrays of the shape (D,) + trailing axes and are
+applied to all trailing axes (P and the shape of the UTPM) at once.
+
+The engine is opt-in: RawAlgorithmsMixIn uses it if the degree D exceeds
+``mul_degree_threshold`` (products) or ``newton_degree_threshold`` (the
+other functions) and the data is real or complex floating point. Both
+thresholds are None by default, i.e. the recurrences are always used.
+
+Accuracy: the rounding errors of the FFT are bounded relative to the
+largest coefficient, not relative to each coefficient. Series whose
+coefficients decay quickly (e.g. 1/d! for exp(t)), which is the usual
+case for Taylor coefficients, lose the relative accuracy of their small
+coefficients entirely, e.g. the 30th coefficient of exp(t)*exp(t) at
+D = 160 is wrong by orders of magnitude. Only enable the engine for
+balanced series, e.g. after scaling t -> h t with the step size h of an
+ODE integrator. Since the FFT has a large constant factor, it only pays
+off for D above roughly 128 (products) and 512 (the other functions) for
+small trailing axes, see
+experimental/performance_tests/high_degree_series.py.
+"""
+
+import numpy
+
+# the series arithmetic is used for D > threshold, None disables it
+mul_degree_threshold = None
+newton_degree_threshold = None
+
+
+def applicable(threshold, *arrays):
+    """
+    returns True if the series arithmetic should be used for the data
+    arrays, i.e. their degree exceeds the threshold and they contain
+    floating point numbers
+    """
+    if threshold is None or arrays[0].shape[0] <= threshold:
+        return False
+    return all([numpy.issubdtype(a.dtype, numpy.inexact) for a in arrays])
+
+
+def _pad(x, n):
+    """ returns the first n coefficients of x, padded with zeros if necessary """
+    if x.shape[0] >= n:
+        return x[:n]
+    y = numpy.zeros((n,) + x.shape[1:], dtype=x.dtype)
+    y[:x.shape[0]] = x
+    return y
+
+
+def mul(x, y, n=None):
+    """ returns the first n (default: len(x)) coefficients of x*y """
+
+    if n is None:
+        n = x.shape[0]
+    x = x[:n]
+    y = y[:n]
+
+    m = x.shape[0] + y.shape[0] - 1
+    L = 1
+    while L < m:
+        L *= 2
+
+    if numpy.iscomplexobj(x) or numpy.iscomplexobj(y):
+        z = numpy.fft.ifft(numpy.fft.fft(x, n=L, axis=0) *
+                           numpy.fft.fft(y, n=L, axis=0), axis=0)
+    else:
+        z = numpy.fft.irfft(numpy.fft.rfft(x, n=L, axis=0) *
+                            numpy.fft.rfft(y, n=L, axis=0), n=L, axis=0)
+
+    return _pad(z[:m], n)
+
+
+def reciprocal(y, n=None):
+    """
+    returns the first n (default: len(y)) coefficients of 1/y
+
+    Newton iteration z <- z (2 - y z), which doubles the number of
+    correct coefficients in each step.
+    """
+
+    if n is None:
+        n = y.shape[0]
+
+    z = 1. / y[:1]
+    m = 1
+    while m < n:
+        m = min(2 * m, n)
+        e = mul(_pad(y, m), z, m)
+        e[0] -= 2
+        z = -mul(z, e, m)
+    return z
+
+
+def log(x, n=None):
+    """
+    returns the first n (default: len(x)) coefficients of log(x),
+    computed as the integral of x'/x
+    """
+
+    if n is None:
+        n = x.shape[0]
+
+    y = numpy.empty((n,) + x.shape[1:], dtype=numpy.result_type(x.dtype, float))
+    y[0] = numpy.log(x[0])
+    if n > 1:
+        y[1:] = _integral(mul(_derivative(_pad(x, n)), reciprocal(x, n - 1), n - 1))[1:]
+    return y
+
+
+def _derivative(x):
+    """ returns the coefficients of dx/dt """
+    d = numpy.arange(1, x.shape[0]).reshape((x.shape[0] - 1,) + (1,) * (x.ndim - 1))
+    return x[1:] * d
+
+
+def _integral(x):
+    """ returns the coefficients of the integral of x with constant coefficient 0 """
+    y = numpy.zeros((x.shape[0] + 1,) + x.shape[1:], dtype=x.dtype)
+    d = numpy.arange(1, x.shape[0] + 1).reshape((x.shape[0],) + (1,) * (x.ndim - 1))
+    y[1:] = x / d
+    return y
+
+
+def exp(x, n=None):
+    """
+    returns the first n (default: len(x)) coefficients of exp(x)
+
+    Newton iteration y <- y (1 + x - log(y)), where the reciprocal z of y
+    that is needed for log(y) is updated by one Newton step per iteration.
+    """
+
+    if n is None:
+        n = x.shape[0]
+
+    x = _pad(x, n)
+    dx = _derivative(x)
+    y = numpy.exp(x[:1])
+    z = 1. / y
+    m = 1
+    while m < n:
+        # z = 1/y up to t**m
+        e = mul(y, z, m)
+        e[0] -= 2
+        z = -mul(z, e, m)
+
+        # x - log(y) = integral of x' - y'/y, where x' - y'/y = (y x' - y')/y
+        # vanishes up to t**(m-1) and hence z suffices for 2m - 1 coefficients
+        m2 = min(2 * m, n)
+        r = mul(y, dx, m2 - 1) - _pad(_derivative(y), m2 - 1)
+        s = _integral(mul(_pad(z, m2 - 1), r, m2 - 1))
+        y = _pad(y, m2) + mul(y, s, m2)
+        m = m2
+
+    # the constant coefficient is exact
+    y[0] = numpy.exp(x[0])
+    return y
+
+
+def sqrt(x, n=None):
+    """
+    returns the first n (default: len(x)) coefficients of sqrt(x)
+
+    Newton iteration w <- w + w (1 - x w**2) / 2 for w = 1/sqrt(x),
+    followed by sqrt(x) = x w.
+    """
+
+    if n is None:
+        n = x.shape[0]
+
+    w = 1. / numpy.sqrt(x[:1])
+    m = 1
+    while m < n:
+        m = min(2 * m, n)
+        e = mul(_pad(x, m), mul(w, w, m), m)
+        e[0] -= 1
+        w = _pad(w, m) - 0.5 * mul(w, e, m)
+
+    y = mul(x, w, n)
+    y[0] = numpy.sqrt(x[0])
+    return y
+
+
+def truediv(x, y, n=None):
+    """ returns the first n (default: len(x)) coefficients of x/y """
+    if n is None:
+        n = x.shape[0]
+    return mul(x, reciprocal(y, n), n)
+
+
+def pow_real(x, r, n=None):
+    """
+    returns the first n (default: len(x)) coefficients of x**r for a real
+    scalar r, computed as exp(r log(x)). The constant coefficients of x
+    must be positive.
+    """
+    if n is None:
+        n = x.shape[0]
+    y = exp(r * log(x, n))
+    y[0] = x[0]**r
+    return y
@@ -7,6 +7,7 @@ from algopy.utpm.algorithms import *
 # explicitly import some of the helpers that have underscores
 from algopy.utpm.algorithms import _plus_const
 from algopy.utpm.algorithms import _taylor_polynomials_of_ode_solutions
+from algopy.utpm import series
 
 
 class Test_Helper_Functions(TestCase):
@@ -315,6 +316,21 @@ class Test_pushforward_class_functions(TestCase):
 
         assert_array_almost_equal(X_data.transpose((0,1,3,2)), Y_data)
 
+    def test__mul(self):
+        # small and large arrays are multiplied by different code paths
+        for D, P, N in [(1, 3, 2), (4, 3, 2), (4, 3, 2000)]:
+            X_data = numpy.random.rand(D, P, N)
+            Y_data = numpy.random.rand(D, P, N)
+            Z_data = numpy.zeros((D, P, N))
+            for d in range(D):
+                for k in range(d + 1):
+                    Z_data[d] += X_data[k] * Y_data[d - k]
+
+            assert_array_almost_equal(Z_data, UTPM._mul(X_data, Y_data))
+            out = numpy.empty_like(Z_data)
+            assert UTPM._mul(X_data, Y_data, out=out) is out
+            assert_array_almost_equal(Z_data, out)
+
 
 class Test_aliasing(TestCase):
 
@@ -401,5 +417,85 @@ class Test_aliasing(TestCase):
         assert_allclose(x, y)
 
 
+class Test_high_degree_series(TestCase):
+
+    def setUp(self):
+        self.thresholds = (series.mul_degree_threshold, series.newton_degree_threshold)
+
+    def tearDown(self):
+        series.mul_degree_threshold, series.newton_degree_threshold = self.thresholds
+
+    def recurrence(self, name, *args):
+        series.mul_degree_threshold = series.newton_degree_threshold = None
+        out = numpy.empty_like(args[0])
+        getattr(UTPM, name)(*args, out=out)
+        return out
+
+    def test_agreement_with_recurrences(self):
+        D, P, N = 40, 3, 4
+        x = numpy.random.rand(D, P, N) * 0.5
+        y = numpy.random.rand(D, P, N) * 0.5
+        x[0] += 1.5
+        y[0] += 1.5
+
+        cases = [('_mul', series.mul, (x, y)),
+                 ('_truediv', series.truediv, (x, y)),
+                 ('_reciprocal', series.reciprocal, (y,)),
+                 ('_exp', series.exp, (x,)),
+                 ('_log', series.log, (x,)),
+                 ('_sqrt', series.sqrt, (x,)),
+                 ('_pow_real', series.pow_real, (x, 1.7))]
+
+        for name, f, args in cases:
+            z1 = self.recurrence(name, *args)
+            z2 = f(*args)
+            # the FFT is accurate relative to the largest coefficient
+            assert_allclose(z2, z1, rtol=0, atol=1e-11 * numpy.abs(z1).max())
+
+    def test_complex_mul(self):
+        D, P, N = 20, 2, 3
+        x = numpy.random.rand(D, P, N) + 1j * numpy.random.rand(D, P, N)
+        y = numpy.random.rand(D, P, N) + 1j * numpy.random.rand(D, P, N)
+        z1 = self.recurrence('_mul', x, y)
+        assert_allclose(series.mul(x, y), z1, rtol=0, atol=1e-12 * numpy.abs(z1).max())
+
+    def factorials(self, D):
+        return numpy.cumprod(numpy.maximum(numpy.arange(D), 1.))
+
+    def test_decaying_coefficients_by_default(self):
+        # the coefficients of exp(t) are 1/d!, those of exp(t)**2 are 2**d/d!
+        D = 160
+        d = numpy.arange(D)
+        x = UTPM(numpy.zeros((D, 1)))
+        x.data[:, 0] = 1. / self.factorials(D)
+
+        assert_allclose((x * x).data[:, 0], 2.**d / self.factorials(D), rtol=1e-12)
+        assert_allclose((x / x).data[:, 0], d == 0, rtol=0, atol=1e-14)
+
+        D = 600
+        t = UTPM(numpy.zeros((D, 1)))
+        t.data[1] = 1.
+        y = UTPM.exp(t)
+        assert_allclose(y.data[:150, 0], x.data[:150, 0], rtol=1e-12)
+        assert_allclose(UTPM.log(y).data[:150, 0], t.data[:150, 0], rtol=0, atol=1e-14)
+
+    def test_decaying_coefficients_lose_accuracy(self):
+        D = 160
+        d = numpy.arange(D)
+        x = 1. / self.factorials(D)
+        z = series.mul(x, x)
+        assert_allclose(z[:10], 2.**d[:10] * x[:10], rtol=1e-12)
+        assert numpy.abs(z[30] / (2.**30 * x[30]) - 1) > 1.
+
+    def test_threshold(self):
+        D, P, N = 12, 2, 3
+        x = UTPM(numpy.random.rand(D, P, N) + 1)
+        y1 = UTPM(self.recurrence('_exp', x.data))
+
+        series.mul_degree_threshold = series.newton_degree_threshold = D - 1
+        y2 = UTPM.exp(x) * x / x
+        assert_allclose(y2.data, y1.data, rtol=0, atol=1e-12 * numpy.abs(y1.data).max())
+
+
 if __name__ == "__main__":
     run_module_suite()
@@ -1,4 +1,5 @@
 import math
+import operator
 
 from numpy.testing import *
 import numpy
@@ -6,6 +7,7 @@ import scipy.special
 
 import algopy.nthderiv
 from algopy.utpm import *
+from algopy.utpm.utpm import workaround_strides_function
 from algopy import zeros
 
 try:
@@ -1459,6 +1461,69 @@ class Test_Push_Forward(TestCase):
 
 
 
+    def test_solve_shared_and_distinct_base_points(self):
+        (D,P,N,K) = 4,3,5,2
+        A = UTPM(numpy.random.rand(D,P,N,N))
+        A.data[0] = numpy.random.rand(N,N) + (N + 1) * numpy.eye(N)
+        x = UTPM(numpy.random.rand(D,P,N,K))
+
+        for shared in [True, False]:
+            if not shared:
+                A.data[0,1] += numpy.eye(N)
+
+            y = UTPM.solve(A, x)
+            assert_array_almost_equal(UTPM.dot(A, y).data, x.data)
+
+            y = UTPM.solve(A, x[:,0])
+            assert_array_almost_equal(UTPM.dot(A, y).data, x[:,0].data)
+
+            y = UTPM.solve(A, x.data[0,0])
+            assert_array_almost_equal(UTPM.dot(A, y).data[0], x.data[0,:1].repeat(P, axis=0))
+            assert_array_almost_equal(UTPM.dot(A, y).data[1:], 0)
+
+            y = UTPM.solve(A.data[0,0], x[:,0])
+            assert_array_almost_equal(y.data, numpy.linalg.solve(A.data[0,0], x[:,0].data[..., None])[..., 0])
+
+            Ainv = UTPM.inv(A)
+            Id = numpy.zeros((D,P,N,N))
+            Id[0] = numpy.eye(N)
+            assert_array_almost_equal(UTPM.dot(A, Ainv).data, Id)
+
+    def test_solve_without_scipy(self):
+        import algopy.utpm.algorithms as algorithms
+        (D,P,N,K) = 3,3,4,2
+        A = UTPM(numpy.random.rand(D,P,N,N) + 1j * numpy.random.rand(D,P,N,N))
+        A.data[0] += (N + 1) * numpy.eye(N)
+        x = UTPM(numpy.random.rand(D,P,N,K))
+
+        for shared in [True, False]:
+            if shared:
+                A.data[0] = A.data[0,0]
+            else:
+                A.data[0,1] += numpy.eye(N)
+
+            cases = [lambda: UTPM.solve(A, x).data,
+                     lambda: UTPM.solve(A, x[:,0]).data,
+                     lambda: UTPM.solve(A, x.data[0,0]).data,
+                     lambda: UTPM.solve(A.data[0,0], x).data,
+                     lambda: UTPM.inv(A).data]
+            desired = [f() for f in cases]
+
+            scipy = algorithms.scipy
+            algorithms.scipy = None
+            try:
+                actual = [f() for f in cases]
+            finally:
+                algorithms.scipy = scipy
+
+            for a, d in zip(actual, desired):
+                assert_array_almost_equal(a, d)
+
+    def test_solve_singular(self):
+        A = UTPM(numpy.zeros((2,3,2,2)))
+        x = UTPM(numpy.ones((2,3,2)))
+        assert_raises(numpy.linalg.LinAlgError, UTPM.solve, A, x)
+
     def test_shape(self):
         D,P,N,M,L = 3,4,5,6,7
 
@@ -1486,6 +1551,45 @@ class Test_Push_Forward(TestCase):
         assert_array_almost_equal(r2.data, r1.data)
 
 
+class Test_workaround_strides_function(TestCase):
+
+    def test_broadcast_target(self):
+        # numpy issue #2705: x2 is a broadcast view of x, i.e. all entries
+        # of x2 share the same memory and the contributions must accumulate
+        D,P,N = 2,3,4
+        x = UTPM(numpy.zeros((D,P,1)))
+        y = UTPM(numpy.random.rand(D,P,N))
+        x2, y2 = UTPM.broadcast(x, y)
+        workaround_strides_function(x2, y2, operator.iadd)
+        assert_array_almost_equal(x.data[..., 0], y.data.sum(axis=-1))
+
+        xbar, ybar = UTPM.pb_add(y, x, y, x + y)
+        assert_array_almost_equal(xbar.data[..., 0], y.data.sum(axis=-1))
+        assert_array_almost_equal(ybar.data, y.data)
+
+    def test_contiguous_and_overlapping_targets(self):
+        D,P,N,M = 2,3,4,5
+        x = UTPM(numpy.random.rand(D,P,N,M))
+        y = UTPM(numpy.random.rand(D,P,N,M))
+        desired = x.data + y.data
+        workaround_strides_function(x, y, operator.iadd)
+        assert_array_almost_equal(x.data, desired)
+
+        # y overlaps with x, the entries are updated one after another
+        desired = x.data.copy()
+        for n in range(N):
+            desired[:,:,n] += desired[:,:,N-1-n]
+        workaround_strides_function(x, UTPM(x.data[:,:,::-1]), operator.iadd)
+        assert_array_almost_equal(x.data, desired)
+
+        # and so are the entries if y is an array that overlaps with x
+        desired = x.data.copy()
+        for n in range(N):
+            desired[0,:,n] += desired[0,0,N-1-n]
+        workaround_strides_function(x, x.data[0,0,::-1], operator.iadd)
+        assert_array_almost_equal(x.data, desired)
+
+
 class Test_Pullbacks(TestCase):
     def test_solve_pullback(self):
         (D,P,N,K) = 2,5,3,4
@@ -1565,6 +1669,72 @@ class Test_Pullbacks(TestCase):
 
         assert_array_almost_equal(Xbar2.data, Xbar.data)
 
+    def test_mul_pullback_constant_first_argument(self):
+        D,P,N = 3,4,5
+        x = numpy.random.rand(N)
+        y = UTPM(numpy.random.rand(D,P,N))
+
+        z = y * x
+        zbar = UTPM(numpy.random.rand(D,P,N))
+
+        xbar, ybar = UTPM.pb_mul(zbar, x, y, z)
+        assert_equal(xbar, None)
+        assert_array_almost_equal(ybar.data, (zbar * x).data)
+
+        ybar = y.zeros_like()
+        UTPM.pb_mul(zbar, x, y, z, out = (None, ybar))
+        assert_array_almost_equal(ybar.data, (zbar * x).data)
+
+    def test_outer_pullback(self):
+        D,P,N = 3,4,5
+        x = UTPM(numpy.random.rand(D,P,N))
+        y = UTPM(numpy.random.rand(D,P,N))
+
+        z = UTPM.outer(x, y)
+        zbar = UTPM(numpy.random.rand(D,P,N,N))
+
+        xbar, ybar = UTPM.pb_outer(zbar, x, y, z, out = (x.zeros_like(), y.zeros_like()))
+
+        assert_array_almost_equal(xbar.data, UTPM.dot(zbar, y).data)
+        assert_array_almost_equal(ybar.data, UTPM.dot(zbar.T, x).data)
+
+    def test_dot_pullback_vectors_and_constants(self):
+        D,P,N,K = 3,4,5,6
+        A = UTPM(numpy.random.rand(D,P,N,K))
+        x = UTPM(numpy.random.rand(D,P,K))
+        A0 = A.data[0,0]
+        x0 = x.data[0,0]
+
+        # matrix-vector product, compared to the product of matrices
+        z = UTPM.dot(A, x)
+        zbar = UTPM(numpy.random.rand(D,P,N))
+        Abar, xbar = UTPM.pb_dot(zbar, A, x, z)
+
+        X = UTPM(x.data.reshape((D,P,K,1)))
+        Abar2, Xbar2 = UTPM.pb_dot(UTPM(zbar.data.reshape((D,P,N,1))), A, X, UTPM.dot(A, X))
+        assert_array_almost_equal(Abar.data, Abar2.data)
+        assert_array_almost_equal(xbar.data, Xbar2.data.reshape((D,P,K)))
+
+        # constant operands give the same adjoint as the lifted constants
+        for a, b in [(A0, x), (A, x0)]:
+            c = UTPM.dot(a, b)
+            abar = a.zeros_like() if isinstance(a, UTPM) else None
+            bbar = b.zeros_like() if isinstance(b, UTPM) else None
+            abar, bbar = UTPM.pb_dot(zbar, a, b, c, out=(abar, bbar))
+
+            if isinstance(a, UTPM):
+                a_lifted, b_lifted = a, UTPM(numpy.zeros((D,P,K)))
+                b_lifted.data[0] = b
+            else:
+                a_lifted, b_lifted = UTPM(numpy.zeros((D,P,N,K))), b
+                a_lifted.data[0] = a
+            abar2, bbar2 = UTPM.pb_dot(zbar, a_lifted, b_lifted, UTPM.dot(a_lifted, b_lifted))
+
+            if isinstance(a, UTPM):
+                assert_array_almost_equal(abar.data, abar2.data)
+            else:
+                assert_array_almost_equal(bbar.data, bbar2.data)
+
     def test_inv_pullback(self):
         D,P,N = 3,4,5
         X = UTPM(numpy.random.rand(D,P,N,N))
@@ -56,7 +56,18 @@ if NumpyVersion(numpy.version.version) >= '1.6.0':
         if x.shape != y.shape:
             raise ValueError('x.shape != y.shape')
 
-        if x.ndim == 0:
+        # The bug only affects targets x whose entries share memory, i.e.
+        # broadcast views with stride 0 (e.g. the adjoints of broadcast
+        # operands in the pullbacks), where fun has to be applied sequentially
+        # to accumulate all contributions. If additionally y does not overlap
+        # with x, fun(x, y) has the same result as the loop below, without
+        # one Python call per entry.
+        data = x.data
+        if all([n == 1 or s != 0 for n, s in zip(data.shape[2:], data.strides[2:])]) and \
+           not numpy.may_share_memory(data, numpy.asarray(getattr(y, 'data', y))):
+            fun(x, y)
+
+        elif x.ndim == 0:
             fun(x, y)
         else:
             for i in range(x.shape[0]):
@@ -278,7 +289,8 @@ class UTPM(Ring, RawAlgorithmsMixIn):
         ybar, dummy, xbar = out
         # print 'xbar =', xbar
         # print 'ybar =', ybar
-        xbar += ybar[sl]
+        if xbar is not None:
+            xbar += ybar[sl]
         ybar[sl].data[...] = 0.
         # print 'funcargs=',funcargs
         # print y[funcargs[0]]
@@ -2364,7 +2376,7 @@ class UTPM(Ring, RawAlgorithmsMixIn):
 
             ybar2, tmp = cls.broadcast(ybar, zbar)
 
-            workaround_strides_function(xbar2, zbar * x, operator.iadd)
+            workaround_strides_function(ybar2, zbar * x, operator.iadd)
             # ybar2 += zbar * x
 
             return (xbar, ybar)
@@ -2471,6 +2483,18 @@ class UTPM(Ring, RawAlgorithmsMixIn):
         # print 'ybar = ',type(ybar)
         # print 'zbar = ',type(zbar)
 
+        # a constant matrix or vector is not lifted to a UTPM instance, its
+        # adjoint is not needed
+        if not isinstance(x,cls) and isinstance(y,cls) and isinstance(ybar,cls) and \
+           numpy.ndim(x) in (1, 2) and y.ndim in (1, 2):
+            cls._dot_pullback_non_UTPM_x(zbar.data, numpy.asarray(x), y.data, z.data, out = ybar.data)
+            return (xbar,ybar)
+
+        if not isinstance(y,cls) and isinstance(x,cls) and isinstance(xbar,cls) and \
+           numpy.ndim(y) in (1, 2) and x.ndim in (1, 2):
+            cls._dot_pullback_non_UTPM_y(zbar.data, x.data, numpy.asarray(y), z.data, out = xbar.data)
+            return (xbar,ybar)
+
         if not isinstance(x,cls):
             D,P = z.data.shape[:2]
             tmp = cls(numpy.zeros((D,P) + x.shape,dtype=z.data.dtype))
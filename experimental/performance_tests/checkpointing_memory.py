@@ -0,0 +1,54 @@
+"""
+Peak memory and run time of the reverse mode with binomial checkpointing.
+
+Traces an explicit Euler integration with many time steps and computes
+the Hessian with the compiled program (all values stored) and with the
+checkpointed program for several numbers of checkpoints.
+"""
+
+import tracemalloc
+from time import time
+
+import numpy
+import algopy
+
+
+def trace(N, nsteps):
+    cg = algopy.CGraph()
+    x = algopy.Function(numpy.ones(N))
+    y = x
+    for i in range(nsteps):
+        cg.mark_step()
+        y = y + 0.01 * (algopy.sin(y) * x - y)
+    z = algopy.sum(y * y)
+    cg.trace_off()
+    cg.independentFunctionList = [x]
+    cg.dependentFunctionList = [z]
+    return cg
+
+
+def measure(cg, x):
+    tracemalloc.start()
+    start_time = time()
+    cg.hessian(x)
+    elapsed = time() - start_time
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+if __name__ == "__main__":
+
+    N, nsteps = 50, 1000
+    x = numpy.random.random(N)
+    cg = trace(N, nsteps)
+
+    cg.compile(release_buffers=False)
+    peak, elapsed = measure(cg, x)
+    print('all values stored:  %8.2f MB  %6.2fs'%(peak/1e6, elapsed))
+
+    for c in [2, 5, 10, 50]:
+        program = cg.compile(checkpoints=c)
+        peak, elapsed = measure(cg, x)
+        print('%3d checkpoints:     %8.2f MB  %6.2fs  %6d step evaluations'%(
+            c, peak/1e6, elapsed, program.recomputations))
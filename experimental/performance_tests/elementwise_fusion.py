@@ -0,0 +1,49 @@
+"""
+Runtime of the gradient and of the Hessian-vector product of the negative
+log-likelihood of a logistic regression model, evaluated by a compiled
+program without and with fusion of the elementwise operations.
+"""
+
+import time
+import numpy
+import algopy
+
+N = 10**6
+
+numpy.random.seed(0)
+vY = (numpy.random.random(N) > 0.5) * 1.
+
+
+def f(alpha):
+    return algopy.sum(vY*algopy.log1p(algopy.exp(-alpha)) +
+                      (1-vY)*algopy.log1p(algopy.exp(alpha)))
+
+
+alpha = numpy.random.random(N)
+v = numpy.random.random(N)
+cg = algopy.CGraph()
+fx = algopy.Function(alpha)
+fy = f(fx)
+cg.trace_off()
+cg.independentFunctionList = [fx]
+cg.dependentFunctionList = [fy]
+
+results = None
+for fused in [False, True]:
+    if fused:
+        print(cg.fuse())
+    cg.compile()
+
+    t = time.time()
+    g = cg.gradient(alpha)
+    t_gradient = time.time() - t
+
+    t = time.time()
+    Hv = cg.hess_vec(alpha, v)
+    t_hess_vec = time.time() - t
+
+    if results is None:
+        results = g, Hv
+    assert numpy.allclose(results[0], g)
+    assert numpy.allclose(results[1], Hv)
+    print('fused = %5s  gradient: %.3f s  hess_vec: %.3f s'%(fused, t_gradient, t_hess_vec))
@@ -0,0 +1,42 @@
+"""
+Gradients at many points: a loop over CGraph.gradient vs. CGraph.gradient_batch.
+"""
+
+from time import time
+
+import numpy
+import algopy
+
+
+def f(x):
+    y = x
+    for i in range(20):
+        y = algopy.sin(y) * x + algopy.exp(-y * y)
+    return algopy.sum(y)
+
+
+if __name__ == "__main__":
+
+    N = 10
+    cg = algopy.CGraph()
+    fx = algopy.Function(numpy.ones(N))
+    fy = f(fx)
+    cg.trace_off()
+    cg.independentFunctionList = [fx]
+    cg.dependentFunctionList = [fy]
+    cg.compile()
+
+    for B in [10, 100, 1000]:
+        X = numpy.random.random((B, N))
+
+        start_time = time()
+        G1 = numpy.array([cg.gradient(x) for x in X])
+        t_loop = time() - start_time
+
+        start_time = time()
+        G2 = cg.gradient_batch(X)
+        t_batch = time() - start_time
+
+        assert numpy.allclose(G1, G2)
+        print('B=%5d  loop: %.4fs  batch: %.4fs  speedup: %.1f'%(
+            B, t_loop, t_batch, t_loop/t_batch))
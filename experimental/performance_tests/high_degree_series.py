@@ -0,0 +1,51 @@
+"""
+Benchmark of the high-degree series arithmetic of algopy.utpm.series.
+
+Compares the O(D^2) recurrences of RawAlgorithmsMixIn with the FFT products
+and Newton iterations for several degrees D and numbers M of trailing
+entries (P times the size of the UTPM). The printed numbers are the run
+time of the recurrence divided by the run time of the series arithmetic,
+i.e. the series arithmetic is faster where they are larger than 1. They
+help to choose series.mul_degree_threshold and
+series.newton_degree_threshold when the engine is enabled.
+"""
+
+from time import time
+
+import numpy
+from algopy.utpm import UTPM, series
+
+
+def time_function(f, args, repetitions=3):
+    f(*args)
+    start_time = time()
+    for r in range(repetitions):
+        f(*args)
+    return (time() - start_time) / repetitions
+
+
+def recurrence(name):
+    f = getattr(UTPM, '_' + name)
+
+    def g(*args):
+        return f(*args, out=numpy.empty_like(args[0]))
+
+    return g
+
+
+if __name__ == "__main__":
+
+    series.mul_degree_threshold = series.newton_degree_threshold = None
+    names = ['mul', 'reciprocal', 'exp', 'log', 'sqrt']
+
+    print('   M     D  ' + '  '.join(['%10s'%name for name in names]))
+    for M in [10, 1000]:
+        for D in [32, 64, 128, 256, 512]:
+            x = numpy.random.random((D, M)) * 0.5
+            x[0] += 1.5
+            args = {'mul': (x, x), 'reciprocal': (x,), 'exp': (x,), 'log': (x,), 'sqrt': (x,)}
+
+            speedups = [time_function(recurrence(name), args[name]) /
+                        time_function(getattr(series, name), args[name])
+                        for name in names]
+            print('%5d %5d  '%(M, D) + '  '.join(['%10.2f'%s for s in speedups]))
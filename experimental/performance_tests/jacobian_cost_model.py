@@ -0,0 +1,111 @@
+"""
+Fits the constants of the cost model of CGraph.jacobian(x, mode='auto'),
+see algopy.tracer.passes.jacobian_cost_model.
+
+CGraph.jacobian is timed in the forward and in the reverse mode for a few
+test functions with different numbers of nodes, sizes of the values and
+dimensions N and M. The run times (in units of 10 ns) are then fitted by least
+squares (with non-negative constants) to
+
+    forward: NODE_OVERHEAD_FORWARD * nodes + FORWARD_FACTOR * N * size
+    reverse: NODE_OVERHEAD_REVERSE * nodes
+             + (REVERSE_FACTOR * M + REVERSE_ENTRY_OVERHEAD) * size
+
+and printed in the form of algopy/tracer/passes.py.
+"""
+
+from time import time
+
+import numpy
+from scipy.optimize import nnls
+import algopy
+from algopy.tracer.passes import tape_size, jacobian_cost_model
+
+UNIT = 1e-8
+
+
+def elementwise(x, depth):
+    y = x
+    for i in range(depth):
+        y = algopy.sin(y) * x + algopy.exp(-y * y)
+    return y
+
+
+def f_scalar(x, depth):
+    return algopy.sum(elementwise(x, depth))
+
+
+def f_vector(x, depth):
+    return elementwise(x, depth)
+
+
+def f_matrix(x, depth):
+    N = x.shape[0]
+    A = numpy.random.random((N, N))
+    y = algopy.dot(A, x)
+    for i in range(depth):
+        y = algopy.dot(A, algopy.sin(y)) + x
+    return y[:max(1, N//4)]
+
+
+def trace(f, N, depth):
+    cg = algopy.CGraph()
+    fx = algopy.Function(numpy.random.random(N))
+    fy = f(fx, depth)
+    cg.trace_off()
+    cg.independentFunctionList = [fx]
+    cg.dependentFunctionList = [fy]
+    cg.compile()
+    return cg
+
+
+def time_jacobian(cg, x, mode, repetitions=3):
+    cg.jacobian(x, mode=mode)
+    start_time = time()
+    for r in range(repetitions):
+        cg.jacobian(x, mode=mode)
+    return (time() - start_time) / repetitions / UNIT
+
+
+if __name__ == "__main__":
+
+    rows_forward, rows_reverse = [], []
+    t_forward, t_reverse = [], []
+
+    for f, sizes in [(f_scalar, [1, 10, 100, 1000]), (f_vector, [1, 10, 100, 1000]),
+                     (f_matrix, [1, 10, 100])]:
+        for N in sizes:
+            for depth in [2, 10, 40]:
+                cg = trace(f, N, depth)
+                x = numpy.random.random(N)
+                nodes, size = tape_size(cg.functionList)
+                M = numpy.size(cg.dependentFunctionList[0].x)
+
+                rows_forward.append([nodes, N * size])
+                rows_reverse.append([nodes, M * size, size])
+                t_forward.append(time_jacobian(cg, x, 'forward'))
+                t_reverse.append(time_jacobian(cg, x, 'reverse'))
+
+    # relative errors, the run times span several orders of magnitude
+    rows_forward = numpy.array(rows_forward, dtype=float)
+    rows_reverse = numpy.array(rows_reverse, dtype=float)
+    t_forward = numpy.array(t_forward)
+    t_reverse = numpy.array(t_reverse)
+    c_forward = nnls(rows_forward / t_forward[:, None], numpy.ones(len(t_forward)))[0]
+    c_reverse = nnls(rows_reverse / t_reverse[:, None], numpy.ones(len(t_reverse)))[0]
+
+    print('NODE_OVERHEAD_FORWARD = %.0f.'%c_forward[0])
+    print('NODE_OVERHEAD_REVERSE = %.0f.'%c_reverse[0])
+    print('FORWARD_FACTOR = %.2g'%c_forward[1])
+    print('REVERSE_FACTOR = %.2g'%c_reverse[1])
+    print('REVERSE_ENTRY_OVERHEAD = %.0f.'%c_reverse[2])
+
+    # how often the fitted and the current constants pick the faster mode
+    faster = t_forward < t_reverse
+    hits = numpy.sum((rows_forward.dot(c_forward) < rows_reverse.dot(c_reverse)) == faster)
+    print('the fitted constants pick the faster mode in %d of %d cases'%(hits, len(faster)))
+    hits = 0
+    for (nodes, Nsize), (nodes, Msize, size), is_faster in zip(rows_forward, rows_reverse, faster):
+        cost_forward, cost_reverse = jacobian_cost_model(nodes, size, Nsize/size, Msize/size)
+        hits += (cost_forward < cost_reverse) == is_faster
+    print('the current constants pick the faster mode in %d of %d cases'%(hits, len(faster)))
@@ -0,0 +1,51 @@
+"""
+Runtime of the gradient of a tape with independent blockwise matrix products
+and solves, evaluated by a compiled program without and with threads.
+
+The BLAS library should be restricted to a single thread, e.g. by
+
+    OPENBLAS_NUM_THREADS=1 OMP_NUM_THREADS=1 python parallel_levels.py
+
+such that the speedup is due to the level scheduling only.
+"""
+
+import time
+import numpy
+import algopy
+
+B = 8       # number of blocks
+N = 300     # size of the blocks
+
+numpy.random.seed(0)
+A = [numpy.random.random((N, N)) + N * numpy.eye(N) for b in range(B)]
+
+
+def f(x):
+    retval = 0
+    for b in range(B):
+        xb = x[b*N:(b+1)*N].reshape((N, 1))
+        M = algopy.dot(A[b], A[b] + algopy.dot(xb, xb.T))
+        retval = retval + algopy.sum(algopy.solve(M, xb))
+    return retval
+
+
+x = numpy.random.random(B * N)
+cg = algopy.CGraph()
+fx = algopy.Function(x)
+fy = f(fx)
+cg.trace_off()
+cg.independentFunctionList = [fx]
+cg.dependentFunctionList = [fy]
+
+g = None
+for threads in [None, 1, 2, 4, 8]:
+    cg.compile(release_buffers=False, threads=threads)
+    cg.gradient(x)
+    t = time.time()
+    for r in range(3):
+        gt = cg.gradient(x)
+    t = (time.time() - t) / 3
+    if g is None:
+        g, t0 = gt, t
+    assert numpy.allclose(g, gt)
+    print('threads = %4s  time = %.3f s  speedup = %.2f'%(threads, t, t0 / t))
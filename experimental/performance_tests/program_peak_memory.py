@@ -0,0 +1,48 @@
+"""
+Peak memory of CGraph.hessian with and without liveness based buffer release.
+
+Compares the interpreted tape, the compiled program that keeps all buffers
+and the compiled program that releases and recycles buffers.
+"""
+
+import tracemalloc
+
+import numpy
+import algopy
+
+
+def f(x):
+    y = x
+    for i in range(50):
+        y = algopy.exp(-y) + y - 0.5 * x
+    return algopy.sum(y * y)
+
+
+def peak_memory(cg, x):
+    tracemalloc.start()
+    cg.hessian(x)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == "__main__":
+
+    for N in [10, 100, 300]:
+        x = numpy.random.random(N)
+
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        m_tape = peak_memory(cg, x)
+        cg.compile(release_buffers=False)
+        m_keep = peak_memory(cg, x)
+        cg.compile(release_buffers=True)
+        m_release = peak_memory(cg, x)
+
+        print('N=%4d  tape: %8.2f MB  compiled: %8.2f MB  compiled+release: %8.2f MB'%(
+            N, m_tape/1e6, m_keep/1e6, m_release/1e6))
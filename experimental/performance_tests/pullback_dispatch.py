@@ -0,0 +1,60 @@
+"""
+Micro-benchmark of the reverse sweep CGraph.pullback.
+
+Compares the pullback dispatch that resolves ``UTPM.pb_<func name>`` with
+eval() at every node (the old behaviour) with the cached dispatch through
+``algopy.tracer.tracer.get_pullback_function``.
+"""
+
+from time import time
+
+import numpy
+import algopy
+from algopy import UTPM
+from algopy.tracer.tracer import Function
+
+
+def eval_pullback_function(self, xcls):
+    return eval('__import__("algopy.utpm").utpm.' + xcls.__name__ + '.pb_' + self.func.__name__)
+
+
+def f(x):
+    y = x
+    for i in range(200):
+        y = algopy.sin(y) * x + algopy.exp(-y) / (1. + x)
+    return algopy.sum(y)
+
+
+def time_sweeps(cg, x, repetitions):
+    cg.gradient(x)
+    start_time = time()
+    for r in range(repetitions):
+        cg.gradient(x)
+    return (time() - start_time) / repetitions
+
+
+if __name__ == "__main__":
+
+    repetitions = 10
+
+    for N in [1, 10, 50]:
+        x = numpy.random.random(N)
+
+        cg = algopy.CGraph()
+        fx = algopy.Function(x)
+        fy = f(fx)
+        cg.trace_off()
+        cg.independentFunctionList = [fx]
+        cg.dependentFunctionList = [fy]
+
+        cached = Function.get_pullback_function
+        Function.get_pullback_function = eval_pullback_function
+        try:
+            t_eval = time_sweeps(cg, x, repetitions)
+        finally:
+            Function.get_pullback_function = cached
+
+        t_cached = time_sweeps(cg, x, repetitions)
+
+        print('N=%4d  nodes=%5d  eval: %.5fs  cached: %.5fs  speedup: %.2f'%(
+            N, len(cg.functionList), t_eval, t_cached, t_eval/t_cached))
@@ -0,0 +1,43 @@
+"""
+Micro-benchmark of the Taylor multiplication UTPM._mul without pytpcore.
+
+Compares the old implementation, which sums a temporary x[:d+1]*y[d::-1]
+for each degree d, with the vectorized implementation of
+RawAlgorithmsMixIn._mul for several degrees D, directions P and sizes N.
+"""
+
+from time import time
+
+import numpy
+from algopy.utpm import UTPM
+
+
+def loop_mul(x_data, y_data, out):
+    D = x_data.shape[0]
+    for d in range(D)[::-1]:
+        numpy.sum(x_data[:d+1,:,...] * y_data[d::-1,:,...], axis=0, out=out[d,:,...])
+    return out
+
+
+def time_mul(mul, x_data, y_data, out, repetitions):
+    mul(x_data, y_data, out=out)
+    start_time = time()
+    for r in range(repetitions):
+        mul(x_data, y_data, out=out)
+    return (time() - start_time) / repetitions
+
+
+if __name__ == "__main__":
+
+    for D in [1, 2, 4, 8]:
+        for P, N in [(1, 10), (10, 100), (1, 10**5), (20, 10**5)]:
+            x_data = numpy.random.random((D, P, N))
+            y_data = numpy.random.random((D, P, N))
+            out = numpy.empty_like(x_data)
+            repetitions = max(1, 10**6 // (D * D * P * N))
+
+            t_loop = time_mul(loop_mul, x_data, y_data, out, repetitions)
+            t_mul = time_mul(UTPM._mul, x_data, y_data, out, repetitions)
+
+            print('D=%d  P=%2d  N=%6d  loop: %.2es  vectorized: %.2es  speedup: %.2f'%(
+                D, P, N, t_loop, t_mul, t_loop/t_mul))
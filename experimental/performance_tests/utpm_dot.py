@@ -0,0 +1,57 @@
+"""
+Benchmark of UTPM.dot and its pullback for many directions.
+
+Compares the old implementation, one numpy.dot call per degree, direction
+and convolution term, with RawAlgorithmsMixIn._dot (stacked matmul calls)
+and with the product of a constant matrix (_dot_non_UTPM_x).
+"""
+
+from time import time
+
+import numpy
+from algopy import UTPM
+
+
+def loop_dot(x_data, y_data, out):
+    out[...] = 0.
+    D, P = x_data.shape[:2]
+    for d in range(D):
+        for p in range(P):
+            for c in range(d+1):
+                out[d,p,...] += numpy.dot(x_data[c,p,...], y_data[d-c,p,...])
+    return out
+
+
+def loop_dot_non_UTPM_x(x, y_data, out):
+    D, P = y_data.shape[:2]
+    for d in range(D):
+        for p in range(P):
+            out[d,p,...] = numpy.dot(x, y_data[d,p,...])
+    return out
+
+
+def time_function(f, args, repetitions=5):
+    f(*args)
+    start_time = time()
+    for r in range(repetitions):
+        f(*args)
+    return (time() - start_time) / repetitions
+
+
+if __name__ == "__main__":
+
+    for N in [3, 10, 30]:
+        for D in [1, 2, 3]:
+            for P in [50, 500]:
+                x_data = numpy.random.random((D, P, N, N))
+                y_data = numpy.random.random((D, P, N, N))
+                out = numpy.empty_like(x_data)
+
+                t_loop = time_function(loop_dot, (x_data, y_data, out))
+                t_dot = time_function(lambda x, y, z: UTPM._dot(x, y, out=z), (x_data, y_data, out))
+                t_loop_const = time_function(loop_dot_non_UTPM_x, (x_data[0, 0], y_data, out))
+                t_const = time_function(lambda x, y, z: UTPM._dot_non_UTPM_x(x, y, out=z),
+                                        (x_data[0, 0], y_data, out))
+
+                print('N=%2d  D=%d  P=%3d  dot speedup: %6.2f  constant x speedup: %6.2f'%(
+                    N, D, P, t_loop/t_dot, t_loop_const/t_const))
@@ -0,0 +1,67 @@
+"""
+Benchmark of UTPM.solve and UTPM.inv for many directions.
+
+Compares the old implementation, one numpy.linalg.solve call (i.e. one LU
+factorization of A_0) per degree and direction, with
+RawAlgorithmsMixIn._solve and _inv, which factorize A_0 once and share the
+factorization among directions with the same base point.
+"""
+
+from time import time
+
+import numpy
+from algopy import UTPM
+
+
+def loop_solve(A_data, x_data, out):
+    D, P = A_data.shape[:2]
+    for p in range(P):
+        out[0,p] = numpy.linalg.solve(A_data[0,p], x_data[0,p])
+    for d in range(1, D):
+        for p in range(P):
+            tmp = x_data[d,p].copy()
+            for k in range(1, d+1):
+                tmp -= numpy.dot(A_data[k,p], out[d-k,p])
+            out[d,p] = numpy.linalg.solve(A_data[0,p], tmp)
+    return out
+
+
+def loop_inv(x_data, out):
+    D, P = x_data.shape[:2]
+    out[...] = 0.
+    for p in range(P):
+        out[0,p] = numpy.linalg.inv(x_data[0,p])
+    for d in range(1, D):
+        for p in range(P):
+            for c in range(1, d+1):
+                out[d,p] += numpy.dot(x_data[c,p], out[d-c,p])
+            out[d,p] = numpy.dot(-out[0,p], out[d,p])
+    return out
+
+
+def time_function(f, args, repetitions=5):
+    f(*args)
+    start_time = time()
+    for r in range(repetitions):
+        f(*args)
+    return (time() - start_time) / repetitions
+
+
+if __name__ == "__main__":
+
+    for N in [10, 100]:
+        for D in [2, 4]:
+            for P in [1, 20]:
+                A_data = numpy.random.random((D, P, N, N))
+                A_data[0] = numpy.random.random((N, N)) + N * numpy.eye(N)
+                x_data = numpy.random.random((D, P, N, 1))
+                out = numpy.empty_like(x_data)
+                out_inv = numpy.empty_like(A_data)
+
+                t_loop = time_function(loop_solve, (A_data, x_data, out))
+                t_solve = time_function(lambda A, x, y: UTPM._solve(A, x, out=y), (A_data, x_data, out))
+                t_loop_inv = time_function(loop_inv, (A_data, out_inv))
+                t_inv = time_function(lambda x, y: UTPM._inv(x, out=(y,)), (A_data, out_inv))
+
+                print('N=%3d  D=%d  P=%2d  solve speedup: %6.2f  inv speedup: %6.2f'%(
+                    N, D, P, t_loop/t_solve, t_loop_inv/t_inv))